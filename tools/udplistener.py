@@ -4,196 +4,973 @@
 __author__ = 'Jan KLopper (jan@underdark.nl)'
 __version__ = 0.1
 
-PROTOCOLVERSION = (1,2)
+PROTOCOLVERSION = (1,2,3)
 MAGIC = 101
-
+# Seconds the receive loop waits for a packet before giving the storage
+# backend a chance to flush buffered data.
+IDLETIMEOUT = 1.0
+# Maximum number of datagrams an ingest worker drains per wakeup.
+BATCHSIZE = 64
 import socket
 import argparse
+import errno
+import Queue
+import select
+import signal
 import struct
+import threading
 import time
 import os
 import sys
-import pickle
 import ConfigParser
 import math
+import traceback
+import wdcapture
+import wdlazy
+
+# The storage backends and optional features are imported when the options
+# first use them, so the listener only loads what it runs with.
+multiprocessing = wdlazy.LazyModule('multiprocessing', globals())
+wdadmission = wdlazy.LazyModule('wdadmission', globals())
+wdcarbon = wdlazy.LazyModule('wdcarbon', globals())
+wdcolumnar = wdlazy.LazyModule('wdcolumnar', globals())
+wdmetrics = wdlazy.LazyModule('wdmetrics', globals())
+wdrecent = wdlazy.LazyModule('wdrecent', globals())
+wdreduce = wdlazy.LazyModule('wdreduce', globals())
+wdsqlite = wdlazy.LazyModule('wdsqlite', globals())
+sqlite = wdlazy.Available('_sqlite3')
+
+# The config files with the sensor names, in the order they are read, and the
+# seconds between two checks whether they changed.
+CONFIGFILES = ('.weatherduino', os.path.expanduser('~/.weatherduino'))
+CONFIGCHECKINTERVAL = 10
+# Devices whose sensor names and metric paths are cached at most.
+MAXDEVICES = 65536
+
+# The python 2.7 socket module does not export SO_REUSEPORT, this is the Linux
+# value.
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+# Every packet starts with: magic, version, 3 device id bytes and probe count.
+HEADER = struct.Struct('<6B')
+# Version 3 packets have a uint16 sequence number between the header and the
+# probe fragments, which are the same as in version 2.
+FRAGMENTOFFSET = {1: 6, 2: 6, 3: 8}
+# Bytes per probe fragment and the struct layout of one fragment per version.
+FRAGMENTSIZE = {1: 3, 2: 5, 3: 5}
+FRAGMENTFORMAT = {1: 'BBB', 2: 'fB', 3: 'fB'}
+# The temperature and humidity of a probe without a (stored) reading.
+UNKNOWNTEMP = (129, 0)
+UNKNOWNHUMIDITY = 255
+_fragmentstructs = {}
+
+def FragmentStruct(version, probecount):
+  """Returns a cached Struct that unpacks `probecount` probe fragments of the
+  given protocol version in a single call."""
+  key = (version, probecount)
+  if key not in _fragmentstructs:
+    _fragmentstructs[key] = struct.Struct(
+        '<' + FRAGMENTFORMAT[version] * probecount)
+  return _fragmentstructs[key]
+
+# Most devices send one or two probes, for which the general decoder costs
+# more than the work itself. Their whole packets are unpacked by one Struct,
+# keyed on the version and probe count bytes (data[1:6:4]).
+SHORTPACKETS = dict(
+    (chr(version) + chr(probecount), (version, struct.Struct(
+        '<6B' + 'x' * (FRAGMENTOFFSET[version] - HEADER.size) +
+        FRAGMENTFORMAT[version] * probecount)))
+    for version in PROTOCOLVERSION for probecount in (1, 2))
 
-try:
-  import sqlite3
-  sqlite = True
-except ImportError:
-  sqlite = False
+def Decode(data):
+  """Decodes a data packet in one pass.
+
+  Returns a (device, temps, humidities) tuple where the lists hold one entry
+  per probe, or None if the packet is invalid. Probe fragments that are cut
+  off at the end of the packet are ignored."""
+  # The (version, Struct) of one and two probe packets, see SHORTPACKETS.
+  short = SHORTPACKETS.get(data[1:6:4])
+  if short and len(data) >= short[1].size:
+    values = short[1].unpack_from(data)
+    if values[0] != MAGIC:
+      return None
+    if short[0] == 1:
+      if len(values) == 9:
+        return values[2:5], [values[6:8]], [values[8]]
+      return values[2:5], [values[6:8], values[9:11]], [values[8], values[11]]
+    temp = values[6]
+    floor = math.floor(temp)
+    if len(values) == 8:
+      return values[2:5], [(int(floor), int((temp - floor) * 100))], [values[7]]
+    other = values[8]
+    otherfloor = math.floor(other)
+    return values[2:5], [(int(floor), int((temp - floor) * 100)),
+                         (int(otherfloor), int((other - otherfloor) * 100))], [
+                             values[7], values[9]]
+  if len(data) < HEADER.size:
+    return None
+  magic, version, dev0, dev1, dev2, probecount = HEADER.unpack_from(data)
+  if magic != MAGIC or version not in PROTOCOLVERSION:
+    return None
+  offset = FRAGMENTOFFSET[version]
+  if len(data) < offset:
+    return None
+  try:
+    fragments = _fragmentstructs[version, probecount]
+  except KeyError:
+    fragments = FragmentStruct(version, probecount)
+  if offset + fragments.size > len(data):
+    probecount = (len(data) - offset) // FRAGMENTSIZE[version]
+    fragments = FragmentStruct(version, probecount)
+  values = fragments.unpack_from(data, offset)
+  if version == 1:
+    humidities = list(values[2::3])
+    temps = zip(values[0::3], values[1::3])
+  else:
+    humidities = list(values[1::2])
+    temps = [(int(floor), int((temp - floor) * 100))
+             for temp, floor in zip(values[0::2],
+                                    map(math.floor, values[0::2]))]
+  return (dev0, dev1, dev2), temps, humidities
 
 class WeatherDuinoListener(object):
-  def __init__(self, options, handler):
+  def __init__(self, options, sinks):
     """This function listens for udp packets on all ethernet interfaces on the
-    given port and processes them."""
+    given port and hands them to every storage sink in `sinks`."""
 
     self.options = options
-    self.UDPSock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    self.UDPSock.bind(('', options.port))
+    self.workers = []
+    self.counters = {}
+    if options.workers > 1:
+      # Every ingest worker binds its own socket in RunWorkers.
+      self.UDPSock = None
+    else:
+      self.UDPSock = self.BindSocket()
     self.verbose = options.verbose
-    self.handler = getattr(self, handler)
+    if not (options.filter or self.verbose):
+      # Nothing to filter or print, skip the wrapper for every packet.
+      self.DecodePacket = Decode
+    self.sinks = [SinkWorker(sink, options.sinkqueue) for sink in sinks]
+    # The sinks that store the readings the reduce stage keeps, and those
+    # that get every packet.
+    self.reducer = self.Reducer()
+    self.reducedsinks = [sink for sink in self.sinks
+                         if self.reducer and sink.sink.reduced]
+    self.rawsinks = [sink for sink in self.sinks
+                     if sink not in self.reducedsinks]
+    self.admissions = []
+    if getattr(options, 'maxdevices', 0):
+      self.admissions.append(self.Admission())
+    self.capture = None
+    if getattr(options, 'capture', None):
+      self.capture = wdcapture.CaptureWriter(options.capture)
+    self.registry = None
+    if getattr(options, 'metrics', None):
+      self.StartMetrics()
+    for sink in self.sinks:
+      sink.start()
     print 'Starting WeatherDuino listener'
 
+  def StartMetrics(self):
+    """Sets up the listener's metrics, serves them over HTTP for Prometheus
+    and pushes them to Carbon when a Carbon server is configured."""
+    registry = self.registry = wdmetrics.Registry()
+    self.received = registry.Add(wdmetrics.Counter(
+        'weatherduino_packets_received_total', 'Datagrams received'))
+    self.invalid = registry.Add(wdmetrics.Counter(
+        'weatherduino_packets_invalid_total',
+        'Datagrams that are not a (wanted) WeatherDuino packet'))
+    # Only where the kernel reports drops (/proc/net/udp on Linux).
+    if wdmetrics.UDPDrops(self.options.port) is not None:
+      registry.Add(wdmetrics.Counter(
+          'weatherduino_socket_drops_total',
+          'Datagrams dropped by the kernel because the receive buffer was '
+          'full', function=lambda: wdmetrics.UDPDrops(self.options.port)))
+    self.decodelatency = registry.Add(wdmetrics.Histogram(
+        'weatherduino_decode_seconds', 'Time spent decoding a packet '
+        '(sampled)'))
+    self.handlelatency = registry.Add(wdmetrics.Histogram(
+        'weatherduino_handle_seconds', 'Time from receiving a packet until '
+        'it was queued for all sinks (sampled)'))
+    self.lastseen = registry.Add(wdmetrics.LastSeen(
+        'weatherduino_last_seen_timestamp',
+        'Last time a device sent a valid reading for a sensor',
+        self.options.lastseenage, MAXDEVICES, MAXDEVICES))
+    if self.admissions:
+      for reason in wdadmission.REASONS:
+        registry.Add(wdmetrics.Counter(
+            'weatherduino_packets_rejected_total',
+            'Packets rejected by the admission stage', {'reason': reason},
+            lambda reason=reason: self.AdmissionCount(reason)))
+      registry.Add(wdmetrics.Counter(
+          'weatherduino_packets_lost_total',
+          'Gaps in the sequence numbers of protocol version 3 devices',
+          function=lambda: self.AdmissionCount('lost')))
+    if self.reducer:
+      registry.Add(wdmetrics.Counter(
+          'weatherduino_readings_reduced_total',
+          'Sensor readings passed to the reduce stage',
+          function=lambda: self.reducer.added))
+      registry.Add(wdmetrics.Counter(
+          'weatherduino_readings_kept_total',
+          'Sensor readings the reduce stage passed on to the sinks',
+          function=lambda: self.reducer.kept))
+    for sink in self.sinks:
+      labels = {'sink': sink.name}
+      registry.Add(wdmetrics.Gauge(
+          'weatherduino_sink_queue_depth', 'Packets queued for a sink',
+          labels, sink.queue.qsize))
+      registry.Add(wdmetrics.Counter(
+          'weatherduino_sink_dropped_total',
+          'Packets dropped because the queue of a sink was full', labels,
+          lambda sink=sink: sink.dropped))
+      sink.latency = registry.Add(wdmetrics.Histogram(
+          'weatherduino_sink_store_seconds', 'Time a sink took to store a '
+          'packet (sampled)', labels))
+      sink.sink.Metrics(registry)
+    address = wdmetrics.ParseAddress(self.options.metrics)
+    self.metricsserver = wdmetrics.MetricsServer(registry, address)
+    print 'Serving metrics on http://%s:%d/metrics' % (
+        self.metricsserver.server_address)
+    self.metricspusher = None
+    if getattr(self.options, 'carbon', None):
+      server, port = self.options.carbon.split(':')
+      self.metricspusher = wdmetrics.CarbonPusher(
+          registry, wdcarbon.CarbonClient(server, port),
+          'weatherduino.listener.%s' % wdmetrics.Hostname(),
+          self.options.metricsinterval)
+      self.metricspusher.start()
+
+  def Reducer(self):
+    """Returns the reduce stage for the configured window and deadbands, or
+    None when every reading is stored. It works on temperatures in
+    hundredths."""
+    window = getattr(self.options, 'reducewindow', 0)
+    deadband = getattr(self.options, 'deadband', None)
+    if not window and deadband is None:
+      return None
+    if deadband is not None:
+      deadband = (int(round(deadband * 100)), self.options.humiditydeadband)
+    return wdreduce.Reducer(window, self.options.reduce, deadband,
+                            self.options.heartbeat, digits=0)
+
+  def Admission(self, shared=False):
+    """Returns a new admission stage with the configured limits."""
+    return wdadmission.Admission(
+        self.options.dedupwindow, self.options.ratelimit, self.options.burst,
+        self.options.maxdevices, shared)
+
+  def AdmissionCount(self, name):
+    """Returns a rejection count (or 'lost') summed over all admission
+    stages."""
+    return sum(admission.Count(name) for admission in self.admissions)
+
+  def BindSocket(self, reuseport=False):
+    """Returns a UDP socket bound to the listening port. With `reuseport` the
+    kernel spreads the incoming datagrams over all sockets bound this way."""
+    udpsock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if reuseport:
+      udpsock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    udpsock.bind(('', self.options.port))
+    return udpsock
+
   def Run(self):
+    if self.options.workers > 1:
+      return self.RunWorkers(self.options.workers)
     count = 0
+    received = self.registry and self.received
+    admission = self.admissions and self.admissions[0]
+    capture = self.capture
+    self.UDPSock.settimeout(IDLETIMEOUT)
     while True:
-      data, addr = self.UDPSock.recvfrom(1024)
+      try:
+        data, addr = self.UDPSock.recvfrom(1024)
+      except socket.timeout:
+        self.Idle()
+        continue
       if self.verbose:
         count = count + 1
         print 'Packet %s @ %s' % (count, time.strftime("%H:%M:%S"))
-      for measurement in self.ParsePacket(data):
-        self.handler(*measurement)
+      now = time.time()
+      if capture:
+        capture.Write(wdcapture.DATAGRAM, data, now)
+      if received:
+        received.value += 1
+      if admission and not admission.Admit(data, now):
+        continue
+      if received and not received.value % wdmetrics.SAMPLEEVERY:
+        self.TimedHandle(data)
+        continue
+      packet = self.DecodePacket(data)
+      if packet:
+        self.HandlePacket(now, packet)
+      elif received:
+        self.invalid.value += 1
+
+  def TimedHandle(self, data):
+    """Decodes and handles a packet like the Run loop, measuring how long
+    that takes."""
+    start = time.time()
+    packet = self.DecodePacket(data)
+    decoded = time.time()
+    self.decodelatency.Observe(decoded - start)
+    if packet:
+      self.HandlePacket(decoded, packet)
+      self.handlelatency.Observe(time.time() - start)
+    else:
+      self.invalid.value += 1
+
+  def RunWorkers(self, count):
+    """Receives and decodes packets in `count` worker processes, each with its
+    own SO_REUSEPORT socket, while this process feeds the storage sinks.
+
+    Workers drain up to BATCHSIZE datagrams per wakeup and hand the decoded
+    packets over in batches through a bounded queue. When the queue is full
+    the batch is dropped and counted, rather than letting the kernel drop
+    datagrams while the storage stage is busy."""
+    self.queue = multiprocessing.Queue(self.options.queuesize)
+    self.counters = dict((name, multiprocessing.Value('L', 0))
+                         for name in ('received', 'queued', 'dropped'))
+    self.counters['handled'] = multiprocessing.Value('L', 0, lock=False)
+    if self.registry:
+      self.RegisterWorkerMetrics()
+    # Every worker does the admission of the devices the kernel hashes to its
+    # socket, which are the same devices for as long as they keep their
+    # address and port.
+    if self.admissions:
+      self.admissions = [self.Admission(shared=True)
+                         for _worker in xrange(count)]
+    # Every worker appends to the capture file through its own writer.
+    if self.capture:
+      self.capture.Close()
+      self.capture = None
+    for number in xrange(count):
+      decodelatency = None
+      if self.registry:
+        decodelatency = self.registry.Add(wdmetrics.Histogram(
+            'weatherduino_decode_seconds', 'Time spent decoding a packet '
+            '(sampled)', {'worker': number}, shared=True))
+      admission = self.admissions and self.admissions[number]
+      worker = multiprocessing.Process(target=self.IngestWorker,
+                                       args=(decodelatency, admission))
+      worker.daemon = True
+      worker.start()
+      self.workers.append(worker)
+    handled = self.counters['handled']
+    while True:
+      try:
+        batch = self.queue.get(timeout=IDLETIMEOUT)
+      except Queue.Empty:
+        self.Idle()
+        continue
+      for timestamp, packet in batch:
+        self.HandlePacket(timestamp, packet)
+      handled.value += len(batch)
+      if self.registry:
+        # The oldest packet of every batch is the sample.
+        self.handlelatency.Observe(time.time() - batch[0][0])
+      if self.verbose:
+        print 'Batch of %d packets @ %s: %r' % (
+            len(batch), time.strftime("%H:%M:%S"), self.Counters())
+
+  def RegisterWorkerMetrics(self):
+    """Replaces the receive metrics of the Run loop by the worker counters,
+    the workers observe their own decode latency."""
+    for metric in (self.received, self.invalid, self.decodelatency):
+      self.registry.Remove(metric)
+    for name, help in (
+        ('received', 'Packets received and decoded by the workers'),
+        ('queued', 'Packets queued for the storage stage'),
+        ('dropped', 'Packets dropped because the storage queue was full'),
+        ('handled', 'Packets handed to the sinks by the storage stage')):
+      self.registry.Add(wdmetrics.Counter(
+          'weatherduino_packets_%s_total' % name, help,
+          function=lambda value=self.counters[name]: value.value))
+    self.registry.Add(wdmetrics.Gauge(
+        'weatherduino_queue_depth', 'Packets waiting for the storage stage',
+        function=lambda: self.Counters()['depth']))
+
+  def IngestWorker(self, decodelatency=None, admission=None):
+    """Receive loop of a single ingest worker process."""
+    udpsock = self.BindSocket(reuseport=True)
+    udpsock.setblocking(0)
+    received = self.counters['received']
+    queued = self.counters['queued']
+    dropped = self.counters['dropped']
+    capture = None
+    if getattr(self.options, 'capture', None):
+      capture = wdcapture.CaptureWriter(self.options.capture, 0)
+    datagrams = 0
+    try:
+      while True:
+        select.select([udpsock], [], [])
+        batch = []
+        for _datagram in xrange(BATCHSIZE):
+          try:
+            data = udpsock.recv(1024)
+          except socket.error, err:
+            if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+              break
+            raise
+          datagrams += 1
+          now = time.time()
+          if capture:
+            capture.Write(wdcapture.DATAGRAM, data, now)
+          if admission and not admission.Admit(data, now):
+            continue
+          if decodelatency and not datagrams % wdmetrics.SAMPLEEVERY:
+            packet = self.DecodePacket(data)
+            decodelatency.Observe(time.time() - now)
+          else:
+            packet = self.DecodePacket(data)
+          if packet:
+            batch.append((now, packet))
+        if not batch:
+          continue
+        with received.get_lock():
+          received.value += len(batch)
+        try:
+          self.queue.put_nowait(batch)
+          counter = queued
+        except Queue.Full:
+          counter = dropped
+        with counter.get_lock():
+          counter.value += len(batch)
+    except KeyboardInterrupt:
+      pass
+
+  def Counters(self):
+    """Returns the ingest counters. In worker mode these are the packets
+    received and decoded by the workers, queued for and dropped before the
+    storage stage, handled by the storage stage and currently waiting in the
+    queue. For every sink the dropped packets and its queue depth are added,
+    and the packets rejected (per reason) and lost with admission control."""
+    counters = dict((name, value.value)
+                    for name, value in self.counters.items())
+    if self.admissions:
+      for name in wdadmission.COUNTS:
+        counters[name] = self.AdmissionCount(name)
+    if self.reducer:
+      counters['reduce.added'] = self.reducer.added
+      counters['reduce.kept'] = self.reducer.kept
+    if 'queued' in counters:
+      counters['depth'] = max(0, counters['queued'] - counters['handled'])
+    for sink in self.sinks:
+      counters['%s.dropped' % sink.name] = sink.dropped
+      counters['%s.depth' % sink.name] = sink.queue.qsize()
+    return counters
+
+  def HandlePacket(self, timestamp, packet):
+    """Fans a decoded packet out to all storage sinks, through the reduce
+    stage for the sinks that store the reduced readings."""
+    for sink in self.rawsinks:
+      sink.Put((timestamp, packet))
+    if self.reducedsinks:
+      reduced = self.Reduce(timestamp, packet)
+      if reduced:
+        for sink in self.reducedsinks:
+          sink.Put((timestamp, reduced))
+    if self.registry:
+      lastseen = self.lastseen
+      if len(lastseen.packets) >= lastseen.maxdevices:
+        lastseen.Fold()
+      lastseen.packets[packet[0]] = timestamp, packet
+
+  def Reduce(self, timestamp, packet):
+    """Passes the readings of a packet through the reduce stage. Returns the
+    packet with the readings it leaves out as unknown, or None when it leaves
+    them all out."""
+    device, temps, humidities = packet
+    add = self.reducer.Add
+    reducedtemps = []
+    reducedhumidities = []
+    kept = False
+    for sensor in xrange(len(temps)):
+      temp = temps[sensor]
+      humidity = humidities[sensor]
+      readings = add((device, sensor), timestamp, (
+          temp[0] * 100 + temp[1] if temp[0] < 129 else None,
+          humidity if humidity < 255 else None))
+      if readings:
+        kept = True
+        temp, humidity = ReducedReading(readings[-1][1])
+      else:
+        temp, humidity = UNKNOWNTEMP, UNKNOWNHUMIDITY
+      reducedtemps.append(temp)
+      reducedhumidities.append(humidity)
+    if kept:
+      return device, reducedtemps, reducedhumidities
+    return None
+
+  def FlushReduced(self):
+    """Hands the readings of the open reduce windows to the sinks, as a
+    packet per device."""
+    packets = {}
+    for (device, sensor), timestamp, values in self.reducer.Flush():
+      stamp, readings = packets.setdefault(device, [timestamp, {}])
+      packets[device][0] = max(stamp, timestamp)
+      readings[sensor] = ReducedReading(values)
+    for device, (timestamp, readings) in packets.iteritems():
+      sensors = xrange(max(readings) + 1)
+      unknown = UNKNOWNTEMP, UNKNOWNHUMIDITY
+      packet = (device,
+                [readings.get(sensor, unknown)[0] for sensor in sensors],
+                [readings.get(sensor, unknown)[1] for sensor in sensors])
+      for sink in self.reducedsinks:
+        sink.Put((timestamp, packet))
 
   def ParsePacket(self, data):
-    """This processes the actual data packet"""
-    magic = ord(data[0])
-    version = ord(data[1])
-    if magic == MAGIC and version in PROTOCOLVERSION:
-      device = (ord(data[2]), ord(data[3]), ord(data[4]))
+    """This processes the actual data packet, yielding one measurement tuple
+    per probe. See DecodePacket for the faster, columnar version."""
+    packet = self.DecodePacket(data)
+    if packet:
+      device, temps, humidities = packet
+      for sensor in xrange(len(temps)):
+        yield (device, sensor, temps[sensor], humidities[sensor])
+
+  def DecodePacket(self, data):
+    """Decodes a data packet with Decode, returns None if the packet is
+    invalid or filtered."""
+    packet = Decode(data)
+    if packet and (self.options.filter or self.verbose):
+      device = packet[0]
       if self.options.filter and self.options.filter != device:
         if self.verbose:
-          print 'skipping device: %r' % device
-      else:
-        probecount = ord(data[5])
-        offset = 6
-        if self.verbose:
-          print '%d probes found on %x:%x:%x' % (
-              probecount, device[0], device[1], device[2])
-        if version == 1:
-          fragmentsize = 3
-          for sensor in range(0, probecount):
-            sensoroffet = (sensor*fragmentsize)+offset
-            humidity = ord(data[sensoroffet+2])
-            temp = (ord(data[sensoroffet]),
-                    ord(data[sensoroffet+1]))
-            yield (device, sensor, temp, humidity)
-        elif version == 2:
-          fragmentsize = 5
-          for sensor in xrange(0, probecount):
-            sensoroffet = (sensor*fragmentsize)+offset
-            humidity = ord(data[sensoroffet+4])
-            rawtemp = data[sensoroffet:sensoroffet+4]
-            temp = struct.unpack('<f', rawtemp)[0]
-            temp = (int(math.floor(temp)), int((temp - math.floor(temp))*100))
-            yield (device, sensor, temp, humidity)
-
-  def PrintMeasurements(self, device, sensor, temp, humidity):
-    """Prints the data for a sensor if either temperature or humidty is valid"""
-    device = '%x:%x:%x' % (device[0], device[1], device[2])
-    try:
-      sensor = self.options.config.get(device, str(sensor))
-    except (ConfigParser.NoOptionError, ConfigParser.NoSectionError):
-      pass
-    print device
-    if temp[0] < 129 or humidity < 255:
-      print 'Sensor %s:' % sensor
-    if temp[0] < 129:
-      print '\ttemp: %d.%02d℃' % temp
-    if humidity < 255:
-      print '\thumidity: %d%%' % humidity
+          print 'skipping device: %r' % (device,)
+        return None
+      if self.verbose:
+        print '%d probes found on %x:%x:%x' % (
+            len(packet[1]), device[0], device[1], device[2])
+    return packet
+
+  def Idle(self):
+    """Called when no packet arrived for IDLETIMEOUT seconds."""
+    if self.capture:
+      self.capture.Flush()
+
+  def Close(self):
+    """Flushes any pending output and releases the listening socket."""
+    for worker in self.workers:
+      worker.terminate()
+      worker.join()
+    if self.reducedsinks:
+      self.FlushReduced()
+    for sink in self.sinks:
+      sink.Close()
+    if self.capture:
+      self.capture.Close()
+      self.capture = None
+    if self.registry:
+      self.metricsserver.Close()
+      if self.metricspusher:
+        self.metricspusher.Close()
+      self.registry = None
+    if self.UDPSock:
+      self.UDPSock.close()
 
   def __del__(self):
-    self.UDPSock.close()
+    if self.UDPSock:
+      self.UDPSock.close()
+
+def ReducedReading(values):
+  """Returns the (temp, humidity) of a probe from the (hundredths, humidity)
+  values of the reduce stage."""
+  temp, humidity = values
+  return (UNKNOWNTEMP if temp is None else divmod(int(round(temp)), 100),
+          UNKNOWNHUMIDITY if humidity is None else int(round(humidity)))
+
+class SinkWorker(threading.Thread):
+  """Runs a storage sink in its own thread, fed through a bounded queue.
+
+  Every sink has its own queue, so a slow sink only fills up its own queue
+  and never stalls the receive loop or the other sinks. Packets that do not
+  fit in a full queue are dropped and counted."""
+  def __init__(self, sink, queuesize):
+    super(SinkWorker, self).__init__(name=sink.name)
+    self.daemon = True
+    self.sink = sink
+    self.queue = Queue.Queue(queuesize)
+    self.dropped = 0
+    # A wdmetrics.Histogram of the store latency, when metrics are enabled.
+    self.latency = None
+
+  def Put(self, item):
+    """Queues a (timestamp, packet) item for the sink without blocking."""
+    try:
+      self.queue.put_nowait(item)
+    except Queue.Full:
+      self.dropped += 1
+
+  def run(self):
+    sink = self.sink
+    stored = 0
+    try:
+      while True:
+        try:
+          item = self.queue.get(timeout=IDLETIMEOUT)
+        except Queue.Empty:
+          try:
+            sink.Idle()
+          except Exception:
+            print 'Error in %s sink:' % self.name
+            traceback.print_exc()
+          continue
+        if item is None:
+          break
+        timestamp, (device, temps, humidities) = item
+        stored += 1
+        timed = self.latency and not stored % wdmetrics.SAMPLEEVERY
+        if timed:
+          start = time.time()
+        try:
+          sink.StorePacket(timestamp, device, temps, humidities)
+        except Exception:
+          print 'Error in %s sink:' % self.name
+          traceback.print_exc()
+        if timed:
+          self.latency.Observe(time.time() - start)
+    finally:
+      # Writes whatever the sink still buffers, also if the loop broke down.
+      sink.Close()
+
+  def Close(self):
+    """Stores everything that is still queued and closes the sink."""
+    if self.is_alive():
+      self.queue.put(None)
+      self.join()
+
+
+def SensorNames(config):
+  """Returns the sensor names of a ~/.weatherduino config as a dict on
+  (device, sensor), with the device as 'a:b:c' hex and the sensor a number."""
+  names = {}
+  for device in config.sections():
+    for sensor, name in config.items(device):
+      if sensor.isdigit():
+        names[device, int(sensor)] = name
+  return names
+
 
-class LogWeatherDuinoListener(WeatherDuinoListener):
+class SensorResolver(object):
+  """Resolves the (device, sensor) of a measurement to the display name and
+  the Carbon metric paths of the sensor.
+
+  The names in the config files are parsed once into a dict. The names and
+  paths of a device are formatted the first time it is seen and cached on its
+  id tuple, so the sinks do no config lookups and no string formatting per
+  measurement. The config files are checked for changes once every
+  `checkinterval` seconds of packet timestamps (and when these jump back). A
+  change reloads the names and clears the cache, as does caching more than
+  MAXDEVICES devices (e.g. with spoofed device ids)."""
+
+  def __init__(self, filenames=CONFIGFILES, checkinterval=CONFIGCHECKINTERVAL):
+    self.filenames = filenames
+    self.checkinterval = checkinterval
+    self.checked = 0
+    self.mtimes = None
+    self.names = {}
+    # device id tuple -> ('a:b:c' name, [(name, temp path, humidity path)])
+    self.devices = {}
+    self.Check(time.time())
+
+  def Check(self, now):
+    """Reloads the names if a config file changed since they were loaded,
+    returns whether it did."""
+    self.checked = now
+    mtimes = []
+    for filename in self.filenames:
+      try:
+        mtimes.append(os.path.getmtime(filename))
+      except OSError:
+        mtimes.append(None)
+    if mtimes == self.mtimes:
+      return False
+    reload = self.mtimes is not None
+    # A broken config is not retried until it changes again.
+    self.mtimes = mtimes
+    config = ConfigParser.ConfigParser()
+    try:
+      config.read(self.filenames)
+    except ConfigParser.Error, err:
+      print 'Cannot read the sensor names: %s' % err
+      return False
+    self.names = SensorNames(config)
+    self.devices = {}
+    if reload:
+      print 'Reloaded the sensor names'
+    return True
+
+  def Sensor(self, devicename, sensor):
+    """Returns the (display name, temp path, humidity path) of a sensor, the
+    name defaults to the sensor number."""
+    name = self.names.get((devicename, sensor), sensor)
+    path = 'weather.%s.%s' % (devicename, name)
+    return name, path + '.temp', path + '.humidity'
+
+  def Device(self, device, sensors, now):
+    """Returns the 'a:b:c' name of a device id tuple and a list with the
+    Sensor tuples of (at least) its first `sensors` sensors."""
+    if not 0 <= now - self.checked < self.checkinterval:
+      self.Check(now)
+    cached = self.devices.get(device)
+    if cached is None:
+      if len(self.devices) >= MAXDEVICES:
+        self.devices = {}
+      cached = self.devices[device] = ('%x:%x:%x' % device, [])
+    devicename, table = cached
+    while len(table) < sensors:
+      table.append(self.Sensor(devicename, len(table)))
+    return cached
+
+
+class Sink(object):
+  """Base class of the storage backends.
+
+  A sink receives every decoded packet through StorePacket, which by default
+  calls StoreMeasurements for each probe. Sinks run in their own SinkWorker
+  thread; Idle is called there whenever no packet arrived for IDLETIMEOUT
+  seconds and Close when the listener shuts down. A sink that is not
+  `reduced` gets every packet, also with a reduce stage."""
+  name = 'sink'
+  reduced = True
+
+  def __init__(self, options):
+    self.options = options
+
+  def StorePacket(self, timestamp, device, temps, humidities):
+    for sensor in xrange(len(temps)):
+      self.StoreMeasurements(
+          timestamp, device, sensor, temps[sensor], humidities[sensor])
+
+  def StoreMeasurements(self, timestamp, device, sensor, temp, humidity):
+    raise NotImplementedError
+
+  def Metrics(self, registry):
+    """Adds the sink's own metrics to a wdmetrics.Registry, when metrics are
+    enabled."""
+    pass
+
+  def Idle(self):
+    pass
+
+  def Close(self):
+    pass
+
+
+class PrintSink(Sink):
+  """This abstraction outputs the collected data to stdout"""
+  name = 'print'
+
+  def StorePacket(self, timestamp, device, temps, humidities):
+    """Prints the data for every sensor, with its name if either temperature
+    or humidity is valid"""
+    device, names = self.options.sensors.Device(device, len(temps), timestamp)
+    for sensor in xrange(len(temps)):
+      temp = temps[sensor]
+      humidity = humidities[sensor]
+      print device
+      if temp[0] < 129 or humidity < 255:
+        print 'Sensor %s:' % names[sensor][0]
+      if temp[0] < 129:
+        print '\ttemp: %d.%02d℃' % temp
+      if humidity < 255:
+        print '\thumidity: %d%%' % humidity
+
+
+class LogSink(Sink):
   """This abstraction saves the collected data to a logfile"""
-  def __init__(self, options, handler):
+  name = 'log'
+
+  def __init__(self, options):
+    super(LogSink, self).__init__(options)
     self.logfile = file(options.log, 'a')
-    super(LogWeatherDuinoListener, self).__init__(options, handler)
 
-  def StoreMeasurements(self, device, sensor, temp, humidity):
+  def StoreMeasurements(self, timestamp, device, sensor, temp, humidity):
     """Store the data for a sensor if either temperature or humidty is valid"""
     self.logfile.write('\nDevice: %x:%x:%x\t' % (
         device[0], device[1], device[2]))
     if temp[0] < 129 or humidity < 255:
-      self.logfile.write('%s\tSensor %i:' % (time.strftime("%H:%M:%S"), sensor))
+      self.logfile.write('%s\tSensor %i:' % (
+          time.strftime("%H:%M:%S", time.localtime(timestamp)), sensor))
     if temp[0] < 129:
       self.logfile.write('\ttemp: %d.%02d℃ - ' % temp)
     if humidity < 255:
       self.logfile.write('\thumidity: %d%%' % humidity)
 
+  def Close(self):
+    self.logfile.close()
+
 if sqlite:
-  class SQLWeatherDuinoListener(WeatherDuinoListener):
+  class SQLSink(Sink):
     """This abstraction saves the collected data to a sqllite backend"""
+    name = 'sql'
+
+    def __init__(self, options):
+      super(SQLSink, self).__init__(options)
+      # The connection is created here but only used from the sink thread.
+      self.logconnection = wdsqlite.Connect(options.sql, options.verbose)
+      self.writer = wdsqlite.BufferedSQLWriter(
+          self.logconnection, options.sqlbatch, options.sqlinterval)
 
-    def __init__(self, options, handler):
-      super(SQLWeatherDuinoListener, self).__init__(options, handler)
-      skipcreate = False
-      if os.path.exists(options.sql):
-        skipcreate = True
-      self.logconnection = sqlite3.connect(options.sql)
-      if not skipcreate:
-        if options.verbose:
-          print 'Create sqlite database %s' % options.sql
-        cursor = self.logconnection.cursor()
-        cursor.execute("""
-          CREATE TABLE sensors (date, device, sensor, temp, humidity)""")
-        self.logconnection.commit()
-
-    def StoreMeasurements(self, device, sensor, temp, humidity):
+    def StoreMeasurements(self, timestamp, device, sensor, temp, humidity):
       """Store the data for a sensor if either temperature or humidity is valid"""
-      cursor = self.logconnection.cursor()
       if temp[0] < 129 or humidity < 255:
-        cursor.execute("INSERT INTO sensors VALUES (%d,'%s',%d,%f,%d)" % (
-            int(time.time()),
-            device,
+        self.writer.Add((
+            int(timestamp),
+            wdsqlite.DeviceName(device),
             sensor,
-            float('%d.%02d' % temp),
-            humidity))
-        self.logconnection.commit()
+            temp[0] + temp[1] / 100.0 if temp[0] < 129 else None,
+            humidity if humidity < 255 else None))
+
+    def Idle(self):
+      self.writer.Tick()
+
+    def Close(self):
+      self.writer.Close()
 
 
-class CarbonWeatherDuinoListener(WeatherDuinoListener):
+class CarbonSink(Sink):
   """This abstraction saves the collected data to a Carbon server"""
-  def __init__(self, options, handler):
-    super(CarbonWeatherDuinoListener, self).__init__(options, handler)
+  name = 'carbon'
+
+  def __init__(self, options):
+    super(CarbonSink, self).__init__(options)
     try:
       server, port = options.carbon.split(':')
-      self.carbonsocket = socket.create_connection((server, int(port)))
-    except socket.error, msg:
-      print 'Cannot connect to carbon server: %r' % msg
+    except ValueError:
+      print 'Carbon server should be given as host:port, not %r' % (
+          options.carbon)
       sys.exit()
+    self.client = wdcarbon.CarbonClient(
+        server, port, options.carbonbatch, options.carboninterval,
+        options.carbonbacklog, options.carbonspool, options.verbose)
+    self.client.Connect()
 
-  def StoreMeasurements(self, device, sensor, temp, humidity):
-    """Store the data for a sensor if either temperature or humidty is valid"""
-    output = {}
-    device = '%x:%x:%x' % (device[0], device[1], device[2])
+  def StorePacket(self, timestamp, device, temps, humidities):
+    """Store the data for every sensor with a valid temperature or humidity"""
+    paths = self.options.sensors.Device(device, len(temps), timestamp)[1]
+    timestamp = int(timestamp)
+    datapoints = []
+    for sensor in xrange(len(temps)):
+      temp = temps[sensor]
+      humidity = humidities[sensor]
+      if temp[0] < 129:
+        datapoints.append((paths[sensor][1],
+                           (timestamp, temp[0] + temp[1] / 100.0)))
+      if humidity < 255:
+        datapoints.append((paths[sensor][2], (timestamp, humidity)))
+    self.client.AddMany(datapoints)
+
+  def Metrics(self, registry):
+    """Exports the batching client's statistics, see CarbonClient.Stats."""
+    stats = self.client.stats
+    for name, kind, key, help in (
+        ('datapoints_total', wdmetrics.Counter, 'datapoints',
+         'Datapoints sent to carbon'),
+        ('batches_total', wdmetrics.Counter, 'batches',
+         'Batches sent to carbon'),
+        ('dropped_total', wdmetrics.Counter, 'dropped',
+         'Datapoints dropped because the backlog was full'),
+        ('spooled_total', wdmetrics.Counter, 'spooled',
+         'Datapoints spooled to disk because the backlog was full'),
+        ('connects_total', wdmetrics.Counter, 'connects',
+         'Connections made to carbon'),
+        ('last_batch_size', wdmetrics.Gauge, 'lastbatch',
+         'Datapoints in the last batch sent'),
+        ('last_flush_seconds', wdmetrics.Gauge, 'lastflush',
+         'Time sending the last batch took'),
+        ('max_flush_seconds', wdmetrics.Gauge, 'maxflush',
+         'Longest time sending a batch took')):
+      registry.Add(kind('weatherduino_carbon_%s' % name, help,
+                        function=lambda key=key: stats[key]))
+    for name, key, help in (
+        ('avg_flush_seconds', 'avgflush', 'Average time sending a batch took'),
+        ('pending', 'pending', 'Datapoints waiting for the next batch'),
+        ('backlog', 'backlog', 'Datapoints in batches not sent yet')):
+      registry.Add(wdmetrics.Gauge(
+          'weatherduino_carbon_%s' % name, help,
+          function=lambda key=key: self.client.Stats()[key]))
+
+  def Idle(self):
+    self.client.Tick()
+
+  def Close(self):
+    self.client.Close()
+    if self.options.verbose:
+      print 'Carbon client statistics: %r' % self.client.Stats()
+
+class ColumnarSink(Sink):
+  """This abstraction appends the collected data to columnar day segments"""
+  name = 'columnar'
+
+  def __init__(self, options):
+    super(ColumnarSink, self).__init__(options)
+    self.writer = wdcolumnar.ColumnarWriter(
+        options.columnar, options.columnarbatch, options.columnarinterval)
+
+  def StoreMeasurements(self, timestamp, device, sensor, temp, humidity):
+    """Store the data for a sensor if either temperature or humidity is valid"""
     if temp[0] < 129 or humidity < 255:
-      try:
-        sensor = self.options.config.get(device, str(sensor))
-      except (ConfigParser.NoOptionError, ConfigParser.NoSectionError):
-        pass
-      path = 'weather.%s' % (device, sensor)
-    if temp[0] < 129:
-      output['%s.temp' % path] = float('%d.%02d' % temp)
-    if humidity < 255:
-      output['%s.humidity' % path] = humidity
-    self.SendToCarbon(output)
-
-  def SendToCarbon(self, output):
-    """Wrapper to output data to Carbon as Pickeld data"""
-    timestamp = int(time.time())
-    items = []
-    for key, stat in sorted(output.items()):
-      items.append( (key, (timestamp, stat)))
-    payload = pickle.dumps(items)
-    header = struct.pack("!L", len(payload))
-    message = header + payload
-    self.carbonsocket.send(message)
+      self.writer.Add(
+          timestamp, device, sensor,
+          temp[0] + temp[1] / 100.0 if temp[0] < 129 else None,
+          humidity)
 
-  def __del__(self):
-    self.carbonsocket.shutdown(1)
-    self.carbonsocket.close()
+  def Idle(self):
+    self.writer.Tick()
+
+  def Close(self):
+    self.writer.Close()
+
+class RecentSink(Sink):
+  """This abstraction keeps the recent readings in memory and serves them"""
+  name = 'recent'
+  # The ring buffers show the current conditions, at the sensors' own rate.
+  reduced = False
+
+  def __init__(self, options):
+    super(RecentSink, self).__init__(options)
+    self.readings = wdrecent.RecentReadings(
+        wdrecent.Slots(options.recenthours, options.recentinterval),
+        options.recentseries)
+    self.server = wdmetrics.MetricsServer(
+        None, wdmetrics.ParseAddress(options.recent),
+        wdrecent.Routes(self.readings))
+    print 'Serving recent readings on http://%s:%d/latest (%.1f MB)' % (
+        self.server.server_address + (self.readings.Memory() / 1048576.0,))
+
+  def StorePacket(self, timestamp, device, temps, humidities):
+    """Store the data for every sensor with a valid temperature or humidity"""
+    device = self.options.sensors.Device(device, len(temps), timestamp)[0]
+    for sensor in xrange(len(temps)):
+      temp = temps[sensor]
+      humidity = humidities[sensor]
+      if temp[0] < 129 or humidity < 255:
+        self.readings.Add(
+            device, sensor, timestamp,
+            temp[0] + temp[1] / 100.0 if temp[0] < 129 else None,
+            humidity if humidity < 255 else None)
+
+  def Close(self):
+    self.server.Close()
+
+# The storage sinks by the option that selects them, in the order they are
+# set up. A sink only imports its backend when it is created.
+SINKS = (('log', LogSink),
+         ('carbon', CarbonSink),
+         ('sql', SQLSink if sqlite else None),
+         ('columnar', ColumnarSink),
+         ('recent', RecentSink))
 
 def main():
   """This program listenes to the broadcast address on the listening port and
   handles any received measurements
 
-  Measurements are stored in:
-	 sqlite (if available), logfile, Carbon, or outputs to stdout"""
+  Measurements are stored in any combination of:
+	 sqlite (if available), logfile, columnar segments and Carbon, or output to
+	 stdout"""
   parser = argparse.ArgumentParser()
-  parser.add_argument("-p", "--port", dest="port",
+  parser.add_argument("-p", "--port", dest="port", type=int,
                     help="Listen port", default=65001)
   parser.add_argument("-v", "--verbose", dest="verbose",
                     action="store_true",
@@ -201,30 +978,112 @@ def main():
   parser.add_argument("-l", "--logoutput", dest="log",
                     help="Output file")
   parser.add_argument("-c", "--carbon", dest="carbon",
-                    help="Carbon server")
+                    help="Carbon server (host:port of the pickle receiver)")
+  parser.add_argument("--carbonbatch", dest="carbonbatch", type=int,
+                    help="Datapoints per carbon batch", default=500)
+  parser.add_argument("--carboninterval", dest="carboninterval", type=float,
+                    help="Max seconds datapoints wait before being sent",
+                    default=5.0)
+  parser.add_argument("--carbonbacklog", dest="carbonbacklog", type=int,
+                    help="Datapoints kept in memory while carbon is down",
+                    default=100000)
+  parser.add_argument("--carbonspool", dest="carbonspool",
+                    help="File to spool carbon data to when the backlog is full")
+  parser.add_argument("--columnar", dest="columnar",
+                    help="Directory for columnar day segments")
+  parser.add_argument("--columnarbatch", dest="columnarbatch", type=int,
+                    help="Records per columnar write", default=500)
+  parser.add_argument("--columnarinterval", dest="columnarinterval",
+                    type=float, default=5.0,
+                    help="Max seconds records wait before being written")
+  parser.add_argument("-m", "--metrics", dest="metrics",
+                    help="[host:]port to serve Prometheus metrics on "
+                    "(host defaults to 127.0.0.1), also pushed to carbon")
+  parser.add_argument("--metricsinterval", dest="metricsinterval", type=int,
+                    help="Seconds between metric pushes to carbon",
+                    default=60)
+  parser.add_argument("--lastseenage", dest="lastseenage", type=int,
+                    help="Seconds after which a silent sensor is no longer "
+                    "exported in the last seen metric", default=7 * 86400)
+  parser.add_argument("--recent", dest="recent",
+                    help="[host:]port to serve the recent readings on as "
+                    "JSON (host defaults to 127.0.0.1)")
+  parser.add_argument("--recenthours", dest="recenthours", type=float,
+                    help="Hours of readings kept per sensor", default=1.0)
+  parser.add_argument("--recentinterval", dest="recentinterval", type=float,
+                    help="Seconds between the readings of a sensor, a sensor "
+                    "reporting more often is kept for less time", default=2.0)
+  parser.add_argument("--recentseries", dest="recentseries", type=int,
+                    help="Sensors the recent readings are kept for",
+                    default=256)
+  parser.add_argument("--dedupwindow", dest="dedupwindow", type=float,
+                    help="Seconds within which a repeated payload from a "
+                    "device is dropped as a duplicate (0 disables)",
+                    default=0.5)
+  parser.add_argument("--ratelimit", dest="ratelimit", type=float,
+                    help="Packets per second a device may send on average "
+                    "(0 disables)", default=5.0)
+  parser.add_argument("--burst", dest="burst", type=int,
+                    help="Packets a device may send at once", default=20)
+  parser.add_argument("--maxdevices", dest="maxdevices", type=int,
+                    help="Devices the admission stage keeps state for, 0 "
+                    "disables deduplication, rate limits and sequence "
+                    "tracking", default=4096)
+  parser.add_argument("--reducewindow", dest="reducewindow", type=float,
+                    help="Seconds over which the readings of a sensor are "
+                    "aggregated into one before they are stored (0 stores "
+                    "every reading)", default=0)
+  parser.add_argument("--reduce", dest="reduce",
+                    choices=('avg', 'min', 'max', 'last'),
+                    help="Aggregate stored per window", default='avg')
+  parser.add_argument("--deadband", dest="deadband", type=float,
+                    help="Only store a reading when the temperature moved "
+                    "more than this many degrees, or the humidity more than "
+                    "--humiditydeadband, since the last stored one",
+                    default=None)
+  parser.add_argument("--humiditydeadband", dest="humiditydeadband",
+                    type=float, help="Humidity deadband in percent, 0 only "
+                    "leaves out unchanged humidities", default=0)
+  parser.add_argument("--heartbeat", dest="heartbeat", type=float,
+                    help="Seconds after which a reading is stored even "
+                    "within the deadband", default=300)
+  parser.add_argument("--capture", dest="capture",
+                    help="Record every received datagram to this file, for "
+                    "wdreplay.py and wdbackfill.py")
   parser.add_argument("-f", "--filter", dest="filter",
                     help="Filter device")
+  parser.add_argument("-w", "--workers", dest="workers", type=int,
+                    help="Ingest worker processes (SO_REUSEPORT)", default=1)
+  parser.add_argument("--queuesize", dest="queuesize", type=int,
+                    help="Packet batches queued for storage in worker mode",
+                    default=1024)
+  parser.add_argument("--sinkqueue", dest="sinkqueue", type=int,
+                    help="Packets queued per storage sink", default=1024)
   if sqlite:
     parser.add_argument("-s", "--sqloutput", dest="sql",
                       help="sqlite file")
+    parser.add_argument("--sqlbatch", dest="sqlbatch", type=int,
+                      help="Rows per sqlite transaction", default=500)
+    parser.add_argument("--sqlinterval", dest="sqlinterval", type=float,
+                      help="Max seconds rows wait before being written",
+                      default=5.0)
   options = parser.parse_args()
 
-  config = ConfigParser.ConfigParser()
+  options.sensors = SensorResolver()
+
+  sinks = [sinkclass(options) for option, sinkclass in SINKS
+           if sinkclass and getattr(options, option, None)]
+  if not sinks:
+    sinks.append(PrintSink(options))
+  wduino = WeatherDuinoListener(options, sinks)
+  # Make a supervisor's SIGTERM unwind like ^C so buffered data is written.
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
   try:
-    config.read(['.weatherduino', os.path.expanduser('~/.weatherduino')])
-    options.config = config
-  except:
+    wduino.Run()
+  except KeyboardInterrupt:
     pass
-
-  if options.log:
-    wduino = LogWeatherDuinoListener(options, 'StoreMeasurements')
-  elif options.carbon:
-    wduino = CarbonWeatherDuinoListener(options, 'StoreMeasurements')
-  elif options.sql and sqlite:
-    wduino = SQLWeatherDuinoListener(options, 'StoreMeasurements')
-  else:
-    wduino = WeatherDuinoListener(options, 'PrintMeasurements')
-  wduino.Run()
+  finally:
+    wduino.Close()
 
 if __name__ == '__main__':
   main()
@@ -9,13 +9,25 @@ http://frack.nl/wiki/WeatherDuino """
 __author__ = 'Rudi Daemen <fludizz@gmail.com>'
 __version__ = '0.2'
 
-import rrdtool
 import sys
 import optparse
 import ConfigParser
 import os
-import serial
+import re
+import signal
+import threading
 import time
+import zlib
+import wdcapture
+import wdlazy
+# Only imported when they are used, e.g. wdbackfill.py uses the RRDWriter
+# without a serial port and the parser is benchmarked without rrdtool.
+multiprocessing = wdlazy.LazyModule("multiprocessing", globals())
+rrdtool = wdlazy.LazyModule("rrdtool", globals())
+serial = wdlazy.LazyModule("serial", globals())
+wdmetrics = wdlazy.LazyModule("wdmetrics", globals())
+wdrecent = wdlazy.LazyModule("wdrecent", globals())
+wdreduce = wdlazy.LazyModule("wdreduce", globals())
 try:
     import simplejson as json
 except ImportError:
@@ -48,107 +60,458 @@ TIMEDELTA = {"day": "-86400",
              "week": "-604800", 
              "month": "-2628000", 
              "year": "-31536000" }
+# Seconds per primary data point, rrdtool.create defaults to 300 seconds.
+STEP = 300
+# Seconds without an update after which a data source is unknown (DEFRRD).
+HEARTBEAT = 600
+# Number of primary data points per consolidated row of the RRA each graph
+# shows (see DEFRRD). A graph only changes once the last update of the RRD
+# file moves into the next consolidated row.
+TIMESTEPS = {"day": 1,
+             "week": 6,
+             "month": 24,
+             "year": 288 }
+# The consolidated row each graph was last rendered for, keyed on
+# (rrdfile, delta).
+RENDERED = {}
+# Line colours of the probes in the graphs, repeated for stations with more.
+COLOURS = ["#00CC00", "#FF9900", "#9900FF", "#0000CC",
+           "#CC0000", "#00CCCC", "#CCCC00", "#CC00CC"]
+# A line of WeatherDuino serial output and the probes in it, as printed by the
+# firmware: {"WeatherDuino":[{"probe":1,"temp":21.50,"humid":45.00},...]}
+# Arduino prints an invalid float as 'nan', 'inf' or 'ovf'.
+SERIALLINE = re.compile(r'\{"WeatherDuino":\[(.*)\]\}\s*$')
+SERIALPROBE = re.compile(r'\{"probe":(\d+),"temp":(-?\d+(?:\.\d+)?|[a-z]+),'
+                         r'"humid":(-?\d+(?:\.\d+)?|[a-z]+)\}')
 
 
-def UpdateRRDfile(path, rrd, val, defs=DEFRRD):
-  ''' This function only writes collected data to the RRD File but does NOT 
-  write new images. This increases the data detail for the daily graphs. This
-  does not need to be called more often however due to the Humidity probes being
-  relativly inaccurate (only whole percents at a time), this causes a smoother
-  graph for the humidity data. '''
-  rrdfile = os.path.abspath("%s/%s" % (path, rrd))
-  # Check if the rrdfile exists and create if needed.
-  if not os.path.isfile(rrdfile):
-    print "INFO: RRD file %s does not exist. Creating a new RRD file." % rrdfile
-    rrdtool.create(rrdfile, defs)
-  # update the data in the rrdfile:
-  while len(val) < 4:
-    val.append("NaN")
-  rrdtool.update(rrdfile, "N:%s" % ":".join(map(str, val)))
-
-
-def ProcessRRDdata(path, rrd, prefix, name, axis_unit):
-  ''' This function updates the graphs using the RRDfile at path/rrd. It will
-  always generate a new daily graph on each run. However, it will only create
-  the weekly/monthly/yearly graphs once every half their avaraging-time. '''
-  rrdfile = os.path.abspath("%s/%s" % (path, rrd))
-  imgname = os.path.abspath("%s/%s_%s" % (path, prefix, name))
+def RRDDefs(probes, defs=DEFRRD):
+  ''' Returns the rrdtool.create definitions for a file with the given
+  number of probes: defs with its data sources extended to P<probes> like
+  the first one. Files always have at least the data sources of defs. '''
+  sources = [definition for definition in defs if definition.startswith("DS:")]
+  extra = [sources[0].replace(":P1:", ":P%d:" % probe)
+           for probe in xrange(len(sources) + 1, probes + 1)]
+  return sources + extra + [definition for definition in defs
+                             if not definition.startswith("DS:")]
 
+
+def DataSources(rrdfile):
+  ''' Returns the names of the data sources of an RRD file, in order. '''
+  sources = {}
+  for key, value in rrdtool.info(rrdfile).iteritems():
+    if key.startswith("ds[") and key.endswith("].index"):
+      sources[int(value)] = key[3:-7]
+  return [sources[index] for index in sorted(sources)]
+
+
+class RRDWriter(object):
+  ''' Collects timestamped samples for RRD files and writes them with a single
+  multi-value rrdtool.update per file, instead of one small write per serial
+  line. This is a lot kinder to SD cards. Samples are written once `batch` are
+  pending for a file or the oldest is `maxdelay` seconds old.
+
+  With `daemon` (e.g. 'unix:/var/run/rrdcached.sock') the updates go through
+  rrdcached, which batches the disk writes even further. If the daemon socket
+  is missing or the daemon fails, the writer falls back to direct updates.
+
+  New files get a data source per value of their first sample, at least those
+  of defs (see RRDDefs). A failed update (e.g. a locked file) is logged and
+  its samples are dropped and counted in `failed`. '''
+
+  def __init__(self, batch=30, maxdelay=60, daemon=None, defs=DEFRRD):
+    self.batch = batch
+    self.maxdelay = maxdelay
+    self.defs = defs
+    self.daemon = daemon
+    if daemon and daemon.startswith("unix:") and not os.path.exists(daemon[5:]):
+      print "rrdcached socket %s not found, updating RRD files directly" % (
+          daemon[5:])
+      self.daemon = None
+    # Stations add samples from their own threads.
+    self.lock = threading.RLock()
+    # RRD files known to exist, so they are only checked once, and the number
+    # of data sources of each.
+    self.known = set()
+    self.sources = {}
+    # Files that got more values than they have data sources.
+    self.truncated = set()
+    # Pending update strings per RRD file, the time the oldest was queued and
+    # the timestamp of the most recent sample.
+    self.pending = {}
+    self.oldest = {}
+    self.last = {}
+    # Samples dropped because their update failed.
+    self.failed = 0
+
+  def Add(self, rrdfile, val, timestamp=None):
+    ''' Queues the values in val for rrdfile, at timestamp or now. Missing
+    values (None) are stored as unknown. A new RRD file starts just before its
+    first sample, so historical samples can be written to it. A sample in the
+    same second as the pending last one replaces it. Returns False if the
+    sample is older than the last one of the file and was dropped. '''
+    with self.lock:
+      if timestamp is None:
+        timestamp = int(time.time())
+      if rrdfile not in self.known:
+        if not os.path.isfile(rrdfile):
+          print "INFO: RRD file %s does not exist. Creating a new RRD " \
+                "file." % rrdfile
+          defs = RRDDefs(len(val), self.defs)
+          rrdtool.create(rrdfile, ["--start", str(timestamp - 1)] + defs)
+          self.sources[rrdfile] = len(
+              [definition for definition in defs if definition[:3] == "DS:"])
+          # The render scheduler reads `last` of every known file without
+          # the lock, so it is set before the file becomes known.
+          self.last[rrdfile] = timestamp - 1
+        else:
+          self.sources[rrdfile] = len(DataSources(rrdfile))
+          if rrdfile not in self.last:
+            self.last[rrdfile] = rrdtool.last(rrdfile)
+        self.known.add(rrdfile)
+      val = ["U" if value is None else value for value in val]
+      sources = self.sources[rrdfile]
+      if len(val) > sources:
+        # rrdtool rejects updates with more values than data sources.
+        if rrdfile not in self.truncated:
+          print "WARNING: %s has %d data sources, ignoring the values of " \
+                "probe %d and up. Move the file aside to start a new one " \
+                "with a data source per probe." % (rrdfile, sources,
+                                                   sources + 1)
+          self.truncated.add(rrdfile)
+        del val[sources:]
+      while len(val) < sources:
+        val.append("NaN")
+      values = ":".join(map(str, val))
+      pending = self.pending.setdefault(rrdfile, [])
+      if pending and timestamp == self.last[rrdfile]:
+        # RRD only accepts increasing timestamps, keep the latest values of
+        # a second.
+        pending[-1] = "%d:%s" % (timestamp, values)
+      elif timestamp > self.last.get(rrdfile, 0):
+        if not pending:
+          self.oldest[rrdfile] = time.time()
+        pending.append("%d:%s" % (timestamp, values))
+        self.last[rrdfile] = timestamp
+      else:
+        return False
+      if len(pending) >= self.batch:
+        self.Flush(rrdfile)
+      return True
+
+  def Tick(self):
+    ''' Writes the pending samples of every file that waited too long. '''
+    with self.lock:
+      now = time.time()
+      for rrdfile, pending in self.pending.items():
+        if pending and now - self.oldest[rrdfile] >= self.maxdelay:
+          self.Flush(rrdfile)
+
+  def Sync(self, rrdfile):
+    ''' Writes the pending samples for rrdfile and has rrdcached write its
+    cache of the file to disk, so rrdtool.graph sees all data. Only called
+    just before a graph of the file is rendered. '''
+    with self.lock:
+      self.Flush(rrdfile)
+      if self.daemon:
+        try:
+          rrdtool.flushcached(rrdfile, "--daemon", self.daemon)
+        except rrdtool.error, err:
+          print "[%s] Error flushing %s in rrdcached: %s" % (
+              time.ctime(), rrdfile, err)
+
+  def Flush(self, rrdfile=None):
+    ''' Writes the pending samples for rrdfile, or for all files. With
+    rrdcached they stay in the daemon's cache, see Sync. '''
+    with self.lock:
+      rrdfiles = [rrdfile] if rrdfile else self.pending.keys()
+      for rrdfile in rrdfiles:
+        samples = self.pending.pop(rrdfile, None)
+        if not samples:
+          continue
+        if self.daemon:
+          try:
+            rrdtool.update(rrdfile, "--daemon", self.daemon, *samples)
+            continue
+          except rrdtool.error, err:
+            print "[%s] rrdcached failed, updating directly from now on: " \
+                "%s" % (time.ctime(), err)
+            self.daemon = None
+        try:
+          rrdtool.update(rrdfile, *samples)
+        except rrdtool.error, err:
+          # Requeuing would fail again on a bad sample, drop the batch.
+          self.failed += len(samples)
+          print "[%s] Error updating %s, %d samples dropped (%d in total): " \
+              "%s" % (time.ctime(), rrdfile, len(samples), self.failed, err)
+
+
+def NeedsRender(rrdfile, imgfile, delta, last):
+  ''' Returns the consolidated row the graph for delta would show, given the
+  last update time of the RRD file, or None if the graph was already rendered
+  for that row and would come out the same. After a restart an existing image
+  that is newer than the start of the row counts as rendered. '''
+  steplength = STEP * TIMESTEPS[delta]
+  row = last // steplength
+  key = (rrdfile, delta)
+  if key not in RENDERED and os.path.isfile(imgfile):
+    if os.path.getmtime(imgfile) >= row * steplength:
+      RENDERED[key] = row
+  if RENDERED.get(key) == row:
+    return None
+  return row
+
+
+class Graph(object):
+  ''' A graph of one RRD file over one timespan (delta), with the data
+  sources it shows, its slot in the render interval and the CPU seconds its
+  last render took. '''
+
+  def __init__(self, rrdfile, imgfile, delta, name, axis_unit, slot):
+    self.rrdfile = rrdfile
+    self.imgfile = imgfile
+    self.delta = delta
+    self.name = name
+    self.axis_unit = axis_unit
+    self.slot = slot
+    self.sources = None
+    self.cpu = None
+    self.charged = 0.0
+    # The intervals the graph was last handled in and deferred in, and its
+    # running render.
+    self.handled = None
+    self.deferred = None
+    self.rendering = None
+
+
+class RenderScheduler(object):
+  ''' Renders the graphs of all stations, spread over the render interval.
+
+  Every graph has a fixed slot in the interval, derived from a checksum of
+  its image file name, so the renders of many stations are jittered across
+  the interval instead of all starting at once. At its slot a graph is
+  rendered if new data reached the RRA it shows (see NeedsRender), in the
+  pool when there is one. A graph still rendering from the previous interval
+  is skipped.
+
+  The render CPU time of an interval is kept within `budget` times the CPU
+  seconds the render processes have in it (0.5 with 4 processes and 300
+  seconds is 600 CPU seconds). A render is charged with the CPU time of its
+  previous render until it reports its own, a graph that was never rendered
+  with that of the latest render. Until the first render reported, renders
+  run one at a time. Graphs that do not fit the budget
+  wait for the next interval, daily graphs go first. Every render is
+  reported with its wall clock and CPU time. '''
+
+  def __init__(self, writer, pool=None, processes=1, interval=STEP,
+               budget=0.5):
+    self.writer = writer
+    self.pool = pool
+    self.interval = interval
+    self.budget = budget * max(1, processes) * interval
+    self.graphs = []
+    self.current = None
+    self.used = 0.0
+    self.rendered = 0
+    self.deferred = 0
+    # CPU seconds of the latest render, the cost of graphs not rendered yet,
+    # and the renders running in the pool.
+    self.estimate = None
+    self.running = 0
+
+  def Add(self, rrdfile, imgname, name, axis_unit):
+    ''' Schedules the graphs of every timespan of an RRD file, rendered to
+    imgname-<delta>.png. '''
+    for delta in TIMEDELTA:
+      imgfile = "%s-%s.png" % (imgname, delta)
+      slot = zlib.crc32(imgfile) % self.interval
+      self.graphs.append(
+          Graph(rrdfile, imgfile, delta, name, axis_unit, slot))
+    self.graphs.sort(key=lambda graph: (TIMESTEPS[graph.delta], graph.slot))
+
+  def Tick(self, now=None):
+    ''' Collects the finished renders and starts those whose slot came up.
+    Called about every second. '''
+    if now is None:
+      now = time.time()
+    self.Collect()
+    number, offset = divmod(int(now), self.interval)
+    if number != self.current:
+      if self.current is not None and (self.rendered or self.deferred):
+        print "[%s] Rendered %d graphs in %.1f of %.1f CPU seconds, %d " \
+            "deferred" % (time.ctime(), self.rendered, self.used,
+                          self.budget, self.deferred)
+      self.current = number
+      self.used = self.rendered = self.deferred = 0
+    # The daily graphs change every interval, the CPU time they still need in
+    # this one is kept free of the other graphs.
+    reserve = sum(self.Cost(graph) or 0.0 for graph in self.graphs
+                  if graph.delta == "day" and graph.handled != number)
+    synced = set()
+    for graph in self.graphs:
+      if graph.slot > offset or graph.handled == number:
+        continue
+      if graph.rendering:
+        # Don't pile up renders of the same graph on a slow machine.
+        graph.handled = number
+        if graph.delta == "day":
+          reserve -= self.Cost(graph) or 0.0
+        continue
+      if graph.rrdfile not in self.writer.known:
+        # No readings for this file yet, so nothing to draw.
+        continue
+      cost = self.Cost(graph)
+      if cost is None:
+        if self.running:
+          continue
+        cost = 0.0
+      if graph.delta != "day":
+        cost += reserve
+      if self.used and self.used + cost > self.budget:
+        if graph.deferred != number:
+          graph.deferred = number
+          self.deferred += 1
+        continue
+      graph.handled = number
+      if graph.deferred == number:
+        # Renders that finished cheaper than charged made room for it.
+        self.deferred -= 1
+      if graph.delta == "day":
+        reserve -= cost
+      # The writer knows the last sample of the file, pending or written.
+      row = NeedsRender(graph.rrdfile, graph.imgfile, graph.delta,
+                        self.writer.last[graph.rrdfile])
+      if row is None:
+        continue
+      if graph.rrdfile not in synced:
+        self.writer.Sync(graph.rrdfile)
+        synced.add(graph.rrdfile)
+      # Recorded first, a failed render clears it again to retry the graph.
+      RENDERED[graph.rrdfile, graph.delta] = row
+      self.Render(graph)
+
+  def Cost(self, graph):
+    if graph.cpu is None:
+      return self.estimate
+    return graph.cpu
+
+  def Render(self, graph):
+    if graph.sources is None:
+      graph.sources = DataSources(graph.rrdfile)
+    args = (graph.imgfile, graph.delta, graph.rrdfile, graph.name,
+            graph.axis_unit, graph.sources)
+    graph.charged = self.Cost(graph) or 0.0
+    self.used += graph.charged
+    self.rendered += 1
+    if self.pool:
+      graph.rendering = self.pool.apply_async(RenderGraph, args)
+      self.running += 1
+    else:
+      try:
+        timing = RenderGraph(*args)
+      except Exception, err:
+        self.Failed(graph, err)
+      else:
+        self.Rendered(graph, timing)
+
+  def Collect(self):
+    ''' Reports the renders that finished in the pool. '''
+    for graph in self.graphs:
+      if graph.rendering and graph.rendering.ready():
+        result, graph.rendering = graph.rendering, None
+        self.running -= 1
+        # Besides rrdtool errors, writing the image or the pool itself can
+        # fail; neither should take down the stations.
+        try:
+          timing = result.get()
+        except Exception, err:
+          self.Failed(graph, err)
+        else:
+          self.Rendered(graph, timing)
+
+  def Rendered(self, graph, timing):
+    elapsed, cpu = timing
+    self.used += cpu - graph.charged
+    graph.cpu = self.estimate = cpu
+    print "[%s] Rendered %s in %.2fs (%.2f CPU seconds)" % (
+        time.ctime(), os.path.basename(graph.imgfile), elapsed, cpu)
+
+  def Failed(self, graph, err):
+    print "[%s] Error rendering %s: %s" % (time.ctime(), graph.imgfile, err)
+    RENDERED.pop((graph.rrdfile, graph.delta), None)
+
+
+def GraphDefs(rrdfile, sources, name, axis_unit):
+  ''' Returns the rrdtool.graph definitions that draw every data source of
+  rrdfile with its last, maximum, average and minimum value. '''
   # Dirty fix for the escaping mismatch... RRDtool uses the % sign in *some*
   # parameters as the escaping character but not in the axis unit. This cause
   # the escape value to break the rrd graph generation. If the unit is %, make
   # it an escaped % sign ('%%') and don't do this for the axis.
   # Also include a space for the % sign, to fix the legend layout.
   unit = axis_unit.replace('%', '%% ')
-  # Generate graphs for each configured Delta in TIMEDELTA:
-  for delta in TIMEDELTA.keys():
-    # All graphs for different timedelta's are generate at different minutes to
-    # reduce the CPU overhead while generating the images. Usefull for low power
-    # devices like a Raspberry Pi.
-    if delta == "day" and int(time.strftime("%M")) % 5 == 0:
-      # Generate the daily graphs every 5 minutes.
-      gen_graph = True
-    elif delta == "week" and int(time.strftime("%M")) in (5, 20, 35, 50):
-      # Generate the Weekly graph every 15 minutes (at minutes 5, 20, 35 and 50)
-      gen_graph = True
-    elif delta == "month" and int(time.strftime("%M")) == 55:
-      # Generate the Monthly graphs once every hour (at minute 55).
-      gen_graph = True
-    elif delta == "year" and int(time.strftime("%H")) in (0, 12):
-      # Generate the yearly graphs once every 12 hours (at 12:00 and 0:00).
-      gen_graph = True
-    else:
-      gen_graph = False
-    if gen_graph:
-      rrdtool.graph(
-          "%s-%s.png" % (imgname, delta),
-          "--start", TIMEDELTA[delta],
-          "--vertical-label=%s (%s)" % (name, axis_unit),
-          "--slope-mode",
-          "--font", "LEGEND:7:mono",
-          "DEF:P1avg=%s:P1:AVERAGE" % rrdfile,
-          "DEF:P2avg=%s:P2:AVERAGE" % rrdfile,
-          "DEF:P3avg=%s:P3:AVERAGE" % rrdfile,
-          "DEF:P4avg=%s:P4:AVERAGE" % rrdfile,
-          "DEF:P1min=%s:P1:MIN" % rrdfile,
-          "DEF:P2min=%s:P2:MIN" % rrdfile,
-          "DEF:P3min=%s:P3:MIN" % rrdfile,
-          "DEF:P4min=%s:P4:MIN" % rrdfile,
-          "DEF:P1max=%s:P1:MAX" % rrdfile,
-          "DEF:P2max=%s:P2:MAX" % rrdfile,
-          "DEF:P3max=%s:P3:MAX" % rrdfile,
-          "DEF:P4max=%s:P4:MAX" % rrdfile,
-          "TEXTALIGN:left",
-          # Using whitespaces to align everything. Tabs behave unpredictable!
-          "COMMENT:Last      Max       Avg       Min  \\r",
-          "LINE1:P1avg#00CC00:Probe1\::",
-          "GPRINT:P1avg:LAST:%%6.1lf%s" % unit,
-          "GPRINT:P1max:MAX:%%6.1lf%s" % unit,
-          "GPRINT:P1avg:AVERAGE:%%6.1lf%s" % unit,
-          "GPRINT:P1min:MIN:%%6.1lf%s\\r" % unit,
-          "LINE1:P2avg#FF9900:Probe2\::",
-          "GPRINT:P2avg:LAST:%%6.1lf%s" % unit,
-          "GPRINT:P2max:MAX:%%6.1lf%s" % unit,
-          "GPRINT:P2avg:AVERAGE:%%6.1lf%s" % unit,
-          "GPRINT:P2min:MIN:%%6.1lf%s\\r" % unit,
-          "LINE1:P3avg#9900FF:Probe3\::",
-          "GPRINT:P3avg:LAST:%%6.1lf%s" % unit,
-          "GPRINT:P3max:MAX:%%6.1lf%s" % unit,
-          "GPRINT:P3avg:AVERAGE:%%6.1lf%s" % unit,
-          "GPRINT:P3min:MIN:%%6.1lf%s\\r" % unit,
-          "LINE1:P4avg#0000CC:Probe4\::",
-          "GPRINT:P4avg:LAST:%%6.1lf%s" % unit,
-          "GPRINT:P4max:MAX:%%6.1lf%s" % unit,
-          "GPRINT:P4avg:AVERAGE:%%6.1lf%s" % unit,
-          "GPRINT:P4min:MIN:%%6.1lf%s\\r" % unit)
-
-
-def GetWeatherDevice(device="/dev/ttyUSB0", baud=57600):
+  defs = []
+  for consolidation, suffix in (("AVERAGE", "avg"), ("MIN", "min"),
+                                ("MAX", "max")):
+    for source in sources:
+      defs.append("DEF:%s%s=%s:%s:%s" % (source, suffix, rrdfile, source,
+                                         consolidation))
+  defs.append("TEXTALIGN:left")
+  # Using whitespaces to align everything. Tabs behave unpredictable!
+  defs.append("COMMENT:Last      Max       Avg       Min  \\r")
+  for pos, source in enumerate(sources):
+    legend = re.sub(r"^P(\d+)$", r"Probe\1", source)
+    defs.extend([
+        "LINE1:%savg%s:%s\\::" % (source, COLOURS[pos % len(COLOURS)],
+                                  legend),
+        "GPRINT:%savg:LAST:%%6.1lf%s" % (source, unit),
+        "GPRINT:%smax:MAX:%%6.1lf%s" % (source, unit),
+        "GPRINT:%savg:AVERAGE:%%6.1lf%s" % (source, unit),
+        "GPRINT:%smin:MIN:%%6.1lf%s\\r" % (source, unit)])
+  return defs
+
+
+def RenderGraph(imgfile, delta, rrdfile, name, axis_unit, sources=None):
+  ''' Renders the graph for the given timedelta from the RRDfile, with a line
+  per data source (P1 to P4 by default). Returns the wall clock and CPU
+  seconds the render took. '''
+  start = time.time()
+  cpu = sum(os.times()[:2])
+  rrdtool.graph(
+      imgfile,
+      "--start", TIMEDELTA[delta],
+      "--vertical-label=%s (%s)" % (name, axis_unit),
+      "--slope-mode",
+      "--font", "LEGEND:7:mono",
+      *GraphDefs(rrdfile, sources or ["P1", "P2", "P3", "P4"], name,
+                 axis_unit))
+  return time.time() - start, sum(os.times()[:2]) - cpu
+
+
+def IgnoreInterrupt():
+  ''' Lets only the main process handle ^C, the render pool follows it. '''
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def GetWeatherDevice(device="/dev/ttyUSB0", baud=57600, capture=None):
   ''' Generate a device/object useable for the program, if it is a valid device
-  (e.g. a WeatherDuino). '''
+  (e.g. a WeatherDuino). Given a wdcapture.CaptureWriter as capture, the
+  detection lines are recorded there, so a replay can be detected too. '''
   weatherduino = serial.Serial(device, baud, timeout=30)
-  weatherduino.setDTR(True)
-  weatherduino.setDTR(False)
+  if capture:
+    readline = weatherduino.readline
+    def CapturedReadline():
+      line = readline()
+      capture.Write(wdcapture.SERIAL, line)
+      return line
+    weatherduino.readline = CapturedReadline
+  try:
+    weatherduino.setDTR(True)
+    weatherduino.setDTR(False)
+  except IOError:
+    # A pseudo terminal (e.g. a wdreplay.py replay) has no DTR line to reset
+    # the Arduino with.
+    pass
   # Clear the initial junk from the buffer
   weatherduino.flushInput()
   weatherduino.readline()
@@ -161,74 +524,316 @@ def GetWeatherDevice(device="/dev/ttyUSB0", baud=57600):
     raise Exception('Device %s (%sbps) is not a WeatherDuino!' % (device, baud))
 
 
+class SerialParser(object):
+  ''' Decodes the serial output of a WeatherDuino into the temps and hums
+  lists, which hold the latest reading of every probe (probe is position + 1)
+  and are reused for every line. Data is fed as it is read from the serial
+  port, partial lines are kept until the rest arrives. Lines that are not
+  WeatherDuino output are counted as junk rather than raising an error.
+
+  The ignore list (e.g. 'T1,H2') is parsed once, the ignored sensors are set
+  to "U", which means Unknown in the RRDtool specifications.
+
+  Given a wdcapture.CaptureWriter as capture, every line is recorded there
+  as it was received. '''
+
+  def __init__(self, num, ignore=None, name="WeatherDuino"):
+    self.num = int(num)
+    self.name = name
+    self.temps = [None] * self.num
+    self.hums = [None] * self.num
+    self.ignoretemps = []
+    self.ignorehums = []
+    for sens in (ignore or "").upper().split(','):
+      sens = sens.strip()
+      if not sens:
+        continue
+      if sens[0] not in "TH" or not sens[1:].isdigit() or \
+          not 0 < int(sens[1:]) <= self.num:
+        print "%s: Ignoring invalid ignore entry '%s'" % (name, sens)
+      elif sens[0] == "T":
+        self.ignoretemps.append(int(sens[1:]) - 1)
+      else:
+        self.ignorehums.append(int(sens[1:]) - 1)
+    for pos in self.ignoretemps:
+      self.temps[pos] = "U"
+    for pos in self.ignorehums:
+      self.hums[pos] = "U"
+    # Probes updated by the last line, positions as in temps and hums.
+    self.updated = []
+    self.buffer = ""
+    self.lines = 0
+    self.junk = 0
+    self.unconfigured = set()
+    self.capture = None
+
+  def Feed(self, data):
+    ''' Decodes every complete line in data and returns how many of them were
+    WeatherDuino readings. '''
+    self.buffer += data
+    if "\n" not in self.buffer:
+      return 0
+    lines = self.buffer.split("\n")
+    self.buffer = lines.pop()
+    readings = 0
+    for line in lines:
+      if self.capture:
+        self.capture.Write(wdcapture.SERIAL, line + "\n")
+      if self.ParseLine(line):
+        readings += 1
+    return readings
+
+  def ParseLine(self, line):
+    ''' Decodes a single line into temps and hums and returns whether it was a
+    WeatherDuino reading. '''
+    self.lines += 1
+    match = SERIALLINE.match(line)
+    if not match:
+      if line.strip():
+        self.junk += 1
+      return False
+    updated = self.updated
+    del updated[:]
+    for probe, temp, humid in SERIALPROBE.findall(match.group(1)):
+      pos = int(probe) - 1
+      if not 0 <= pos < self.num:
+        if probe not in self.unconfigured:
+          print "%s: Ignoring unconfigured probe with ID '%s'" % (
+              self.name, probe)
+          self.unconfigured.add(probe)
+        continue
+      self.temps[pos] = float(temp) if temp[-1].isdigit() else None
+      self.hums[pos] = float(humid) if humid[-1].isdigit() else None
+      updated.append(pos)
+    if not updated:
+      self.junk += 1
+      return False
+    for pos in self.ignoretemps:
+      self.temps[pos] = "U"
+    for pos in self.ignorehums:
+      self.hums[pos] = "U"
+    return True
+
+
+def StationConfigs(config):
+  ''' Returns the configuration of every WeatherDuino in config. Each
+  [device:NAME] section describes one station, with the port, baud and num
+  options of [device] and optionally its own prefix (defaults to NAME) and
+  ignore list. Without such sections, [device] and [files] describe a single
+  station, as before. A capture option names a file to record the serial
+  output of a station in, for wdreplay.py. '''
+  misc = config.get("misc", {})
+  stations = []
+  for section in sorted(config):
+    if section.startswith("device:"):
+      station = dict(config[section])
+      station["name"] = section[7:]
+      station.setdefault("prefix", station["name"])
+      station.setdefault("ignore", misc.get("ignore"))
+      stations.append(station)
+  if not stations:
+    station = dict(config["device"])
+    station["name"] = config["files"]["prefix"]
+    station["prefix"] = config["files"]["prefix"]
+    station["ignore"] = misc.get("ignore")
+    stations.append(station)
+  return stations
+
+
+def Reducers(config):
+  ''' Returns the wdreduce.Reducer for the temperatures and the one for the
+  humidities of a station, as configured in the reduce section, or None when
+  every reading is written. '''
+  window = float(config.get("window") or 0)
+  deadband = config.get("deadband")
+  if not window and deadband in (None, ""):
+    return None
+  deadbands = (None, None)
+  if deadband not in (None, ""):
+    deadbands = (float(deadband), float(config.get("humiditydeadband") or 0))
+  # RRD files fill the time before an update with its value, so the reading
+  # left out last is written before a change (see wdreduce).
+  return tuple(wdreduce.Reducer(window, config.get("aggregate") or "avg",
+                                band, float(config.get("heartbeat") or 300),
+                                backfill=True)
+               for band in deadbands)
+
+
+def KnownValue(value):
+  ''' Returns a probe reading, or None for an invalid or ignored one. '''
+  if isinstance(value, float):
+    return value
+  return None
+
+
+class Station(threading.Thread):
+  ''' Reads the serial output of a single WeatherDuino in its own thread and
+  queues the readings in the shared RRDWriter, and in the shared
+  wdrecent.RecentReadings if one is given (as station name and probe). With
+  reducers (see Reducers), the RRD files only get the readings they keep.
+  '''
+
+  def __init__(self, station, path, writer, recent=None, reducers=None):
+    super(Station, self).__init__(name=station["name"])
+    self.daemon = True
+    self.station = station
+    self.writer = writer
+    self.recent = recent
+    self.reducers = reducers
+    # Keeps Flush from the main thread out of the reducers while they work.
+    self.lock = threading.Lock()
+    self.prefix = station["prefix"]
+    self.temprrd = "%s_temp.rrd" % self.prefix
+    self.humidrrd = "%s_humid.rrd" % self.prefix
+    self.temppath = os.path.abspath("%s/%s" % (path, self.temprrd))
+    self.humidpath = os.path.abspath("%s/%s" % (path, self.humidrrd))
+    print "[%s] Writing sensor data to files '%s/%s*'" % (
+        self.name, path, self.prefix)
+    self.capture = None
+    if station.get("capture"):
+      # Unbuffered, serial output is slow and a capture should survive a kill.
+      self.capture = wdcapture.CaptureWriter(station["capture"], 0)
+      print "[%s] Capturing serial output to '%s'" % (
+          self.name, station["capture"])
+
+  def run(self):
+    try:
+      self.ReadDevice()
+    except serial.serialutil.SerialException, err:
+      print "[%s] %s Error: %s" % (time.ctime(), self.name, err)
+
+  def ReadDevice(self):
+    ''' Open the WeatherDuino device and run an endless loop collecting its
+    weather data. '''
+    station = self.station
+    # Initialize the WeatherDuino!
+    arduino = GetWeatherDevice(station["port"], station["baud"], self.capture)
+    # clear any potential junk from the buffer
+    arduino.readline()
+
+    parser = SerialParser(station['num'], station["ignore"], self.name)
+    parser.capture = self.capture
+    temps = parser.temps
+    hums = parser.hums
+    while True:
+      # Keep reading the buffer, the serial device times out otherwise.
+      if not parser.Feed(arduino.read(arduino.inWaiting() or 1)):
+        continue
+      for pos in parser.updated:
+        print "[%s] %s Probe %s: T%s H%s;" % (
+            time.ctime(), self.name, pos + 1, temps[pos], hums[pos])
+
+      # Queue the samples for the RRD files regardless of the graphs/time
+      timestamp = int(time.time())
+      if self.recent:
+        for pos in parser.updated:
+          self.recent.Add(self.name, pos + 1, timestamp,
+                          KnownValue(temps[pos]), KnownValue(hums[pos]))
+      if self.reducers:
+        self.Reduce(timestamp, temps, hums)
+      else:
+        self.writer.Add(self.temppath, temps, timestamp)
+        self.writer.Add(self.humidpath, hums, timestamp)
+      self.writer.Tick()
+
+  def Reduce(self, timestamp, temps, hums):
+    ''' Queues the readings the reducers keep. Invalid and ignored readings
+    are unknown. '''
+    with self.lock:
+      for rrdfile, values, reducer in (
+          (self.temppath, temps, self.reducers[0]),
+          (self.humidpath, hums, self.reducers[1])):
+        for sample in reducer.Add(rrdfile, timestamp,
+                                  tuple(map(KnownValue, values))):
+          self.writer.Add(rrdfile, list(sample[1]), sample[0])
+
+  def Flush(self):
+    ''' Queues the readings of the reduce windows that are still open. '''
+    if not self.reducers:
+      return
+    with self.lock:
+      for reducer in self.reducers:
+        for rrdfile, timestamp, values in reducer.Flush():
+          self.writer.Add(rrdfile, list(values), timestamp)
+
+
 def ContinualRRDwrite(config):
-  ''' Open the WeatherDuino device, run an endless loop for collecting and 
-  writing weather data. '''
+  ''' Open all configured WeatherDuino devices, each read by its own Station
+  thread, and run an endless loop that writes their weather data and renders
+  the graphs of all stations. '''
   if config["files"]["path"].startswith("~"):
     path = os.path.expanduser(config["files"]["path"])
   else:
     path = os.path.abspath(config["files"]["path"])
   if not os.path.exists(path):
     raise Exception('Destination path \'%s\' does not exist.' % path)
-  prefix = config["files"]["prefix"]
-  print "Writing sensor data to files '%s/%s*'" % (path, prefix)
-  humidrrd = "%s_humid.rrd" % prefix
-  temprrd = "%s_temp.rrd" % prefix
-
-  oldtime = None
-  # Initialize the WeatherDuino!
-  arduino = GetWeatherDevice(config["device"]["port"], config["device"]["baud"])
-  # clear any potential junk from the buffer
-  arduino.readline()
-
-  # Make an empty list with NUM devices (where NUM is in config).
-  # In theses lists, probe is position + 1 (e.g. temps[0] is probe 1).
-  temps = [ None ] * int(config['device']['num'])
-  hums = [ None ] * int(config['device']['num'])
-  while True:
-    try:
-      data = json.loads(arduino.readline().strip())["WeatherDuino"]
-    except serial.serialutil.SerialException, err:
-      print "[%s] Error: %s" % (time.ctime(), err)
-      sys.exit(1)
-      pass
-    # Only process the data once per 5 minutes but keep reading the buffer. This
-    # constant reading is required because otherwise the serial device times out
-    for items in data:
-      try:
-        if items['probe'] <= int(config['device']['num']):
-          # Probes are numberd 1 through 4, need to adjust to match the list!
-          pos = items['probe'] - 1
-          temps[pos] = items['temp']
-          hums[pos] = items['humid']
-          print "[%s] Probe %s: T%s H%s;" % (time.ctime(), items['probe'],
-                                             temps[pos], hums[pos])
-        else:
-          print "Ignoring unconfigured probe with ID '%s'" % items['probe']
-      except KeyError, err:
-        print "Ignoring invalid key %s" % err
-        pass
-
-    # Ignore the probes on the ignore list. Set them to "U" which means Unknown
-    # in the RRDtool specifications.
-    if config["misc"]["ignore"]:
-      ignores = config["misc"]["ignore"].upper().split(',')
-      for sens in ignores:
-        if sens[0] == "T":
-          temps[int(sens[1]) - 1] = "U"
-        elif sens[0] == "H":
-          hums[int(sens[1]) - 1] = "U"
-
-    # Update RRDfile regardless of the graphs/time
-    UpdateRRDfile(path, temprrd, temps)
-    UpdateRRDfile(path, humidrrd, hums)
-
-    # every 5 minutes, generate graphs:
-    newtime = int(time.strftime('%M'))
-    if not newtime == oldtime and newtime % 5 == 0:
-      oldtime = newtime
-      ProcessRRDdata(path, temprrd, prefix, "temp", u"\u00B0C".encode('utf8'))
-      ProcessRRDdata(path, humidrrd, prefix, "humid", u"%".encode('utf8'))
+
+  # Render the graphs in the background so reading the serial port is never
+  # held up by rrdtool, by default with a process per core. With 0 renderers
+  # the graphs are rendered inline.
+  misc = config.get("misc", {})
+  renderers = misc.get("renderers")
+  if renderers is None:
+    renderers = multiprocessing.cpu_count()
+  renderers = int(renderers)
+  pool = None
+  if renderers:
+    pool = multiprocessing.Pool(renderers, IgnoreInterrupt)
+
+  rrdconfig = config.get("rrd", {})
+  writer = RRDWriter(int(rrdconfig.get("batch", 30)),
+                     float(rrdconfig.get("interval", 60)),
+                     rrdconfig.get("daemon") or None)
+  # Keep the recent readings of all stations in memory and serve them as JSON.
+  recentconfig = config.get("recent", {})
+  recent = server = None
+  if recentconfig.get("address"):
+    recent = wdrecent.RecentReadings(
+        wdrecent.Slots(float(recentconfig.get("hours", 1)),
+                       float(recentconfig.get("interval", 2))),
+        int(recentconfig.get("series", 256)))
+    server = wdmetrics.MetricsServer(
+        None, wdmetrics.ParseAddress(recentconfig["address"]),
+        wdrecent.Routes(recent))
+    print "Serving recent readings on http://%s:%d/latest (%.1f MB)" % (
+        server.server_address + (recent.Memory() / 1048576.0,))
+  # Downsample and/or deadband the readings before they are written.
+  reduceconfig = config.get("reduce", {})
+  if Reducers(reduceconfig):
+    print "Reducing readings: window %ss, deadband %s" % (
+        reduceconfig.get("window") or 0, reduceconfig.get("deadband"))
+    if (float(reduceconfig.get("window") or 0) +
+        float(reduceconfig.get("heartbeat") or 300) >= HEARTBEAT):
+      print "WARNING: window and heartbeat add up to %d seconds or more, " \
+            "the RRD files will have unknown gaps." % HEARTBEAT
+  stations = [Station(station, path, writer, recent, Reducers(reduceconfig))
+              for station in StationConfigs(config)]
+  # The graphs of all stations are rendered spread over every 5 minutes.
+  scheduler = RenderScheduler(writer, pool, renderers,
+                              budget=float(misc.get("renderbudget", 0.5)))
+  for station in stations:
+    imgname = os.path.abspath("%s/%s" % (path, station.prefix))
+    scheduler.Add(station.temppath, imgname + "_temp", "temp",
+                  u"\u00B0C".encode('utf8'))
+    scheduler.Add(station.humidpath, imgname + "_humid", "humid",
+                  u"%".encode('utf8'))
+    station.start()
+
+  # Make a supervisor's SIGTERM unwind like ^C so pending samples are written.
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+  try:
+    while any(station.is_alive() for station in stations):
+      time.sleep(1)
+      writer.Tick()
+      scheduler.Tick()
+    print "[%s] All WeatherDuinos stopped, exiting." % time.ctime()
+    sys.exit(1)
+  finally:
+    for station in stations:
+      station.Flush()
+    writer.Flush()
+    if server:
+      server.Close()
 
 
 if __name__ == '__main__':
@@ -249,6 +854,44 @@ if __name__ == '__main__':
                     help="Ignore Probe/Sensor. E.g. 'T1,H2' to ignore Probe 1 Temperature and Probe 2 Humidity")
   parser.add_option("-x", "--prefix", metavar="PREFIX", default="WeatherDuino",
                     help="Filename prefix for the RRD files.")
+  parser.add_option("--batch", metavar="NUM", default=30, type="int",
+                    help="Samples written per rrdtool update.")
+  parser.add_option("--interval", metavar="SECONDS", default=60, type="float",
+                    help="Max seconds samples wait before being written.")
+  parser.add_option("--daemon", metavar="ADDRESS", default=None,
+                    help="rrdcached address, e.g. unix:/var/run/rrdcached.sock")
+  parser.add_option("-r", "--renderers", metavar="NUM", default=None,
+                    type="int", help="Processes rendering graphs, 0 renders "
+                    "inline (default: one per core).")
+  parser.add_option("--renderbudget", metavar="FRACTION", default=0.5,
+                    type="float", help="Share of the renderers' CPU time "
+                    "graphs may use.")
+  parser.add_option("--capture", metavar="FILE", default=None,
+                    help="Record the serial output to FILE, for wdreplay.py")
+  parser.add_option("--reducewindow", metavar="SECONDS", default=0,
+                    type="float", help="Seconds over which the readings are "
+                    "aggregated into one sample (0 writes every reading).")
+  parser.add_option("--reduce", metavar="AGGREGATE", default="avg",
+                    choices=["avg", "min", "max", "last"],
+                    help="Aggregate written per window: avg, min, max or last.")
+  parser.add_option("--deadband", metavar="DEGREES", default=None,
+                    type="float", help="Only write a sample when a "
+                    "temperature moved more than this since the last one.")
+  parser.add_option("--humiditydeadband", metavar="PERCENT", default=0,
+                    type="float", help="Humidity deadband, 0 only leaves out "
+                    "unchanged humidities.")
+  parser.add_option("--heartbeat", metavar="SECONDS", default=300,
+                    type="float", help="Seconds after which a sample is "
+                    "written even within the deadband.")
+  parser.add_option("--recent", metavar="ADDRESS", default=None,
+                    help="[host:]port to serve the recent readings on as JSON.")
+  parser.add_option("--recenthours", metavar="HOURS", default=1, type="float",
+                    help="Hours of readings kept per probe.")
+  parser.add_option("--recentinterval", metavar="SECONDS", default=2,
+                    type="float", help="Seconds between the readings of a "
+                    "probe, faster probes are kept for less time.")
+  parser.add_option("--recentseries", metavar="NUM", default=256, type="int",
+                    help="Probes the recent readings are kept for.")
   (opts, args) = parser.parse_args()
   try:
     print "%s: Unrecognized argument \'%s\'" % (sys.argv[0], args[0])
@@ -259,10 +902,25 @@ if __name__ == '__main__':
 # store the received options in config dictionary
   config = { "device": { "port": opts.device,
                          "baud": opts.baud,
-                         "num": opts.num },
+                         "num": opts.num,
+                         "capture": opts.capture },
              "files": { "path": opts.path,
                         "prefix": opts.prefix },
-             "misc": { "ignore" : opts.ignore } }
+             "misc": { "ignore" : opts.ignore,
+                       "renderers": opts.renderers,
+                       "renderbudget": opts.renderbudget },
+             "rrd": { "batch": opts.batch,
+                      "interval": opts.interval,
+                      "daemon": opts.daemon },
+             "recent": { "address": opts.recent,
+                         "hours": opts.recenthours,
+                         "interval": opts.recentinterval,
+                         "series": opts.recentseries },
+             "reduce": { "window": opts.reducewindow,
+                         "aggregate": opts.reduce,
+                         "deadband": opts.deadband,
+                         "humiditydeadband": opts.humiditydeadband,
+                         "heartbeat": opts.heartbeat } }
 # Check for config file and overwrite the config using this file.
   if opts.conf:
     # Some basic path expansion
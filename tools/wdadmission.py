@@ -0,0 +1,131 @@
+#!/usr/bin/python2.7
+# -*- coding: utf8 -*-
+""" Per device admission control for the WeatherDuino listener.
+
+The admission stage looks at the raw datagrams before they are decoded and
+rejects:
+* duplicates, the same payload from a device again within a short window,
+  e.g. a broadcast that reached the listener over two paths
+* packets of a device that exceeds its token bucket rate, e.g. a misbehaving
+  or spoofed sender flooding the listening port
+* protocol version 3 packets whose sequence number was already seen
+
+Protocol version 3 packets carry a uint16 sequence number after the header,
+gaps in the sequence numbers of a device are counted as lost packets. Version
+1 and 2 packets are only deduplicated and rate limited."""
+__author__ = 'Jan KLopper (jan@underdark.nl)'
+__version__ = 0.1
+
+import struct
+
+# The first header byte of every WeatherDuino packet (udplistener.MAGIC).
+MAGIC = chr(101)
+# The uint16 sequence number of a protocol version 3 packet and its offset.
+SEQUENCE = struct.Struct('<H')
+SEQUENCEOFFSET = 6
+# A sequence number at most REORDERWINDOW behind the last one is a duplicate,
+# a late packet or a replay, unless it is 0 or (after a pause longer than the
+# deduplication window) at most REORDERWINDOW: a device that restarted and
+# counts from 0 again. A jump of more than MAXGAP either way is also taken as
+# a restarted device rather than as lost packets.
+REORDERWINDOW = 64
+MAXGAP = 4096
+# Seconds after which the state of a silent device may be dropped, and the
+# minimum time between two passes over a full device table.
+IDLE = 300
+EXPIREINTERVAL = 1.0
+# Rejection reasons and the lost packet count, the indexes of Admission.counts.
+REASONS = ('duplicate', 'replayed', 'ratelimited', 'overflow')
+COUNTS = REASONS + ('lost',)
+DUPLICATE, REPLAYED, RATELIMITED, OVERFLOW, LOST = range(len(COUNTS))
+
+
+class Admission(object):
+  """Decides per datagram whether it goes on to the decoder.
+
+  The state of a device is a single list of its last payload, the time of its
+  last (non duplicate) packet, its tokens and its last sequence number, kept
+  in a dict on the 3 byte device id. At most `maxdevices` devices are tracked:
+  when the table is full, devices silent for IDLE seconds are dropped, and if
+  that frees nothing, packets of new devices are rejected as overflow, so a
+  flood of spoofed device ids can not push out the known devices.
+
+  A `window` or `rate` of 0 disables deduplication or rate limiting. A shared
+  admission keeps its counts in shared memory for a forked worker process;
+  every process needs its own, as updates are not locked."""
+
+  def __init__(self, window=0.5, rate=5.0, burst=20, maxdevices=4096,
+               shared=False):
+    self.window = window
+    self.rate = rate
+    self.burst = burst
+    self.maxdevices = maxdevices
+    self.idle = max(IDLE, window, float(burst) / rate if rate else 0)
+    self.devices = {}
+    self.expired = 0
+    if shared:
+      import multiprocessing
+      self.counts = multiprocessing.RawArray('L', len(COUNTS))
+    else:
+      self.counts = [0] * len(COUNTS)
+
+  def Admit(self, data, now):
+    """Returns whether the datagram `data`, received at `now`, should be
+    decoded. Anything that is not a WeatherDuino packet is left to the
+    decoder to reject."""
+    if len(data) < SEQUENCEOFFSET or data[0] != MAGIC:
+      return True
+    sequence = None
+    if data[1] == '\x03' and len(data) >= SEQUENCEOFFSET + SEQUENCE.size:
+      sequence = SEQUENCE.unpack_from(data, SEQUENCEOFFSET)[0]
+    key = data[2:5]
+    state = self.devices.get(key)
+    if state is None:
+      if len(self.devices) >= self.maxdevices and not self.Expire(now):
+        self.counts[OVERFLOW] += 1
+        return False
+      self.devices[key] = [data, now, self.burst - 1, sequence]
+      return True
+    payload, updated, tokens, last = state
+    if data == payload and now - updated < self.window:
+      self.counts[DUPLICATE] += 1
+      return False
+    if sequence is not None and last is not None:
+      behind = (last - sequence) & 0xffff
+      if behind < REORDERWINDOW:
+        if sequence and (sequence > REORDERWINDOW or
+                         now - updated <= self.window):
+          self.counts[REPLAYED] += 1
+          return False
+      else:
+        ahead = 0x10000 - behind
+        if ahead <= MAXGAP:
+          self.counts[LOST] += ahead - 1
+    admitted = True
+    if self.rate:
+      tokens = min(self.burst, tokens + (now - updated) * self.rate)
+      if tokens < 1:
+        self.counts[RATELIMITED] += 1
+        admitted = False
+      else:
+        tokens -= 1
+    state[0] = data
+    state[1] = now
+    state[2] = tokens
+    state[3] = sequence
+    return admitted
+
+  def Expire(self, now):
+    """Drops the devices that were silent for longer than the idle time, at
+    most once every EXPIREINTERVAL seconds. Returns whether there is room for
+    a new device."""
+    if now - self.expired >= EXPIREINTERVAL:
+      self.expired = now
+      for key, state in self.devices.items():
+        if now - state[1] > self.idle:
+          del self.devices[key]
+    return len(self.devices) < self.maxdevices
+
+  def Count(self, name):
+    """Returns the count of a rejection reason or of 'lost'."""
+    return self.counts[COUNTS.index(name)]
@@ -0,0 +1,307 @@
+#!/usr/bin/python2.7
+# -*- coding: utf8 -*-
+""" Bulk loads historical WeatherDuino measurements into RRD files or Carbon.
+
+Measurements are streamed from a sqlite database or a text log written by
+udplistener, or from a capture file of raw datagrams, and written with their
+original timestamps: to RRD files in the layout of wd2rrd (PREFIX_temp.rrd and
+PREFIX_humid.rrd per station, many samples per rrdtool.update), and/or to
+Carbon in large pickle batches.
+
+Memory use does not depend on the size of the input. The sources are read one
+record at a time and only the sample being assembled is kept per station."""
+__author__ = 'Jan KLopper (jan@underdark.nl)'
+__version__ = 0.1
+
+import argparse
+import os
+import re
+import sqlite3
+import time
+import udplistener
+import wdcapture
+import wdcarbon
+import wdsqlite
+
+# A measurement in the udplistener text log. The log only has the time of day;
+# temperatures are written as their whole degrees (rounded down) and
+# hundredths, e.g. -6.25 as '-7.75'.
+LOGLINE = re.compile(r'Device: ([0-9a-f]+:[0-9a-f]+:[0-9a-f]+)\t'
+                     r'(\d\d):(\d\d):(\d\d)\tSensor (\d+):'
+                     r'(?:\ttemp: (-?\d+)\.(\d\d))?[^\t]*'
+                     r'(?:\thumidity: (\d+)%)?')
+# A time of day that goes back more than this starts the next day.
+ROLLOVER = 43200
+# Records between two progress reports.
+PROGRESS = 100000
+
+
+def SourceType(filename):
+  """Returns 'capture', 'sqlite' or 'log' for a source file."""
+  with open(filename, 'rb') as source:
+    header = source.read(16)
+  if header.startswith(wdcapture.MAGIC):
+    return 'capture'
+  if header.startswith('SQLite format 3'):
+    return 'sqlite'
+  return 'log'
+
+
+def SQLiteRecords(filename, start=0, end=None):
+  """Yields the (date, device, sensor, temp, humidity) rows of a udplistener
+  database in date order, without migrating it. Unknown values are None."""
+  connection = sqlite3.connect(filename)
+  try:
+    version = connection.execute('PRAGMA user_version').fetchone()[0]
+    rows = connection.execute(
+        'SELECT date, device, sensor, temp, humidity FROM sensors '
+        'WHERE date BETWEEN ? AND ? ORDER BY date',
+        (start, end if end is not None else 2 ** 63 - 1))
+    if version:
+      for row in rows:
+        yield row
+      return
+    # The original schema, see wdsqlite.Migrate.
+    for date, device, sensor, temp, humidity in rows:
+      yield (int(date), wdsqlite.LegacyDeviceName(device), int(sensor),
+             wdsqlite.LegacyTemp(temp) if temp is not None and temp < 129
+             else None,
+             int(humidity) if humidity is not None and humidity < 255
+             else None)
+  finally:
+    connection.close()
+
+
+def LogDays(filename):
+  """Returns the number of day changes in a text log."""
+  days = 0
+  previous = None
+  with open(filename) as logfile:
+    for line in logfile:
+      match = LOGLINE.match(line)
+      if not match:
+        continue
+      hour, minute, second = match.group(2, 3, 4)
+      seconds = int(hour) * 3600 + int(minute) * 60 + int(second)
+      if previous is not None and seconds < previous - ROLLOVER:
+        days += 1
+      previous = seconds
+  return days
+
+
+def LogRecords(filename, date=None):
+  """Yields the measurements in a udplistener text log. `date` (YYYY-MM-DD)
+  is the day of the first measurement; by default the log is taken to end
+  on the day it was last modified. Times are local time."""
+  if date:
+    day = time.strptime(date, '%Y-%m-%d')[:3]
+  else:
+    last = time.localtime(os.path.getmtime(filename))
+    day = time.localtime(time.mktime(
+        (last[0], last[1], last[2] - LogDays(filename), 12, 0, 0, 0, 0, -1)))
+    day = day[:3]
+  previous = None
+  with open(filename) as logfile:
+    for line in logfile:
+      match = LOGLINE.match(line)
+      if not match:
+        continue
+      (device, hour, minute, second, sensor, whole, hundredths,
+       humidity) = match.groups()
+      hour, minute, second = int(hour), int(minute), int(second)
+      seconds = hour * 3600 + minute * 60 + second
+      if previous is not None and seconds < previous - ROLLOVER:
+        day = time.localtime(time.mktime(
+            (day[0], day[1], day[2] + 1, 12, 0, 0, 0, 0, -1)))[:3]
+      previous = seconds
+      yield (int(time.mktime(day + (hour, minute, second, 0, 0, -1))),
+             device, int(sensor),
+             int(whole) + int(hundredths) / 100.0 if whole else None,
+             int(humidity) if humidity else None)
+
+
+def CaptureRecords(filename):
+  """Yields the measurements in the datagrams of a capture file."""
+  for timestamp, _kind, data in wdcapture.Read(filename, wdcapture.DATAGRAM):
+    packet = udplistener.Decode(data)
+    if not packet:
+      continue
+    device, temps, humidities = packet
+    device = wdsqlite.DeviceName(device)
+    for sensor in xrange(len(temps)):
+      temp = temps[sensor]
+      humidity = humidities[sensor]
+      if temp[0] < 129 or humidity < 255:
+        yield (int(timestamp), device, sensor,
+               temp[0] + temp[1] / 100.0 if temp[0] < 129 else None,
+               humidity if humidity < 255 else None)
+
+
+class RRDTarget(object):
+  """Writes measurements to the RRD files of wd2rrd. The measurements of a
+  station with the same timestamp make up one sample; sensor N is probe
+  P<N+1>. A new file gets a data source per probe of its first sample (at
+  least four), values beyond the data sources of an existing file are left
+  out with a warning (see wd2rrd.RRDWriter). Samples older than the last
+  update of an existing file are dropped."""
+
+  def __init__(self, path, prefix, batch=1000):
+    import wd2rrd
+    self.path = path
+    self.prefix = prefix
+    self.writer = wd2rrd.RRDWriter(batch)
+    # device -> [timestamp, temps, hums] of the sample being assembled.
+    self.samples = {}
+    self.files = {}
+    self.written = 0
+    self.dropped = 0
+
+  def Add(self, timestamp, device, sensor, temp, humidity):
+    sample = self.samples.get(device)
+    if sample is None or sample[0] != timestamp:
+      if sample is not None:
+        self.Write(device, sample)
+      sample = self.samples[device] = [timestamp, [], []]
+    if sensor >= len(sample[1]):
+      missing = sensor + 1 - len(sample[1])
+      sample[1].extend([None] * missing)
+      sample[2].extend([None] * missing)
+    sample[1][sensor] = temp
+    sample[2][sensor] = humidity
+
+  def Write(self, device, sample):
+    files = self.files.get(device)
+    if files is None:
+      prefix = os.path.join(self.path,
+                            self.prefix % device.replace(':', '-'))
+      files = self.files[device] = (prefix + '_temp.rrd',
+                                    prefix + '_humid.rrd')
+    timestamp, temps, hums = sample
+    for rrdfile, values in zip(files, (temps, hums)):
+      if self.writer.Add(rrdfile, values, timestamp):
+        self.written += 1
+      else:
+        self.dropped += 1
+
+  def Close(self):
+    for device, sample in self.samples.items():
+      self.Write(device, sample)
+    self.samples = {}
+    self.writer.Flush()
+
+  def Stats(self):
+    return 'RRD: %d samples written, %d older than their file dropped' % (
+        self.written, self.dropped)
+
+
+class CarbonTarget(object):
+  """Sends measurements to Carbon in batches, with the metric paths of the
+  listener's CarbonSink. While Carbon is unreachable the backfill waits,
+  rather than letting the client drop batches."""
+
+  def __init__(self, server, port, batch=5000, sensors=None):
+    self.client = wdcarbon.CarbonClient(server, port, batch, backlog=batch)
+    # A udplistener.SensorResolver, by default without any sensor names.
+    self.sensors = sensors or udplistener.SensorResolver(())
+    self.paths = {}
+
+  def Add(self, timestamp, device, sensor, temp, humidity):
+    paths = self.paths.get((device, sensor))
+    if paths is None:
+      paths = self.paths[device, sensor] = self.sensors.Sensor(
+          device, sensor)
+    if temp is not None:
+      self.client.Add(paths[1], timestamp, temp)
+    if humidity is not None:
+      self.client.Add(paths[2], timestamp, humidity)
+    if self.client.backlogsize:
+      self.Wait()
+
+  def Wait(self):
+    """Retries sending the backlog until Carbon took it."""
+    print 'Waiting for carbon server %s:%d' % self.client.address
+    while not self.client.Send():
+      time.sleep(max(0, self.client.retryat - time.time()))
+
+  def Close(self):
+    self.client.Flush()
+    if self.client.backlogsize:
+      self.Wait()
+    self.client.Close()
+
+  def Stats(self):
+    return 'Carbon: %(datapoints)d datapoints in %(batches)d batches' % (
+        self.client.Stats())
+
+
+def main():
+  """Streams the records of the source into the targets and reports the
+  throughput."""
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('source', help='udplistener sqlite database, text log '
+                      'or capture file (detected from its contents)')
+  parser.add_argument('-r', '--rrd', help='Directory for the RRD files')
+  parser.add_argument('-x', '--prefix', default='WeatherDuino-%s',
+                      help='RRD file prefix, %%s is the station id '
+                      '(default: %(default)s)')
+  parser.add_argument('-b', '--batch', type=int, default=1000,
+                      help='Samples per rrdtool update')
+  parser.add_argument('-c', '--carbon',
+                      help='Carbon server (host:port of the pickle receiver)')
+  parser.add_argument('--carbonbatch', type=int, default=5000,
+                      help='Datapoints per carbon batch')
+  parser.add_argument('-s', '--start', type=int, default=0,
+                      help='First timestamp to load')
+  parser.add_argument('-e', '--end', type=int, default=None,
+                      help='Last timestamp to load')
+  parser.add_argument('-d', '--logdate',
+                      help='Date (YYYY-MM-DD) of the first line of a text '
+                      'log (default: the log ends on its modification date)')
+  options = parser.parse_args()
+  if not options.rrd and not options.carbon:
+    parser.error('Give an RRD directory (--rrd) and/or a carbon server '
+                 '(--carbon)')
+
+  targets = []
+  if options.rrd:
+    if not os.path.isdir(options.rrd):
+      os.makedirs(options.rrd)
+    targets.append(RRDTarget(options.rrd, options.prefix, options.batch))
+  if options.carbon:
+    server, port = options.carbon.split(':')
+    targets.append(CarbonTarget(server, port, options.carbonbatch,
+                                udplistener.SensorResolver()))
+
+  sourcetype = SourceType(options.source)
+  if sourcetype == 'sqlite':
+    records = SQLiteRecords(options.source, options.start, options.end)
+  elif sourcetype == 'capture':
+    records = CaptureRecords(options.source)
+  else:
+    records = LogRecords(options.source, options.logdate)
+  print 'Loading %s %s' % (sourcetype, options.source)
+
+  start = time.time()
+  count = 0
+  try:
+    for record in records:
+      if record[0] < options.start or (
+          options.end is not None and record[0] > options.end):
+        continue
+      for target in targets:
+        target.Add(*record)
+      count += 1
+      if not count % PROGRESS:
+        print '%d records, up to %s: %.0f records/s' % (
+            count, time.ctime(record[0]), count / (time.time() - start))
+  finally:
+    for target in targets:
+      target.Close()
+  elapsed = time.time() - start
+  print '%d records in %.1fs: %.0f records/s' % (
+      count, elapsed, count / max(elapsed, 1e-6))
+  for target in targets:
+    print target.Stats()
+
+if __name__ == '__main__':
+  main()
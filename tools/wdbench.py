@@ -0,0 +1,1599 @@
+#!/usr/bin/python2.7
+# -*- coding: utf8 -*-
+""" Benchmarks for the WeatherDuino tools.
+
+Every benchmark is a subcommand, run 'python wdbench.py --help' for a list.
+The benchmarks do not need any WeatherDuino hardware, they generate their own
+synthetic measurements."""
+__author__ = 'Jan KLopper (jan@underdark.nl)'
+__version__ = 0.1
+
+import argparse
+import math
+import multiprocessing
+import os
+import pickle
+import random
+import shutil
+import signal
+import socket
+import SocketServer
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+
+def Report(name, count, elapsed, unit='rows'):
+  """Prints a single benchmark result line"""
+  print '%-24s %8d %s in %7.3fs: %10.1f %s/s' % (
+      name, count, unit, elapsed, count / elapsed, unit)
+
+
+def SyntheticRows(count, devices=300, sensors=4, interval=1):
+  """Returns `count` sensor rows as the original listener stored them, every
+  sensor of every device reporting once per `interval` seconds"""
+  rows = []
+  start = int(time.time()) - count // (devices * sensors) * interval
+  for i in xrange(count):
+    device = (i // sensors % devices) >> 8, (i // sensors % devices) & 0xff, 1
+    rows.append((start + i // (devices * sensors) * interval, str(device),
+                 i % sensors, round(random.uniform(-10, 30), 2),
+                 random.randint(20, 90)))
+  return rows
+
+
+def SyntheticPacket(probecount, version=2, device=(1, 2, 3), sequence=0):
+  """Returns a WeatherDuino UDP packet with random probe readings"""
+  packet = [struct.pack('<6B', 101, version, device[0], device[1], device[2],
+                        probecount)]
+  if version == 3:
+    packet.append(struct.pack('<H', sequence & 0xffff))
+  for _probe in xrange(probecount):
+    if version == 1:
+      packet.append(struct.pack('<3B', random.randint(0, 40),
+                                random.randint(0, 99), random.randint(0, 100)))
+    else:
+      packet.append(struct.pack('<fB', random.uniform(-20, 40),
+                                random.randint(0, 100)))
+  return ''.join(packet)
+
+
+def ListenerOptions(**kwargs):
+  """Returns listener options for a listener on a random free port"""
+  options = argparse.Namespace(port=0, verbose=False, filter=None, workers=1,
+                               queuesize=1024, sinkqueue=1024, metrics=None,
+                               metricsinterval=60, lastseenage=7 * 86400,
+                               carbon=None, dedupwindow=0, ratelimit=0,
+                               burst=20,
+                               maxdevices=0)
+  for key, value in kwargs.items():
+    setattr(options, key, value)
+  return options
+
+
+def LegacyParsePacket(data):
+  """The original per-byte WeatherDuinoListener.ParsePacket generator"""
+  magic = ord(data[0])
+  version = ord(data[1])
+  if magic == 101 and version in (1, 2):
+    device = (ord(data[2]), ord(data[3]), ord(data[4]))
+    probecount = ord(data[5])
+    offset = 6
+    if version == 1:
+      fragmentsize = 3
+      for sensor in range(0, probecount):
+        sensoroffet = (sensor*fragmentsize)+offset
+        humidity = ord(data[sensoroffet+2])
+        temp = (ord(data[sensoroffet]),
+                ord(data[sensoroffet+1]))
+        yield (device, sensor, temp, humidity)
+    elif version == 2:
+      fragmentsize = 5
+      for sensor in xrange(0, probecount):
+        sensoroffet = (sensor*fragmentsize)+offset
+        humidity = ord(data[sensoroffet+4])
+        rawtemp = data[sensoroffet:sensoroffet+4]
+        temp = struct.unpack('<f', rawtemp)[0]
+        temp = (int(math.floor(temp)), int((temp - math.floor(temp))*100))
+        yield (device, sensor, temp, humidity)
+
+
+def BenchDecode(options):
+  """Compares the original ParsePacket generator with DecodePacket"""
+  import udplistener
+  listener = udplistener.WeatherDuinoListener(ListenerOptions(), [])
+  for version in (1, 2):
+    print 'Protocol version %d:' % version
+    for probecount in options.probes:
+      packets = [SyntheticPacket(probecount, version)
+                 for _i in xrange(options.packets)]
+      for packet in packets:
+        if (list(LegacyParsePacket(packet)) !=
+            list(listener.ParsePacket(packet))):
+          raise AssertionError('Decoders disagree on %r' % packet)
+      # The best of several runs, a single one is mostly scheduling noise.
+      elapsed = []
+      for _run in xrange(options.runs):
+        start = time.time()
+        for packet in packets:
+          for _measurement in LegacyParsePacket(packet):
+            pass
+        elapsed.append(time.time() - start)
+      Report('legacy %3d probes' % probecount, len(packets), min(elapsed),
+             'packets')
+      elapsed = []
+      for _run in xrange(options.runs):
+        start = time.time()
+        for packet in packets:
+          listener.DecodePacket(packet)
+        elapsed.append(time.time() - start)
+      Report('columnar %3d probes' % probecount, len(packets), min(elapsed),
+             'packets')
+  listener.Close()
+
+
+def RunCountingListener(options, counter, delay, cpu=None):
+  """Runs a listener with a sink that only counts the packets it stores. The
+  CPU seconds used by the listener and its workers are stored in `cpu`"""
+  import resource
+  import udplistener
+
+  class CountingSink(udplistener.Sink):
+    name = 'counting'
+
+    def StorePacket(self, timestamp, device, temps, humidities):
+      counter.value += 1
+      if delay:
+        time.sleep(delay)
+
+  listener = udplistener.WeatherDuinoListener(options, [CountingSink(options)])
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+  try:
+    listener.Run()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    listener.Close()
+    if cpu is not None:
+      cpu.value = sum(usage.ru_utime + usage.ru_stime for usage in (
+          resource.getrusage(resource.RUSAGE_SELF),
+          resource.getrusage(resource.RUSAGE_CHILDREN)))
+
+
+def SendPackets(job):
+  """Sends the packets round robin to the port on loopback for `duration`
+  seconds, as fast as possible or at `rate` packets per second, and returns
+  how many were sent"""
+  port, packets, duration, rate = job
+  udpsock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  sent = 0
+  start = time.time()
+  deadline = start + duration
+  while time.time() < deadline:
+    for packet in packets:
+      udpsock.sendto(packet, ('127.0.0.1', port))
+    sent += len(packets)
+    if rate:
+      time.sleep(max(0, start + float(sent) / rate - time.time()))
+  udpsock.close()
+  return sent
+
+
+def BenchIngest(options):
+  """Replays synthetic v2 packets over loopback at the listener, comparing
+  the single threaded Run loop with the SO_REUSEPORT worker mode, and
+  optionally the cost of the metrics"""
+  packets = [SyntheticPacket(options.probes, device=(0, device >> 8, device))
+             for device in xrange(256)]
+  for workers in [1] + options.workers:
+    for metrics in ([None, '127.0.0.1:0'] if options.metrics else [None]):
+      counter = multiprocessing.Value('L', 0, lock=False)
+      cpu = multiprocessing.Value('d', 0, lock=False)
+      listener = multiprocessing.Process(
+          target=RunCountingListener,
+          args=(ListenerOptions(port=options.port, workers=workers,
+                                metrics=metrics),
+                counter, options.delay, cpu))
+      listener.start()
+      time.sleep(0.5)
+      senders = multiprocessing.Pool(options.senders)
+      start = time.time()
+      sent = sum(senders.map(SendPackets,
+                             [(options.port, packets, options.duration,
+                               options.rate)] * options.senders))
+      # Give the listener a moment to drain whatever is still queued.
+      time.sleep(0.5)
+      elapsed = time.time() - start
+      listener.terminate()
+      listener.join()
+      senders.close()
+      handled = counter.value
+      name = 'Run loop' if workers == 1 else '%d workers' % workers
+      if metrics:
+        name += ' + metrics'
+      print '%s: %d packets sent, %d handled (%.1f%% lost), %.1fus CPU ' \
+          'per packet' % (name, sent, handled, 100.0 * (sent - handled) / sent,
+                          cpu.value / max(handled, 1) * 1e6)
+      Report(name, handled, elapsed, 'packets')
+
+
+class CarbonHandler(SocketServer.StreamRequestHandler):
+  """Reads length prefixed pickles, like Carbon's pickle receiver"""
+  def handle(self):
+    self.server.connections.append(self.request)
+    while True:
+      header = self.rfile.read(4)
+      if len(header) < 4:
+        return
+      length = struct.unpack('!L', header)[0]
+      payload = self.rfile.read(length)
+      if len(payload) < length:
+        return
+      with self.server.lock:
+        self.server.datapoints.extend(pickle.loads(payload))
+
+
+class CarbonStandIn(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+  """A local stand-in for a Carbon server that keeps all datapoints"""
+  allow_reuse_address = True
+  daemon_threads = True
+
+  def __init__(self, port, datapoints):
+    SocketServer.TCPServer.__init__(self, ('127.0.0.1', port), CarbonHandler)
+    self.datapoints = datapoints
+    self.connections = []
+    self.lock = threading.Lock()
+    thread = threading.Thread(target=self.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+  def Stop(self):
+    """Stops the server and drops all open connections"""
+    self.shutdown()
+    self.server_close()
+    for connection in self.connections:
+      try:
+        connection.shutdown(socket.SHUT_RDWR)
+      except socket.error:
+        pass  # Already closed by the client.
+
+  def WaitFor(self, count, timeout=30):
+    """Waits until `count` datapoints were received"""
+    deadline = time.time() + timeout
+    while len(self.datapoints) < count and time.time() < deadline:
+      time.sleep(0.01)
+
+
+def BenchCarbon(options):
+  """Compares one pickle per measurement with the batching CarbonClient, and
+  checks that the client delivers everything across a carbon restart"""
+  import wdcarbon
+  now = int(time.time())
+  datapoints = [('weather.1:2:%x.%d.temp' % (i % 256, i % 4),
+                 (now + i // 1024, round(random.uniform(-10, 30), 2)))
+                for i in xrange(options.datapoints)]
+
+  # The original listener: a pickle and a send() for every datapoint.
+  received = []
+  server = CarbonStandIn(options.port, received)
+  carbonsocket = socket.create_connection(('127.0.0.1', options.port))
+  start = time.time()
+  for datapoint in datapoints:
+    payload = pickle.dumps([datapoint])
+    carbonsocket.sendall(struct.pack('!L', len(payload)) + payload)
+  server.WaitFor(len(datapoints))
+  Report('pickle per datapoint', len(received), time.time() - start,
+         'datapoints')
+  carbonsocket.close()
+  server.Stop()
+
+  received = []
+  server = CarbonStandIn(options.port, received)
+  client = wdcarbon.CarbonClient('127.0.0.1', options.port, options.batch)
+  start = time.time()
+  for path, (timestamp, value) in datapoints:
+    client.Add(path, timestamp, value)
+  client.Flush()
+  server.WaitFor(len(datapoints))
+  Report('batched (%d datapoints)' % options.batch, len(received),
+         time.time() - start, 'datapoints')
+  print 'Client statistics: %r' % client.Stats()
+  client.Close()
+  server.Stop()
+  if sorted(received) != sorted(datapoints):
+    raise AssertionError('Carbon received different datapoints than sent')
+
+  # Send half, take the server down, send the rest and bring it back.
+  received = []
+  server = CarbonStandIn(options.port, received)
+  client = wdcarbon.CarbonClient('127.0.0.1', options.port, options.batch)
+  half = len(datapoints) // 2
+  client.AddMany(datapoints[:half])
+  client.Flush()
+  server.WaitFor(half)
+  server.Stop()
+  client.AddMany(datapoints[half:])
+  client.Flush()
+  server = CarbonStandIn(options.port, received)
+  client.retryat = 0
+  client.Close()
+  server.WaitFor(len(datapoints))
+  server.Stop()
+  if sorted(received) != sorted(datapoints):
+    raise AssertionError('Carbon restart lost %d datapoints' % (
+        len(datapoints) - len(received)))
+  print 'Carbon restart: all %d datapoints delivered' % len(received)
+
+
+def LegacyRenders(timestamp):
+  """Returns the graphs the original ProcessRRDdata rendered at `timestamp`,
+  which was called every 5 minutes"""
+  now = time.localtime(timestamp)
+  deltas = []
+  if now.tm_min % 5 == 0:
+    deltas.append('day')
+  if now.tm_min in (5, 20, 35, 50):
+    deltas.append('week')
+  if now.tm_min == 55:
+    deltas.append('month')
+  if now.tm_hour in (0, 12):
+    deltas.append('year')
+  return deltas
+
+
+def BenchRender(options):
+  """Estimates the CPU seconds per hour spent rendering graphs by the original
+  minute based schedule and by the render cache"""
+  import resource
+  import rrdtool
+  import wd2rrd
+  workdir = tempfile.mkdtemp(prefix='wdbench')
+  try:
+    # A year of 5 minute samples, so every graph has data to draw.
+    rrdfile = os.path.join(workdir, 'bench_temp.rrd')
+    end = int(time.time()) // wd2rrd.STEP * wd2rrd.STEP
+    start = end - 365 * 86400
+    rrdtool.create(rrdfile, ['--start', str(start - 1)] + wd2rrd.DEFRRD)
+    samples = ['%d:%.2f:%.2f:%.2f:%.2f' % ((timestamp,) + tuple(
+        20 + 10 * math.sin(timestamp / 86400.0 + probe) for probe in xrange(4)))
+               for timestamp in xrange(start, end, wd2rrd.STEP)]
+    for offset in xrange(0, len(samples), 1000):
+      rrdtool.update(rrdfile, samples[offset:offset + 1000])
+
+    cost = {}
+    for delta in wd2rrd.TIMEDELTA:
+      imgfile = os.path.join(workdir, 'bench-%s.png' % delta)
+      before = resource.getrusage(resource.RUSAGE_SELF)
+      for _render in xrange(options.renders):
+        wd2rrd.RenderGraph(imgfile, delta, rrdfile, 'temp', 'C')
+      after = resource.getrusage(resource.RUSAGE_SELF)
+      cost[delta] = (after.ru_utime + after.ru_stime -
+                     before.ru_utime - before.ru_stime) / options.renders
+      print '%-5s graph: %.3f CPU seconds per render' % (delta, cost[delta])
+
+    # Replay a day of 5 minute ticks. Samples arrive continuously, so at every
+    # tick the last update of the RRD file is the tick itself.
+    legacy = dict.fromkeys(wd2rrd.TIMEDELTA, 0)
+    cached = dict.fromkeys(wd2rrd.TIMEDELTA, 0)
+    day = end - end % 86400
+    for tick in xrange(day, day + 86400, wd2rrd.STEP):
+      for delta in LegacyRenders(tick):
+        legacy[delta] += 1
+      for delta in wd2rrd.TIMEDELTA:
+        row = wd2rrd.NeedsRender(rrdfile, '/nonexistent', delta, tick)
+        if row is not None:
+          wd2rrd.RENDERED[rrdfile, delta] = row
+          cached[delta] += 1
+    # wd2rrd renders every graph for both the temperature and humidity file.
+    for name, renders in (('minute schedule', legacy),
+                          ('render cache', cached)):
+      print '%-16s %s: %.2f CPU seconds per hour' % (
+          name, ', '.join('%s %.2f/h' % (delta, renders[delta] / 24.0)
+                          for delta in sorted(renders)),
+          2 * sum(renders[delta] * cost[delta] for delta in renders) / 24)
+  finally:
+    shutil.rmtree(workdir)
+
+
+def BenchFleet(options):
+  """Renders the graphs of a fleet of stations through the wd2rrd render
+  scheduler, for every number of render processes. The scheduler runs in real
+  time with a short interval, every interval starts with a new sample"""
+  import rrdtool
+  import wd2rrd
+
+  class Scheduler(wd2rrd.RenderScheduler):
+    """Keeps the render timings instead of printing them"""
+    timings = []
+
+    def Rendered(self, graph, timing):
+      self.timings.append((graph.delta,) + tuple(timing))
+      self.used += timing[1] - graph.charged
+      graph.cpu = self.estimate = timing[1]
+
+  workdir = tempfile.mkdtemp(prefix='wdbench')
+  try:
+    # A week of 5 minute samples per station, the data to draw hardly matters
+    # for the render time.
+    end = int(time.time()) // wd2rrd.STEP * wd2rrd.STEP
+    start = end - 7 * 86400
+    defs = wd2rrd.RRDDefs(options.probes)
+    rrdfiles = []
+    for station in xrange(options.stations):
+      rrdfile = os.path.join(workdir, 'station%d_temp.rrd' % station)
+      rrdtool.create(rrdfile, ['--start', str(start - 1)] + defs)
+      samples = [('%d:' % timestamp) + ':'.join(
+          '%.2f' % (20 + 10 * math.sin(timestamp / 86400.0 + probe))
+          for probe in xrange(options.probes))
+                 for timestamp in xrange(start, end, wd2rrd.STEP)]
+      for offset in xrange(0, len(samples), 1000):
+        rrdtool.update(rrdfile, samples[offset:offset + 1000])
+      rrdfiles.append(rrdfile)
+    print '%d stations with %d probes, %d graphs, %ds intervals' % (
+        options.stations, options.probes,
+        options.stations * len(wd2rrd.TIMEDELTA), options.interval)
+
+    # The sample time, a render interval further for every interval.
+    sample = end
+    for renderers in options.renderers:
+      pool = None
+      if renderers:
+        pool = multiprocessing.Pool(renderers, wd2rrd.IgnoreInterrupt)
+      writer = wd2rrd.RRDWriter()
+      writer.known.update(rrdfiles)
+      writer.last.update(dict.fromkeys(rrdfiles, sample))
+      wd2rrd.RENDERED.clear()
+      scheduler = Scheduler(writer, pool, renderers, options.interval,
+                            options.budget)
+      for rrdfile in rrdfiles:
+        scheduler.Add(rrdfile, rrdfile[:-4], 'temp', 'C')
+      time.sleep(options.interval - time.time() % options.interval)
+      # The first interval renders every graph that fits, the next those with
+      # a new row and those deferred.
+      for label in ('first interval', 'next interval'):
+        sample += wd2rrd.STEP
+        for rrdfile in rrdfiles:
+          rrdtool.update(rrdfile, '%d:%s' % (
+              sample, ':'.join(['21.00'] * options.probes)))
+          writer.last[rrdfile] = sample
+        del Scheduler.timings[:]
+        boundary = (time.time() // options.interval + 1) * options.interval
+        while time.time() < boundary - 0.1:
+          scheduler.Tick()
+          time.sleep(0.1)
+        timings = Scheduler.timings
+        print '%d renderers, %s: %d graphs rendered, %.2f of %.1f CPU ' \
+            'seconds, %d deferred, %d still rendering' % (
+                renderers, label, len(timings), scheduler.used,
+                scheduler.budget, scheduler.deferred, scheduler.running)
+        for delta in sorted(wd2rrd.TIMEDELTA, key=wd2rrd.TIMESTEPS.get):
+          cpu = [timing[2] for timing in timings if timing[0] == delta]
+          if cpu:
+            print '  %-5s %4d renders, %.3f CPU seconds per render' % (
+                delta, len(cpu), sum(cpu) / len(cpu))
+        time.sleep(max(0, boundary - time.time()))
+      if pool:
+        pool.terminate()
+        pool.join()
+  finally:
+    shutil.rmtree(workdir)
+
+
+def SyntheticSerial(lines, probes=4, junk=0.01):
+  """Returns WeatherDuino serial output with `lines` lines, a fraction `junk`
+  of which is line noise or a reading that was cut off"""
+  output = []
+  for _line in xrange(lines):
+    readings = ','.join(
+        '{"probe":%d,"temp":%.2f,"humid":%.2f}' % (
+            probe, random.uniform(-10, 30), random.randint(20, 90))
+        for probe in xrange(1, probes + 1))
+    line = '{"WeatherDuino":[%s]}' % readings
+    if random.random() < junk:
+      line = line[:random.randint(1, len(line) - 1)]
+    output.append(line + '\r\n')
+  return ''.join(output)
+
+
+def LegacySerialLines(capture, num, ignore):
+  """The original wd2rrd loop body: json.loads and the ignore list split for
+  every line. Returns the readings and how many lines raised an error"""
+  import json
+  temps = [None] * num
+  hums = [None] * num
+  readings = []
+  errors = 0
+  for line in capture.splitlines(True):
+    try:
+      data = json.loads(line.strip())["WeatherDuino"]
+    except (ValueError, KeyError, TypeError):
+      errors += 1
+      continue
+    for items in data:
+      try:
+        if items['probe'] <= int(num):
+          pos = items['probe'] - 1
+          temps[pos] = items['temp']
+          hums[pos] = items['humid']
+      except KeyError:
+        pass
+    if ignore:
+      ignores = ignore.upper().split(',')
+      for sens in ignores:
+        if sens[0] == "T":
+          temps[int(sens[1]) - 1] = "U"
+        elif sens[0] == "H":
+          hums[int(sens[1]) - 1] = "U"
+    readings.append((list(temps), list(hums)))
+  return readings, errors
+
+
+def BenchSerial(options):
+  """Compares json.loads per serial line with the streaming SerialParser, on
+  serial captures or synthetic serial output"""
+  import wd2rrd
+  if options.captures:
+    capture = ''.join(open(filename, 'rb').read()
+                      for filename in options.captures)
+  else:
+    capture = SyntheticSerial(options.lines, options.probes, options.junk)
+  lines = capture.count('\n')
+  # Serial reads return whatever arrived, so feed the parser in small chunks.
+  chunks = [capture[offset:offset + options.chunk]
+            for offset in xrange(0, len(capture), options.chunk)]
+
+  legacy, errors = LegacySerialLines(capture, options.probes, options.ignore)
+  parser = wd2rrd.SerialParser(options.probes, options.ignore)
+  readings = []
+  for line in capture.splitlines():
+    if parser.ParseLine(line):
+      readings.append((list(parser.temps), list(parser.hums)))
+  print 'json.loads: %d readings, %d lines raised an error' % (
+      len(legacy), errors)
+  print 'SerialParser: %d readings, %d junk lines' % (
+      len(readings), parser.junk)
+  if readings != legacy:
+    raise AssertionError('SerialParser and json.loads disagree')
+
+  start = time.time()
+  LegacySerialLines(capture, options.probes, options.ignore)
+  Report('json.loads per line', lines, time.time() - start, 'lines')
+  parser = wd2rrd.SerialParser(options.probes, options.ignore)
+  start = time.time()
+  for chunk in chunks:
+    parser.Feed(chunk)
+  Report('SerialParser (%d bytes)' % options.chunk, lines, time.time() - start,
+         'lines')
+
+
+def BenchColumnar(options):
+  """Compares scanning the listener's text log with range queries on the
+  memory mapped columnar segments"""
+  import numpy
+  import wdcolumnar
+  wdcolumnar.ImportNumPy()
+  workdir = tempfile.mkdtemp(prefix='wdbench')
+  try:
+    end = int(time.time()) // 86400 * 86400
+    start = end - options.days * 86400
+    devices = [(0, device >> 8, device & 0xff)
+               for device in xrange(1, options.devices + 1)]
+    dates = numpy.arange(start, end, options.interval, dtype='u4')
+    records = numpy.zeros(len(dates) * len(devices) * 4, wdcolumnar.DTYPE)
+    records['date'] = numpy.repeat(dates, len(devices) * 4)
+    records['device'] = numpy.tile(numpy.repeat(
+        [wdcolumnar.DeviceId(device) for device in devices], 4), len(dates))
+    records['sensor'] = numpy.tile(numpy.arange(4, dtype='u1'),
+                                   len(dates) * len(devices))
+    records['temp'] = numpy.random.uniform(-10, 30, len(records))
+    records['humidity'] = numpy.random.randint(20, 90, len(records))
+    records.sort(order='date', kind='mergesort')
+    logname = os.path.join(workdir, 'weatherduino.log')
+    with open(logname, 'w') as logfile:
+      for date, deviceid, sensor, temp, humidity in records:
+        logfile.write('\nDevice: %s\t%s\tSensor %i:\ttemp: %.2f℃ - '
+                      '\thumidity: %d%%' % (
+                          wdcolumnar.DeviceName(deviceid),
+                          time.strftime('%H:%M:%S', time.localtime(date)),
+                          sensor, temp, humidity))
+    segments = os.path.join(workdir, 'segments')
+    os.mkdir(segments)
+    for day in xrange(start, end, 86400):
+      dayrecords = records[(records['date'] >= day) &
+                           (records['date'] < day + 86400)]
+      dayrecords.tofile(os.path.join(segments, wdcolumnar.SegmentName(day)))
+    print '%d records: %.1f MB of text log, %.1f MB of segments' % (
+        len(records), os.path.getsize(logname) / 1e6,
+        len(records) * wdcolumnar.RECORD.size / 1e6)
+
+    device = wdcolumnar.DeviceName(wdcolumnar.DeviceId(devices[-1]))
+    needle = 'Device: %s\t' % device
+    start_time = time.time()
+    found = 0
+    with open(logname) as logfile:
+      for line in logfile:
+        if line.startswith(needle):
+          found += 1
+    print '%-24s %8d records in %7.2fms' % (
+        'text log, one device', found, (time.time() - start_time) * 1000)
+
+    reader = wdcolumnar.ColumnarReader(segments)
+    found = sum(1 for _record in reader.Records(start, end, device))
+    start_time = time.time()
+    found = sum(1 for _record in reader.Records(start, end, device))
+    print '%-24s %8d records in %7.2fms' % (
+        'unpacked, one device', found, (time.time() - start_time) * 1000)
+    for name, query in (
+        ('one device, %d days' % options.days, (start, end, device)),
+        ('one device, 1 day', (end - 86400, end, device)),
+        ('all devices, 1 hour', (end - 3600, end - 1)),
+        ('all devices, %d days' % options.days, (start, end))):
+      reader.Query(*query)
+      start_time = time.time()
+      for _query in xrange(options.queries):
+        found = len(reader.Query(*query))
+      elapsed = (time.time() - start_time) / options.queries
+      print '%-24s %8d records in %7.2fms' % (name, found, elapsed * 1000)
+  finally:
+    shutil.rmtree(workdir)
+
+
+def BenchSQLite(options):
+  """Compares the per-row commit path with the BufferedSQLWriter, migrates a
+  database in the original schema and compares a day of one sensor from the
+  raw rows with a series from the rollups"""
+  import sqlite3
+  import wdsqlite
+  rows = SyntheticRows(options.rows)
+  workdir = tempfile.mkdtemp(prefix='wdbench')
+  try:
+    # The original listener: one cursor, one INSERT and one commit per row.
+    connection = sqlite3.connect(os.path.join(workdir, 'perrow.sqlite'))
+    connection.execute(
+        'CREATE TABLE sensors (date, device, sensor, temp, humidity)')
+    start = time.time()
+    for row in rows:
+      cursor = connection.cursor()
+      cursor.execute("INSERT INTO sensors VALUES (%d,'%s',%d,%f,%d)" % row)
+      connection.commit()
+    Report('per-row commit', len(rows), time.time() - start)
+    connection.close()
+
+    connection = wdsqlite.Connect(os.path.join(workdir, 'batched.sqlite'))
+    writer = wdsqlite.BufferedSQLWriter(connection, options.batch)
+    start = time.time()
+    for row in rows:
+      writer.Add((row[0], wdsqlite.LegacyDeviceName(row[1])) + row[2:])
+    writer.Close()
+    Report('batched (%d rows)' % options.batch, len(rows), time.time() - start)
+
+    # A month of history in the original schema, 5 minutes apart.
+    rows = SyntheticRows(options.history, options.devices, 4, 300)
+    filename = os.path.join(workdir, 'history.sqlite')
+    connection = sqlite3.connect(filename)
+    connection.execute(
+        'CREATE TABLE sensors (date, device, sensor, temp, humidity)')
+    connection.executemany('INSERT INTO sensors VALUES (?,?,?,?,?)', rows)
+    connection.commit()
+    end = rows[-1][0]
+    device = (0, 0, 1)
+    start = time.time()
+    raw = connection.execute(
+        'SELECT date, temp, humidity FROM sensors WHERE device = ? AND '
+        'sensor = 0 AND date BETWEEN ? AND ?',
+        (str(device), end - 86400, end)).fetchall()
+    print '%-24s %8d rows in %7.2fms' % (
+        'original, 1 day', len(raw), (time.time() - start) * 1000)
+    connection.close()
+
+    start = time.time()
+    connection = wdsqlite.Connect(filename)
+    Report('migration', len(rows), time.time() - start)
+    for name, begin in (('raw rows, 1 day', end - 86400),
+                        ('raw rows, 30 days', end - 30 * 86400)):
+      start = time.time()
+      raw = connection.execute(
+          'SELECT date, temp, humidity FROM sensors WHERE device = ? AND '
+          'sensor = 0 AND date BETWEEN ? AND ?',
+          (wdsqlite.DeviceName(device), begin, end)).fetchall()
+      print '%-24s %8d rows in %7.2fms' % (
+          name, len(raw), (time.time() - start) * 1000)
+    for name, begin in (('series, 1 day', end - 86400),
+                        ('series, 30 days', end - 30 * 86400),
+                        ('series, 1 year', end - 365 * 86400)):
+      start = time.time()
+      series = wdsqlite.Series(connection, device, 0, begin, end)
+      print '%-24s %8d points in %7.2fms' % (
+          name, len(series), (time.time() - start) * 1000)
+    connection.close()
+  finally:
+    shutil.rmtree(workdir)
+
+
+def BenchBackfill(options):
+  """Builds the same history as a sqlite database, a text log and a capture
+  file, and backfills each into RRD files and a Carbon stand-in, comparing
+  one rrdtool update per sample with batched updates"""
+  import udplistener
+  import wdbackfill
+  import wdcapture
+  import wdsqlite
+  workdir = tempfile.mkdtemp(prefix='wdbench')
+  try:
+    devices = [(0, device >> 8, device & 0xff)
+               for device in xrange(1, options.devices + 1)]
+    packets = options.rows // (len(devices) * 4)
+    start = int(time.time()) - packets * options.interval
+    database = os.path.join(workdir, 'history.sqlite')
+    writer = wdsqlite.BufferedSQLWriter(wdsqlite.Connect(database), 5000)
+    logname = os.path.join(workdir, 'history.log')
+    logfile = open(logname, 'w')
+    capturename = os.path.join(workdir, 'history.wdcap')
+    capture = wdcapture.CaptureWriter(capturename)
+    for index in xrange(packets):
+      timestamp = start + index * options.interval
+      for device in devices:
+        packet = SyntheticPacket(4, 2, device)
+        capture.Write(wdcapture.DATAGRAM, packet, timestamp)
+        device, temps, humidities = udplistener.Decode(packet)
+        for sensor in xrange(4):
+          temp = temps[sensor]
+          writer.Add((timestamp, wdsqlite.DeviceName(device), sensor,
+                      temp[0] + temp[1] / 100.0, humidities[sensor]))
+          logfile.write('\nDevice: %x:%x:%x\t%s\tSensor %i:\ttemp: '
+                        '%d.%02d\xe2\x84\x83 - \thumidity: %d%%' % (
+                            device + (time.strftime(
+                                '%H:%M:%S', time.localtime(timestamp)),
+                                      sensor) + temp + (humidities[sensor],)))
+    writer.Close()
+    logfile.close()
+    capture.Close()
+    logdate = time.strftime('%Y-%m-%d', time.localtime(start))
+    records = packets * len(devices) * 4
+    print '%d records of %d stations: sqlite %.1f MB, log %.1f MB, ' \
+        'capture %.1f MB' % (records, len(devices),
+                             os.path.getsize(database) / 1e6,
+                             os.path.getsize(logname) / 1e6,
+                             os.path.getsize(capturename) / 1e6)
+
+    sources = (
+        ('sqlite', lambda: wdbackfill.SQLiteRecords(database)),
+        ('log', lambda: wdbackfill.LogRecords(logname, logdate)),
+        ('capture', lambda: wdbackfill.CaptureRecords(capturename)))
+    for name, source in sources:
+      begin = time.time()
+      count = sum(1 for _record in source())
+      Report('read %s' % name, count, time.time() - begin, 'records')
+      if count != records:
+        raise AssertionError('Read %d records from the %s, wrote %d' % (
+            count, name, records))
+
+    for name, batch in (('rrd, update per sample', 1),
+                        ('rrd, %d per update' % options.batch,
+                         options.batch)):
+      rrddir = tempfile.mkdtemp(dir=workdir)
+      target = wdbackfill.RRDTarget(rrddir, 'bench-%s', batch)
+      begin = time.time()
+      for record in sources[0][1]():
+        target.Add(*record)
+      target.Close()
+      Report(name, records, time.time() - begin, 'records')
+      print '  %s' % target.Stats()
+
+    received = []
+    server = CarbonStandIn(options.port, received)
+    target = wdbackfill.CarbonTarget('127.0.0.1', options.port,
+                                     options.carbonbatch)
+    begin = time.time()
+    for record in sources[0][1]():
+      target.Add(*record)
+    target.Close()
+    server.WaitFor(records * 2)
+    Report('carbon, %d per batch' % options.carbonbatch, records,
+           time.time() - begin, 'records')
+    server.Stop()
+    if len(received) != records * 2:
+      raise AssertionError('Carbon received %d datapoints, expected %d' % (
+          len(received), records * 2))
+  finally:
+    shutil.rmtree(workdir)
+
+
+def Percentiles(latencies):
+  """Returns the 50th, 90th and 99th percentile and the maximum of latencies
+  in seconds, in microseconds"""
+  if not latencies:
+    return [0.0] * 4
+  latencies = sorted(latencies)
+  last = len(latencies) - 1
+  return [latencies[int(last * fraction)] * 1e6
+          for fraction in (0.5, 0.9, 0.99, 1.0)]
+
+
+def Usage():
+  """Returns the CPU seconds and the peak RSS in MB of this process"""
+  import resource
+  usage = resource.getrusage(resource.RUSAGE_SELF)
+  return usage.ru_utime + usage.ru_stime, usage.ru_maxrss / 1024.0
+
+
+def ReportUsage(count, percentiles, cpu, rss, unit):
+  """Prints the latency percentiles, CPU per item and memory growth"""
+  print '  latency p50 %.1fus, p90 %.1fus, p99 %.1fus, max %.1fus; ' \
+      '%.1fus CPU per %s; peak RSS +%.1f MB' % (
+          tuple(percentiles) + (cpu / max(count, 1) * 1e6, unit[:-1], rss))
+
+
+def TimeCalls(name, setup, items, unit):
+  """Calls store(item) for every item, with the store and close functions
+  that setup() returns, in a child process so CPU time and memory are its
+  own. Reports the throughput including close(), the latency of every
+  store(), the CPU time and how much the peak RSS grew"""
+  results = multiprocessing.Queue()
+
+  def Child():
+    store, close = setup()
+    cpu, rss = Usage()
+    latencies = []
+    start = time.time()
+    for item in items:
+      begin = time.time()
+      store(item)
+      latencies.append(time.time() - begin)
+    if close:
+      close()
+    elapsed = time.time() - start
+    endcpu, endrss = Usage()
+    results.put((elapsed, Percentiles(latencies), endcpu - cpu, endrss - rss))
+
+  child = multiprocessing.Process(target=Child)
+  child.start()
+  elapsed, percentiles, cpu, rss = results.get()
+  child.join()
+  Report(name, len(items), elapsed, unit)
+  ReportUsage(len(items), percentiles, cpu, rss, unit)
+
+
+def SyntheticCapture(filename, devices, seconds, probes=4):
+  """Writes a capture of `devices` stations sending a v2 packet and a serial
+  WeatherDuino sending a line every second, for `seconds` seconds"""
+  import wdcapture
+  capture = wdcapture.CaptureWriter(filename)
+  lines = SyntheticSerial(seconds, probes, junk=0).splitlines(True)
+  start = time.time() - seconds
+  for second in xrange(seconds):
+    for device in xrange(devices):
+      capture.Write(wdcapture.DATAGRAM,
+                    SyntheticPacket(probes, 2, (0, device >> 8, device & 0xff)),
+                    start + second + float(device) / devices)
+    capture.Write(wdcapture.SERIAL, lines[second], start + second)
+  capture.Close()
+
+
+def SuiteSinks(workdir, carbonport):
+  """Returns listener options for every storage backend and the (name, sink
+  class) pairs of the backends"""
+  import udplistener
+  options = ListenerOptions(
+      log=os.path.join(workdir, 'suite.log'),
+      sql=os.path.join(workdir, 'suite.sqlite'), sqlbatch=500,
+      sqlinterval=5.0, columnar=os.path.join(workdir, 'segments'),
+      columnarbatch=500, columnarinterval=5.0,
+      carbon='127.0.0.1:%d' % carbonport, carbonbatch=500,
+      carboninterval=5.0, carbonbacklog=100000, carbonspool=None,
+      sensors=udplistener.SensorResolver(()))
+  sinks = [('log', udplistener.LogSink)]
+  if udplistener.sqlite:
+    sinks.append(('sqlite', udplistener.SQLSink))
+  sinks.extend([('columnar', udplistener.ColumnarSink),
+                ('carbon', udplistener.CarbonSink)])
+  return options, sinks
+
+
+def RunSuiteListener(options, sinkclass, results):
+  """Runs a listener with a single sink that also records how long every
+  packet took from being received until it was stored, until SIGTERM"""
+  import udplistener
+
+  class TimedSink(sinkclass):
+    def __init__(self, options):
+      super(TimedSink, self).__init__(options)
+      self.latencies = []
+
+    def StorePacket(self, timestamp, device, temps, humidities):
+      super(TimedSink, self).StorePacket(timestamp, device, temps, humidities)
+      self.latencies.append(time.time() - timestamp)
+
+  sink = TimedSink(options)
+  listener = udplistener.WeatherDuinoListener(options, [sink])
+  cpu, rss = Usage()
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+  try:
+    listener.Run()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    listener.Close()
+    endcpu, endrss = Usage()
+    results.put((len(sink.latencies), Percentiles(sink.latencies),
+                 endcpu - cpu, endrss - rss))
+
+
+def BenchSuite(options):
+  """Replays captures (or a synthetic one) through the decoders, every
+  storage backend on its own and the listener over loopback UDP, reporting
+  throughput, latency percentiles, CPU time and memory growth of each"""
+  import udplistener
+  import wd2rrd
+  import wdbackfill
+  import wdcapture
+  import wdreplay
+  workdir = tempfile.mkdtemp(prefix='wdbench')
+  server = None
+  try:
+    captures = options.captures
+    if not captures:
+      captures = [os.path.join(workdir, 'synthetic.wdcap')]
+      SyntheticCapture(captures[0], options.devices, options.seconds)
+    datagrams = []
+    lines = []
+    for capture in captures:
+      for timestamp, kind, data in wdcapture.Read(capture):
+        if kind == wdcapture.DATAGRAM:
+          datagrams.append((timestamp, data))
+        else:
+          lines.append(data)
+    packets = [(timestamp, packet) for timestamp, packet in (
+        (timestamp, udplistener.Decode(data)) for timestamp, data in datagrams)
+               if packet]
+    print '%d datagrams (%d valid packets) and %d serial lines' % (
+        len(datagrams), len(packets), len(lines))
+
+    print 'Decoders:'
+    if datagrams:
+      TimeCalls('udplistener.Decode', lambda: (udplistener.Decode, None),
+                [data for _timestamp, data in datagrams], 'packets')
+    if lines:
+      TimeCalls('wd2rrd.SerialParser', lambda: (
+          wd2rrd.SerialParser(options.probes).ParseLine, None),
+                [line.rstrip('\n') for line in lines], 'lines')
+    if not packets:
+      return
+
+    received = []
+    server = CarbonStandIn(options.carbonport, received)
+    listeneroptions, sinks = SuiteSinks(workdir, options.carbonport)
+    sinks = [(name, sinkclass) for name, sinkclass in sinks
+             if not options.backends or name in options.backends]
+    print 'Storage backends:'
+    for name, sinkclass in sinks:
+      def Setup(sinkclass=sinkclass):
+        sink = sinkclass(listeneroptions)
+        return (lambda item: sink.StorePacket(item[0], *item[1]),
+                sink.Close)
+      TimeCalls(name, Setup, packets, 'packets')
+    if not options.backends or 'rrd' in options.backends:
+      def RRDSetup():
+        writer = wd2rrd.RRDWriter()
+        rrdfiles = {}
+
+        def Store(item):
+          timestamp, (device, temps, humidities) = item
+          if device not in rrdfiles:
+            prefix = os.path.join(workdir, 'suite-%x-%x-%x' % device)
+            rrdfiles[device] = prefix + '_temp.rrd', prefix + '_humid.rrd'
+          writer.Add(rrdfiles[device][0], [
+              temp[0] + temp[1] / 100.0 if temp[0] < 129 else None
+              for temp in temps], int(timestamp))
+          writer.Add(rrdfiles[device][1], [
+              humidity if humidity < 255 else None
+              for humidity in humidities],
+                     int(timestamp))
+        return Store, writer.Flush
+      TimeCalls('rrd', RRDSetup, packets, 'packets')
+
+    print 'Listener, replaying over loopback UDP at %s:' % (
+        '%gx real time' % options.speed if options.speed else 'full speed')
+    for name, sinkclass in sinks:
+      results = multiprocessing.Queue()
+      listener = multiprocessing.Process(
+          target=RunSuiteListener,
+          args=(argparse.Namespace(**dict(vars(listeneroptions),
+                                          port=options.port)),
+                sinkclass, results))
+      listener.start()
+      time.sleep(0.5)
+      start = time.time()
+      sent = 0
+      for capture in captures:
+        sent += wdreplay.ReplayUDP(capture, ('127.0.0.1', options.port),
+                                   options.speed)
+      # Give the listener a moment to drain whatever is still queued.
+      time.sleep(1)
+      listener.terminate()
+      handled, percentiles, cpu, rss = results.get()
+      listener.join()
+      Report(name, handled, time.time() - start, 'packets')
+      print '  %d datagrams sent, %.1f%% lost' % (
+          sent, 100.0 * (sent - handled) / max(sent, 1))
+      ReportUsage(handled, percentiles, cpu, rss, 'packets')
+  finally:
+    if server:
+      server.Stop()
+    shutil.rmtree(workdir)
+
+
+def BenchAdmission(options):
+  """Measures the admission stage on v3 packets of stations sending once a
+  second: clean, duplicated and lossy traffic, restarting stations, one
+  station flooding and a flood with spoofed device ids"""
+  import wdadmission
+  devices = [(0, device >> 8, device & 0xff)
+             for device in xrange(1, options.devices + 1)]
+  rounds = max(1, options.packets // len(devices))
+  clean = [(float(second), SyntheticPacket(1, 3, device, second))
+           for second in xrange(rounds) for device in devices]
+  duplicated = [packet for packet in clean for _copy in (0, 1)]
+  random.seed(1)
+  # Only losses between two received packets of a station can be counted.
+  lossy = [packet for packet in clean if packet[0] in (0, rounds - 1) or
+           random.random() >= options.loss]
+  flood = [(index / 1000.0, SyntheticPacket(1, 3, devices[0], index))
+           for index in xrange(options.packets)]
+  # Every station restarts halfway, 5 seconds later it counts from 0 again.
+  restart = rounds // 2
+  reboot = [(float(second + 5 * (second >= restart)), SyntheticPacket(
+      1, 3, device, second - restart * (second >= restart)))
+            for second in xrange(rounds) for device in devices]
+  spoofed = [(index / 10000.0, SyntheticPacket(
+      1, 2, (random.randint(0, 255), random.randint(0, 255),
+             random.randint(0, 255))))
+             for index in xrange(options.packets)]
+  for name, packets in (('clean', clean), ('duplicated', duplicated),
+                        ('lossy', lossy), ('reboot', reboot),
+                        ('flood, 1000/s', flood),
+                        ('spoofed ids, 10000/s', spoofed)):
+    admission = wdadmission.Admission(options.window, options.rate,
+                                      options.burst, options.maxdevices)
+    start = time.time()
+    admitted = 0
+    for now, data in packets:
+      if admission.Admit(data, now):
+        admitted += 1
+    Report(name, len(packets), time.time() - start, 'packets')
+    print '  %d admitted, %s, %d devices tracked' % (
+        admitted, ', '.join('%s %d' % (reason, admission.Count(reason))
+                            for reason in wdadmission.COUNTS),
+        len(admission.devices))
+    if name == 'lossy' and admission.Count('lost') != len(clean) - len(lossy):
+      raise AssertionError('Counted %d lost packets, dropped %d' % (
+          admission.Count('lost'), len(clean) - len(lossy)))
+    if name == 'reboot' and admitted != len(reboot):
+      raise AssertionError('Rejected %d packets of restarted stations' % (
+          len(reboot) - admitted))
+
+
+def BenchRecent(options):
+  """Measures the recent readings ring buffers: storing readings until every
+  ring wrapped around, and the latest and window queries, directly and over
+  HTTP"""
+  import urllib2
+  import wdmetrics
+  import wdrecent
+  before = Usage()[1]
+  recent = wdrecent.RecentReadings(
+      wdrecent.Slots(options.hours, options.interval), options.series)
+  allocated = Usage()[1]
+  print 'Recent readings: %d slots for %d series, %.1f MB allocated, ' \
+      'peak RSS +%.1f MB' % (recent.slots, recent.maxseries,
+                             recent.Memory() / 1048576.0, allocated - before)
+  series = [('0:%x:%x' % (number >> 8, number & 0xff), sensor)
+            for number in xrange(options.series // 4) for sensor in xrange(4)]
+  rounds = recent.slots + recent.slots // 2
+  start = time.time()
+  for reading in xrange(rounds):
+    timestamp = reading * options.interval
+    for device, sensor in series:
+      recent.Add(device, sensor, timestamp, 20.5 + sensor, 50.0)
+  Report('add', rounds * len(series), time.time() - start, 'readings')
+  print '  peak RSS +%.1f MB after wrapping around' % (Usage()[1] - allocated)
+  device, sensor = series[-1]
+  last = (rounds - 1) * options.interval
+  for name, query, count in (
+      ('latest', lambda: recent.Latest(), 100),
+      ('latest of a device', lambda: recent.Latest(device), 1000),
+      ('last 10 minutes', lambda: recent.Readings(
+          device, sensor, last - 600), 1000),
+      ('all readings', lambda: recent.Readings(device, sensor), 100)):
+    start = time.time()
+    for _query in xrange(count):
+      result = query()
+    Report(name, count, time.time() - start, 'queries')
+    print '  %d readings per query' % len(result)
+  server = wdmetrics.MetricsServer(None, ('127.0.0.1', options.port),
+                                   wdrecent.Routes(recent))
+  try:
+    for name, path in (
+        ('http latest', '/latest'),
+        ('http last 10 minutes', '/readings?device=%s&sensor=%d&start=%d' % (
+            device, sensor, last - 600))):
+      url = 'http://127.0.0.1:%d%s' % (options.port, path)
+      start = time.time()
+      for _query in xrange(100):
+        body = urllib2.urlopen(url).read()
+      Report(name, 100, time.time() - start, 'queries')
+      print '  %d bytes per response' % len(body)
+  finally:
+    server.Close()
+
+
+def StartupTime(command, ready=None):
+  """Returns the seconds `command` takes to exit, or with `ready` to print a
+  line containing it, after which it is terminated"""
+  start = time.time()
+  process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT)
+  if ready is None:
+    output = process.communicate()[0]
+    if process.returncode:
+      raise AssertionError('%s failed:\n%s' % (' '.join(command), output))
+    return time.time() - start
+  output = []
+  for line in iter(process.stdout.readline, ''):
+    output.append(line)
+    if ready in line:
+      elapsed = time.time() - start
+      process.terminate()
+      process.wait()
+      return elapsed
+  process.wait()
+  raise AssertionError('%s exited before it was ready:\n%s' % (
+      ' '.join(command), ''.join(output)))
+
+
+def BenchStartup(options):
+  """Measures how long the tools take to start, in fresh interpreters: the
+  interpreter itself, importing every tool module and starting the listener
+  with each storage backend, reporting the median of several runs"""
+  tools = os.path.dirname(os.path.abspath(__file__))
+  workdir = tempfile.mkdtemp(prefix='wdbench-')
+  python = [sys.executable, '-u']
+  port = str(options.port)
+  runs = [('interpreter', python + ['-c', 'pass'], None)]
+  for module in ('udplistener', 'wd2rrd', 'wdbackfill', 'wdsqlite',
+                 'wdcolumnar', 'wdcarbon', 'wdmetrics'):
+    runs.append(('import %s' % module, python + [
+        '-c', 'import sys; sys.path.insert(0, %r); import %s' % (
+            tools, module)], None))
+  listener = python + [os.path.join(tools, 'udplistener.py'), '-p', port]
+  for name, arguments in (
+      ('print', []),
+      ('log', ['-l', os.path.join(workdir, 'log')]),
+      ('sqlite', ['-s', os.path.join(workdir, 'db')]),
+      ('columnar', ['--columnar', workdir]),
+      ('carbon', ['-c', '127.0.0.1:%d' % options.carbonport]),
+      ('metrics', ['-m', str(options.port + 1)]),
+      ('all', ['-l', os.path.join(workdir, 'log'),
+               '-s', os.path.join(workdir, 'db'), '--columnar', workdir,
+               '-c', '127.0.0.1:%d' % options.carbonport,
+               '-m', str(options.port + 1),
+               '--recent', str(options.port + 2)])):
+    runs.append(('listener %s' % name, listener + arguments,
+                 'Starting WeatherDuino listener'))
+  try:
+    for name, command, ready in runs:
+      times = sorted(StartupTime(command, ready)
+                     for _run in xrange(options.runs))
+      print '%-24s median %7.1fms, min %7.1fms, max %7.1fms' % (
+          name, times[len(times) // 2] * 1000, times[0] * 1000,
+          times[-1] * 1000)
+  finally:
+    shutil.rmtree(workdir)
+
+
+def LegacyCarbonDatapoints(config, timestamp, device, temps, humidities):
+  """The datapoints of the original CarbonSink.StorePacket, which looked up
+  every sensor name in the ConfigParser and formatted every path"""
+  import ConfigParser
+  timestamp = int(timestamp)
+  datapoints = []
+  device = '%x:%x:%x' % (device[0], device[1], device[2])
+  for sensor in xrange(len(temps)):
+    temp = temps[sensor]
+    humidity = humidities[sensor]
+    if temp[0] < 129 or humidity < 255:
+      try:
+        name = config.get(device, str(sensor))
+      except (ConfigParser.NoOptionError, ConfigParser.NoSectionError):
+        name = sensor
+      path = 'weather.%s.%s' % (device, name)
+    if temp[0] < 129:
+      datapoints.append(
+          ('%s.temp' % path, (timestamp, float('%d.%02d' % temp))))
+    if humidity < 255:
+      datapoints.append(('%s.humidity' % path, (timestamp, humidity)))
+  return datapoints
+
+
+def BenchSensorNames(options):
+  """Compares looking up the sensor names and formatting the metric paths of
+  the Carbon sink per measurement with the cached SensorResolver, for
+  stations of which half have named sensors"""
+  import ConfigParser
+  import udplistener
+  workdir = tempfile.mkdtemp(prefix='wdbench')
+  try:
+    devices = [(0, device >> 8, device & 0xff)
+               for device in xrange(1, options.devices + 1)]
+    configfile = os.path.join(workdir, 'weatherduino')
+    with open(configfile, 'w') as config:
+      for device in devices[::2]:
+        config.write('[%x:%x:%x]\n' % device)
+        for sensor in xrange(options.probes):
+          config.write('%d = room%d\n' % (sensor, sensor))
+    start = time.time()
+    sensors = udplistener.SensorResolver((configfile,))
+    Report('load names', 1, time.time() - start, 'configs')
+    config = ConfigParser.ConfigParser()
+    config.read([configfile])
+    packets = []
+    for second in xrange(max(1, options.packets // len(devices))):
+      for device in devices:
+        packet = udplistener.Decode(SyntheticPacket(options.probes, 2, device))
+        packets.append((float(second),) + packet)
+
+    def Datapoints(timestamp, device, temps, humidities):
+      paths = sensors.Device(device, len(temps), timestamp)[1]
+      datapoints = []
+      for sensor in xrange(len(temps)):
+        temp = temps[sensor]
+        if temp[0] < 129:
+          datapoints.append((paths[sensor][1],
+                             (int(timestamp), temp[0] + temp[1] / 100.0)))
+        if humidities[sensor] < 255:
+          datapoints.append((paths[sensor][2],
+                             (int(timestamp), humidities[sensor])))
+      return datapoints
+
+    for packet in packets[:len(devices)]:
+      if [path for path, _value in LegacyCarbonDatapoints(config, *packet)] \
+          != [path for path, _value in Datapoints(*packet)]:
+        raise AssertionError('Paths differ for %r' % (packet[1],))
+    start = time.time()
+    for packet in packets:
+      LegacyCarbonDatapoints(config, *packet)
+    Report('ConfigParser per sensor', len(packets), time.time() - start,
+           'packets')
+    start = time.time()
+    for packet in packets:
+      Datapoints(*packet)
+    Report('SensorResolver', len(packets), time.time() - start, 'packets')
+  finally:
+    shutil.rmtree(workdir)
+
+
+def ReduceErrors(reducer, readings):
+  """Passes the (series, timestamp, value) readings through a single value
+  wdreduce.Reducer. Returns the readings kept and the largest error of a
+  reading when the kept values are held until the next (forward), and when
+  they fill the time before them like in an RRD file (backward)"""
+  held = {}
+  pending = {}
+  kept = 0
+  forward = backward = 0.0
+  for series, timestamp, value in readings:
+    stored = reducer.Add(series, timestamp, (value,))
+    kept += len(stored)
+    waiting = pending.setdefault(series, [])
+    waiting.append((timestamp, value))
+    for storedtime, (storedvalue,) in stored:
+      while waiting and waiting[0][0] <= storedtime:
+        backward = max(backward, abs(waiting.pop(0)[1] - storedvalue))
+      held[series] = storedvalue
+    if series in held:
+      forward = max(forward, abs(value - held[series]))
+  return kept, forward, backward
+
+
+def BenchReduce(options):
+  """Measures the readings the listener's reduce stage keeps and the error of
+  the stored readings, for temperatures that drift with some noise and
+  humidities in whole percents"""
+  import udplistener
+  import wdreduce
+  random.seed(1)
+  devices = [(0, device >> 8, device & 0xff)
+             for device in xrange(1, options.devices + 1)]
+  packets = []
+  for second in xrange(options.seconds):
+    for number, device in enumerate(devices):
+      temps = []
+      humidities = []
+      for sensor in xrange(options.probes):
+        phase = number + sensor
+        temp = int(round(2000 + 500 * math.sin(second / 3600.0 + phase) +
+                         random.gauss(0, 3)))
+        temps.append(divmod(temp, 100))
+        humidities.append(int(50 + 10 * math.sin(second / 7200.0 + phase)))
+      packets.append((float(second), (device, temps, humidities)))
+  readings = len(packets) * options.probes
+  print '%d readings: %d devices, %d probes, %d seconds' % (
+      readings, options.devices, options.probes, options.seconds)
+
+  listener = udplistener.WeatherDuinoListener(ListenerOptions(
+      reducewindow=options.window, reduce=options.reduce,
+      deadband=options.deadband, humiditydeadband=options.humiditydeadband,
+      heartbeat=options.heartbeat), [])
+  try:
+    start = time.time()
+    kept = 0
+    for timestamp, packet in packets:
+      reduced = listener.Reduce(timestamp, packet)
+      if reduced:
+        kept += 1
+    Report('reduce stage', len(packets), time.time() - start, 'packets')
+    print 'Packets stored: %d of %d (%.1f%%), readings kept: %d (%.1f%%)' % (
+        kept, len(packets), 100.0 * kept / len(packets),
+        listener.reducer.kept, 100.0 * listener.reducer.kept / readings)
+  finally:
+    listener.Close()
+
+  if options.deadband is None or options.window:
+    return
+  # The errors per quantity, in degrees and percent.
+  for name, deadband, values in (
+      ('temperature', options.deadband,
+       lambda temps, humidities: [temp[0] + temp[1] / 100.0
+                                  for temp in temps]),
+      ('humidity', options.humiditydeadband,
+       lambda temps, humidities: humidities)):
+    for backfill in (False, True):
+      stream = [((device, sensor), timestamp, value)
+                for timestamp, (device, temps, humidities) in packets
+                for sensor, value in enumerate(values(temps, humidities))]
+      kept, forward, backward = ReduceErrors(wdreduce.Reducer(
+          deadband=deadband, heartbeat=options.heartbeat, backfill=backfill),
+                                             stream)
+      print '%-11s deadband %.2f%s: %.1f%% kept, error held forward %.2f, ' \
+          'filled backward %.2f' % (
+              name, deadband, ' with backfill' if backfill else '',
+              100.0 * kept / len(stream), forward, backward)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  subparsers = parser.add_subparsers()
+
+  sqlparser = subparsers.add_parser(
+      'sqlite', help='sqlite writes, migration and queries')
+  sqlparser.add_argument('-r', '--rows', type=int, default=5000,
+                         help='Number of rows to write')
+  sqlparser.add_argument('-b', '--batch', type=int, default=500,
+                         help='Rows per batch for the buffered writer')
+  sqlparser.add_argument('--history', type=int, default=1000000,
+                         help='Rows of history to migrate and query')
+  sqlparser.add_argument('-D', '--devices', type=int, default=30,
+                         help='Number of stations in the history')
+  sqlparser.set_defaults(func=BenchSQLite)
+
+  decodeparser = subparsers.add_parser(
+      'decode', help='per-byte packet parsing versus the columnar decoder')
+  decodeparser.add_argument('-n', '--packets', type=int, default=2000,
+                            help='Number of packets per probe count')
+  decodeparser.add_argument('-p', '--probes', type=int, nargs='+',
+                            default=[1, 2, 4, 16, 64, 255],
+                            help='Probe counts to benchmark (1-255)')
+  decodeparser.add_argument('-r', '--runs', type=int, default=7,
+                            help='Runs per probe count, the fastest counts')
+  decodeparser.set_defaults(func=BenchDecode)
+
+  ingestparser = subparsers.add_parser(
+      'ingest', help='sustained packets per second over loopback UDP')
+  ingestparser.add_argument('-d', '--duration', type=float, default=5,
+                            help='Seconds to send packets for')
+  ingestparser.add_argument('-p', '--port', type=int, default=65101,
+                            help='Loopback port to run the listener on')
+  ingestparser.add_argument('--probes', type=int, default=4,
+                            help='Probes per packet')
+  ingestparser.add_argument('-s', '--senders', type=int, default=2,
+                            help='Number of load generating processes')
+  ingestparser.add_argument('-w', '--workers', type=int, nargs='+',
+                            default=[multiprocessing.cpu_count()],
+                            help='Worker counts to compare with the Run loop')
+  ingestparser.add_argument('-r', '--rate', type=int, default=0,
+                            help='Packets per second per sender, below the '
+                            'listener capacity the CPU per packet is exact '
+                            '(default: as fast as possible)')
+  ingestparser.add_argument('-m', '--metrics', action='store_true',
+                            help='Also run every listener with metrics')
+  ingestparser.add_argument('--delay', type=float, default=0,
+                            help='Seconds the sink sleeps per packet, '
+                            'to simulate slow storage')
+  ingestparser.set_defaults(func=BenchIngest)
+
+  carbonparser = subparsers.add_parser(
+      'carbon', help='carbon pickle per datapoint versus batched client')
+  carbonparser.add_argument('-n', '--datapoints', type=int, default=100000,
+                            help='Number of datapoints to send')
+  carbonparser.add_argument('-b', '--batch', type=int, default=500,
+                            help='Datapoints per batch for the client')
+  carbonparser.add_argument('-p', '--port', type=int, default=62004,
+                            help='Loopback port for the stand-in server')
+  carbonparser.set_defaults(func=BenchCarbon)
+
+  renderparser = subparsers.add_parser(
+      'render', help='wd2rrd graph rendering CPU seconds per hour')
+  renderparser.add_argument('-r', '--renders', type=int, default=5,
+                            help='Renders per graph to measure the CPU cost')
+  renderparser.set_defaults(func=BenchRender)
+
+  fleetparser = subparsers.add_parser(
+      'fleet', help='wd2rrd render scheduling for many stations')
+  fleetparser.add_argument('-s', '--stations', type=int, default=20,
+                           help='Number of stations')
+  fleetparser.add_argument('--probes', type=int, default=8,
+                           help='Probes per station')
+  fleetparser.add_argument('-r', '--renderers', type=int, nargs='+',
+                           default=[0, multiprocessing.cpu_count()],
+                           help='Render processes to compare, 0 renders in '
+                           'the main process (default: 0 and one per core)')
+  fleetparser.add_argument('-i', '--interval', type=int, default=20,
+                           help='Render interval in seconds (wd2rrd.py: 300)')
+  fleetparser.add_argument('-b', '--budget', type=float, default=0.5,
+                           help='Share of the renderers\' CPU time for '
+                           'rendering')
+  fleetparser.set_defaults(func=BenchFleet)
+
+  serialparser = subparsers.add_parser(
+      'serial', help='wd2rrd json.loads per line versus the serial parser')
+  serialparser.add_argument('captures', nargs='*',
+                            help='Files with recorded serial output, '
+                            'synthetic output is used if none are given')
+  serialparser.add_argument('-n', '--lines', type=int, default=100000,
+                            help='Number of synthetic lines')
+  serialparser.add_argument('-p', '--probes', type=int, default=4,
+                            help='Number of probes configured')
+  serialparser.add_argument('-i', '--ignore', default='T2,H2',
+                            help='Ignore list, as the wd2rrd --ignore option')
+  serialparser.add_argument('-j', '--junk', type=float, default=0.01,
+                            help='Fraction of synthetic lines that is junk')
+  serialparser.add_argument('-c', '--chunk', type=int, default=64,
+                            help='Bytes per serial read fed to the parser')
+  serialparser.set_defaults(func=BenchSerial)
+
+  columnarparser = subparsers.add_parser(
+      'columnar', help='text log scans versus columnar range queries')
+  columnarparser.add_argument('-d', '--days', type=int, default=30,
+                              help='Days of history')
+  columnarparser.add_argument('-D', '--devices', type=int, default=100,
+                              help='Number of stations, with 4 sensors each')
+  columnarparser.add_argument('-i', '--interval', type=int, default=600,
+                              help='Seconds between packets of a station')
+  columnarparser.add_argument('-q', '--queries', type=int, default=10,
+                              help='Times every query is repeated')
+  columnarparser.set_defaults(func=BenchColumnar)
+
+  backfillparser = subparsers.add_parser(
+      'backfill', help='bulk loading history into RRD files and Carbon')
+  backfillparser.add_argument('-r', '--rows', type=int, default=200000,
+                              help='Number of measurements of history')
+  backfillparser.add_argument('-D', '--devices', type=int, default=5,
+                              help='Number of stations, with 4 sensors each')
+  backfillparser.add_argument('-i', '--interval', type=int, default=60,
+                              help='Seconds between packets of a station')
+  backfillparser.add_argument('-b', '--batch', type=int, default=1000,
+                              help='Samples per rrdtool update')
+  backfillparser.add_argument('--carbonbatch', type=int, default=5000,
+                              help='Datapoints per carbon batch')
+  backfillparser.add_argument('-p', '--port', type=int, default=62005,
+                              help='Loopback port for the stand-in server')
+  backfillparser.set_defaults(func=BenchBackfill)
+
+  suiteparser = subparsers.add_parser(
+      'suite', help='decoders, storage backends and the listener on a '
+      'captured or synthetic replay')
+  suiteparser.add_argument('captures', nargs='*',
+                           help='Capture files (udplistener/wd2rrd.py '
+                           '--capture), a synthetic one is used if none '
+                           'are given')
+  suiteparser.add_argument('-D', '--devices', type=int, default=50,
+                           help='Stations in the synthetic capture')
+  suiteparser.add_argument('-t', '--seconds', type=int, default=200,
+                           help='Seconds of synthetic capture')
+  suiteparser.add_argument('--probes', type=int, default=4,
+                           help='Probes of the serial WeatherDuino')
+  suiteparser.add_argument('-b', '--backends', nargs='+',
+                           help='Storage backends to run (log, sqlite, '
+                           'columnar, carbon, rrd; default: all)')
+  suiteparser.add_argument('-x', '--speed', type=float, default=20,
+                           help='Replay speed for the listener, 0 is as fast '
+                           'as possible (default: 20 times real time)')
+  suiteparser.add_argument('-p', '--port', type=int, default=65102,
+                           help='Loopback port to run the listener on')
+  suiteparser.add_argument('--carbonport', type=int, default=62006,
+                           help='Loopback port for the carbon stand-in')
+  suiteparser.set_defaults(func=BenchSuite)
+
+  admissionparser = subparsers.add_parser(
+      'admission', help='deduplication, rate limiting and sequence tracking')
+  admissionparser.add_argument('-n', '--packets', type=int, default=100000,
+                               help='Number of packets per scenario')
+  admissionparser.add_argument('-D', '--devices', type=int, default=1000,
+                               help='Number of stations')
+  admissionparser.add_argument('-l', '--loss', type=float, default=0.01,
+                               help='Fraction of packets lost in the lossy '
+                               'scenario')
+  admissionparser.add_argument('--window', type=float, default=0.5,
+                               help='Deduplication window in seconds')
+  admissionparser.add_argument('--rate', type=float, default=5.0,
+                               help='Packets per second per device')
+  admissionparser.add_argument('--burst', type=int, default=20,
+                               help='Token bucket size')
+  admissionparser.add_argument('--maxdevices', type=int, default=4096,
+                               help='Devices to keep state for')
+  admissionparser.set_defaults(func=BenchAdmission)
+
+  recentparser = subparsers.add_parser(
+      'recent', help='recent readings ring buffers and their queries')
+  recentparser.add_argument('--hours', type=float, default=1.0,
+                            help='Hours of readings kept per series')
+  recentparser.add_argument('--interval', type=float, default=2.0,
+                            help='Seconds between two readings of a series')
+  recentparser.add_argument('--series', type=int, default=256,
+                            help='Number of series')
+  recentparser.add_argument('-p', '--port', type=int, default=65103,
+                            help='Port for the HTTP queries')
+  recentparser.set_defaults(func=BenchRecent)
+
+  startupparser = subparsers.add_parser(
+      'startup', help='interpreter, import and listener start times')
+  startupparser.add_argument('-n', '--runs', type=int, default=5,
+                             help='Runs per measurement')
+  startupparser.add_argument('-p', '--port', type=int, default=65104,
+                             help='Listening port, the next two are used for '
+                             'the metrics and recent readings')
+  startupparser.add_argument('--carbonport', type=int, default=62007,
+                             help='Port of a (missing) carbon server')
+  startupparser.set_defaults(func=BenchStartup)
+
+  namesparser = subparsers.add_parser(
+      'names', help='sensor name lookups and metric paths per measurement')
+  namesparser.add_argument('-n', '--packets', type=int, default=100000,
+                           help='Number of packets')
+  namesparser.add_argument('-D', '--devices', type=int, default=1000,
+                           help='Number of stations')
+  namesparser.add_argument('--probes', type=int, default=4,
+                           help='Probes per station')
+  namesparser.set_defaults(func=BenchSensorNames)
+
+  reduceparser = subparsers.add_parser(
+      'reduce', help='listener downsampling and deadband, kept readings and '
+      'their error')
+  reduceparser.add_argument('-D', '--devices', type=int, default=20,
+                            help='Number of stations')
+  reduceparser.add_argument('--probes', type=int, default=4,
+                            help='Probes per station')
+  reduceparser.add_argument('-t', '--seconds', type=int, default=3600,
+                            help='Seconds of readings, one packet per second '
+                            'per station')
+  reduceparser.add_argument('-w', '--window', type=float, default=0,
+                            help='Aggregation window in seconds')
+  reduceparser.add_argument('--reduce', default='avg',
+                            choices=('avg', 'min', 'max', 'last'),
+                            help='Aggregate per window')
+  reduceparser.add_argument('-d', '--deadband', type=float, default=0.1,
+                            help='Temperature deadband in degrees')
+  reduceparser.add_argument('--humiditydeadband', type=float, default=0,
+                            help='Humidity deadband in percent')
+  reduceparser.add_argument('--heartbeat', type=float, default=300,
+                            help='Seconds after which a reading is stored')
+  reduceparser.set_defaults(func=BenchReduce)
+
+  options = parser.parse_args()
+  options.func(options)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,62 @@
+#!/usr/bin/python2.7
+# -*- coding: utf8 -*-
+""" Capture files of raw WeatherDuino input.
+
+A capture file starts with MAGIC, followed by one record per captured UDP
+datagram or serial line: a little endian float64 receive timestamp, a uint8
+kind (DATAGRAM or SERIAL) and a uint16 length, followed by the raw data. The
+records are written in the order they were received."""
+__author__ = 'Jan KLopper (jan@underdark.nl)'
+__version__ = 0.1
+
+import struct
+import time
+
+MAGIC = 'WDCAPTURE1\n'
+RECORD = struct.Struct('<dBH')
+DATAGRAM = 0
+SERIAL = 1
+
+
+class CaptureWriter(object):
+  """Appends records to a capture file, writing the header to a new file.
+  Several processes can append to the same file if each uses its own
+  unbuffered (`buffering` 0) writer, as every record is then a single
+  write() to a file opened for appending."""
+
+  def __init__(self, filename, buffering=-1):
+    self.capturefile = open(filename, 'ab', buffering)
+    if not self.capturefile.tell():
+      self.capturefile.write(MAGIC)
+    self.records = 0
+
+  def Write(self, kind, data, timestamp=None):
+    if timestamp is None:
+      timestamp = time.time()
+    self.capturefile.write(RECORD.pack(timestamp, kind, len(data)) + data)
+    self.records += 1
+
+  def Flush(self):
+    self.capturefile.flush()
+
+  def Close(self):
+    self.capturefile.close()
+
+
+def Read(filename, kind=None):
+  """Yields the (timestamp, kind, data) records of a capture file, optionally
+  only those of one kind. A record cut off at the end of the file (by a crash
+  while capturing) is ignored."""
+  with open(filename, 'rb') as capturefile:
+    if capturefile.read(len(MAGIC)) != MAGIC:
+      raise ValueError('%s is not a WeatherDuino capture file' % filename)
+    while True:
+      header = capturefile.read(RECORD.size)
+      if len(header) < RECORD.size:
+        return
+      timestamp, recordkind, length = RECORD.unpack(header)
+      data = capturefile.read(length)
+      if len(data) < length:
+        return
+      if kind is None or recordkind == kind:
+        yield timestamp, recordkind, data
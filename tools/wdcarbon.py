@@ -0,0 +1,216 @@
+#!/usr/bin/python2.7
+# -*- coding: utf8 -*-
+""" Batching Carbon client for the WeatherDuino tools.
+
+Datapoints are collected in memory and sent to Carbon's pickle receiver in
+large batches. When the connection to Carbon is lost the batches are kept in a
+bounded backlog, optionally overflowing to a spool file on disk, and are sent
+once the connection is restored."""
+__author__ = 'Jan KLopper (jan@underdark.nl)'
+__version__ = 0.1
+
+import collections
+import os
+import select
+import socket
+import struct
+import time
+try:
+  import cPickle as pickle
+except ImportError:
+  import pickle
+
+# Seconds to wait before reconnecting, doubled after every failed attempt.
+RECONNECT_MIN = 1
+RECONNECT_MAX = 60
+# Seconds a connect or send may take before the connection is considered dead.
+SOCKET_TIMEOUT = 10
+# Carbon's pickle receiver frames every payload with a 4 byte length header.
+FRAME = struct.Struct('!L')
+
+
+class CarbonClient(object):
+  """Sends (path, (timestamp, value)) datapoints to Carbon in batches.
+
+  A batch is sent once `batchsize` datapoints are pending or the oldest
+  pending datapoint is `maxdelay` seconds old. At most `backlog` datapoints are
+  kept in memory while Carbon is unreachable; beyond that whole batches are
+  appended to the `spool` file if one is given, or the oldest batches are
+  dropped."""
+
+  def __init__(self, server, port, batchsize=500, maxdelay=5.0,
+               backlog=100000, spool=None, verbose=False):
+    self.address = (server, int(port))
+    self.batchsize = batchsize
+    self.maxdelay = maxdelay
+    self.backloglimit = backlog
+    self.spool = spool
+    self.verbose = verbose
+    self.carbonsocket = None
+    self.retrydelay = RECONNECT_MIN
+    self.retryat = 0
+    self.pending = []
+    self.oldest = None
+    self.backlog = collections.deque()
+    self.backlogsize = 0
+    self.stats = dict.fromkeys(
+        ('batches', 'datapoints', 'dropped', 'spooled', 'connects',
+         'lastbatch', 'lastflush', 'maxflush', 'totalflush'), 0)
+
+  def Add(self, path, timestamp, value):
+    """Queues a single datapoint."""
+    if not self.pending:
+      self.oldest = time.time()
+    self.pending.append((path, (timestamp, value)))
+    if (len(self.pending) >= self.batchsize or
+        time.time() - self.oldest >= self.maxdelay):
+      self.Flush()
+
+  def AddMany(self, datapoints):
+    """Queues a list of (path, (timestamp, value)) datapoints."""
+    if not self.pending:
+      self.oldest = time.time()
+    self.pending.extend(datapoints)
+    if (len(self.pending) >= self.batchsize or
+        time.time() - self.oldest >= self.maxdelay):
+      self.Flush()
+
+  def Tick(self):
+    """Flushes pending datapoints if they have been waiting for too long, and
+    retries sending the backlog."""
+    if self.pending and time.time() - self.oldest >= self.maxdelay:
+      self.Flush()
+    elif self.backlog or self.Spooled():
+      self.Send()
+
+  def Flush(self):
+    """Moves the pending datapoints to the backlog as one batch and sends it."""
+    if self.pending:
+      batch = self.pending
+      self.pending = []
+      self.oldest = None
+      self.backlog.append(batch)
+      self.backlogsize += len(batch)
+      while self.backlogsize > self.backloglimit and len(self.backlog) > 1:
+        overflow = self.backlog.popleft()
+        self.backlogsize -= len(overflow)
+        if self.spool:
+          with open(self.spool, 'ab') as spool:
+            spool.write(self.Frame(overflow))
+          self.stats['spooled'] += len(overflow)
+        else:
+          self.stats['dropped'] += len(overflow)
+    self.Send()
+
+  def Send(self):
+    """Sends the spooled and backlogged batches, oldest first. Returns False
+    when Carbon could not be reached; the data is then kept for a retry."""
+    if not self.Connect():
+      return False
+    try:
+      if self.Spooled():
+        self.SendSpool()
+      while self.backlog:
+        batch = self.backlog[0]
+        start = time.time()
+        self.carbonsocket.sendall(self.Frame(batch))
+        elapsed = time.time() - start
+        self.backlog.popleft()
+        self.backlogsize -= len(batch)
+        self.stats['batches'] += 1
+        self.stats['datapoints'] += len(batch)
+        self.stats['lastbatch'] = len(batch)
+        self.stats['lastflush'] = elapsed
+        self.stats['totalflush'] += elapsed
+        self.stats['maxflush'] = max(self.stats['maxflush'], elapsed)
+    except socket.error, msg:
+      print 'Lost connection to carbon server %s:%d: %s' % (
+          self.address + (msg,))
+      self.Disconnect()
+      return False
+    return True
+
+  def SendSpool(self):
+    """Sends the spool file to Carbon and truncates it. The spool holds ready
+    framed batches, so it is copied over in fixed size chunks."""
+    with open(self.spool, 'rb') as spool:
+      while True:
+        chunk = spool.read(65536)
+        if not chunk:
+          break
+        self.carbonsocket.sendall(chunk)
+    os.unlink(self.spool)
+
+  def Spooled(self):
+    return self.spool and os.path.exists(self.spool)
+
+  def Connect(self):
+    """Makes sure there is a connection to Carbon, backing off exponentially
+    between failed attempts. Returns whether there is a connection."""
+    if self.carbonsocket:
+      # Carbon never sends anything, so a readable socket means it closed the
+      # connection. Checking this first avoids writing a batch into a socket
+      # that is already dead, which would succeed but lose the batch.
+      readable = select.select([self.carbonsocket], [], [], 0)[0]
+      if not readable:
+        return True
+      print 'Carbon server %s:%d closed the connection' % self.address
+      self.carbonsocket.close()
+      self.carbonsocket = None
+    if time.time() < self.retryat:
+      return False
+    try:
+      self.carbonsocket = socket.create_connection(self.address,
+                                                   SOCKET_TIMEOUT)
+    except socket.error, msg:
+      print 'Cannot connect to carbon server %s:%d: %s (retry in %ds)' % (
+          self.address + (msg, self.retrydelay))
+      self.retryat = time.time() + self.retrydelay
+      self.retrydelay = min(self.retrydelay * 2, RECONNECT_MAX)
+      return False
+    if self.verbose:
+      print 'Connected to carbon server %s:%d' % self.address
+    self.stats['connects'] += 1
+    self.retrydelay = RECONNECT_MIN
+    return True
+
+  def Disconnect(self):
+    if self.carbonsocket:
+      self.carbonsocket.close()
+      self.carbonsocket = None
+    self.retryat = time.time() + self.retrydelay
+
+  def Frame(self, batch):
+    """Returns a batch as a length prefixed pickle, as Carbon expects it."""
+    payload = pickle.dumps(batch, 2)
+    return FRAME.pack(len(payload)) + payload
+
+  def Stats(self):
+    """Returns the counters of this client: batches and datapoints sent, the
+    size of the last batch, flush latencies in seconds and how many datapoints
+    are pending, backlogged, spooled or were dropped."""
+    stats = dict(self.stats)
+    stats['avgflush'] = stats['totalflush'] / (stats['batches'] or 1)
+    stats['pending'] = len(self.pending)
+    stats['backlog'] = self.backlogsize
+    return stats
+
+  def Close(self):
+    """Sends whatever is left if Carbon is reachable, spools or discards it
+    otherwise, and disconnects."""
+    self.retryat = 0
+    self.Flush()
+    if self.carbonsocket:
+      self.carbonsocket.shutdown(socket.SHUT_WR)
+    self.Disconnect()
+    if self.backlog and self.spool:
+      with open(self.spool, 'ab') as spool:
+        for batch in self.backlog:
+          spool.write(self.Frame(batch))
+      self.stats['spooled'] += self.backlogsize
+    elif self.backlog:
+      print 'Discarding %d datapoints that could not be sent to carbon' % (
+          self.backlogsize)
+      self.stats['dropped'] += self.backlogsize
+    self.backlog.clear()
+    self.backlogsize = 0
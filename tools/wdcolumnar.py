@@ -0,0 +1,265 @@
+#!/usr/bin/python2.7
+# -*- coding: utf8 -*-
+""" Columnar on-disk history for the WeatherDuino listener.
+
+Measurements are appended as fixed width binary records to one segment file
+per (UTC) day, named YYYYMMDD.wdc. A record is 13 bytes: a uint32 timestamp,
+the 3 device id bytes, a uint8 sensor number, a float32 temperature (NaN when
+unknown) and a uint8 humidity (255 when unknown), all little endian.
+
+Because every record has the same size, a reader can memory map a segment and
+use it as a NumPy record array without parsing it. Every batch is written in
+timestamp order, so the timestamp column of a segment is normally sorted and a
+time range is found with a binary search."""
+__author__ = 'Jan KLopper (jan@underdark.nl)'
+__version__ = 0.1
+
+import argparse
+import calendar
+import mmap
+import os
+import struct
+import time
+
+RECORD = struct.Struct('<I3sBfB')
+SUFFIX = '.wdc'
+SEGMENTSECONDS = 86400
+# NumPy and the record dtype, set by ImportNumPy as only queries need them.
+numpy = None
+DTYPE = None
+
+
+def ImportNumPy():
+  """Imports NumPy for the queries, which takes long on a small machine and
+  is not needed to write segments. Returns whether NumPy is available."""
+  global numpy, DTYPE
+  if numpy is None:
+    try:
+      import numpy
+    except ImportError:
+      numpy = False
+      return False
+    # Packed, so the dtype matches RECORD byte for byte.
+    DTYPE = numpy.dtype([('date', '<u4'), ('device', 'S3'), ('sensor', 'u1'),
+                         ('temp', '<f4'), ('humidity', 'u1')])
+  return bool(numpy)
+
+
+def DeviceId(device):
+  """Returns the 3 byte id of a device given as a tuple or as 'a:b:c' hex."""
+  if isinstance(device, basestring):
+    if len(device) == 3 and ':' not in device:
+      return device
+    device = [int(part, 16) for part in device.split(':')]
+  return struct.pack('3B', *device)
+
+
+def DeviceName(deviceid):
+  """Returns the 'a:b:c' hex name of a 3 byte device id."""
+  # NumPy strips trailing NUL bytes from the device column.
+  return '%x:%x:%x' % struct.unpack('3B', deviceid.ljust(3, '\0'))
+
+
+def SegmentName(timestamp):
+  """Returns the name of the segment file for a timestamp."""
+  return time.strftime('%Y%m%d', time.gmtime(timestamp)) + SUFFIX
+
+
+def SegmentStart(name):
+  """Returns the first timestamp of the day a segment file holds."""
+  return calendar.timegm(time.strptime(name[:8], '%Y%m%d'))
+
+
+class ColumnarWriter(object):
+  """Collects records in memory and appends them to the day segments in
+  batches, once `maxrecords` are pending or the oldest pending record is
+  `maxdelay` seconds old. A batch is sorted on timestamp and written with a
+  single write() per segment, so a crash can at most leave one partial record
+  at the end of a segment, which readers ignore."""
+
+  def __init__(self, directory, maxrecords=500, maxdelay=5.0):
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    self.directory = directory
+    self.maxrecords = maxrecords
+    self.maxdelay = maxdelay
+    self.records = []
+    self.oldest = None
+    self.deviceids = {}
+
+  def Add(self, timestamp, device, sensor, temp, humidity):
+    """Queues a measurement. The temperature is a float or None, the humidity
+    an int or None."""
+    deviceid = self.deviceids.get(device)
+    if deviceid is None:
+      deviceid = self.deviceids[device] = DeviceId(device)
+    if not self.records:
+      self.oldest = time.time()
+    self.records.append((
+        int(timestamp), deviceid, sensor,
+        float('nan') if temp is None else temp,
+        255 if humidity is None else humidity))
+    if len(self.records) >= self.maxrecords:
+      self.Flush()
+    else:
+      self.Tick()
+
+  def Tick(self):
+    """Flushes the pending records if they have been waiting for too long."""
+    if self.records and time.time() - self.oldest >= self.maxdelay:
+      self.Flush()
+
+  def Flush(self):
+    """Appends all pending records to their segments."""
+    if not self.records:
+      return
+    self.records.sort(key=lambda record: record[0])
+    segments = {}
+    for record in self.records:
+      day = record[0] // SEGMENTSECONDS
+      segments.setdefault(day, []).append(RECORD.pack(*record))
+    for day, records in sorted(segments.items()):
+      segment = os.path.join(self.directory,
+                             SegmentName(day * SEGMENTSECONDS))
+      if os.path.exists(segment):
+        # Drop a partial record left behind by a crash.
+        size = os.path.getsize(segment)
+        if size % RECORD.size:
+          with open(segment, 'r+b') as segmentfile:
+            segmentfile.truncate(size - size % RECORD.size)
+      with open(segment, 'ab') as segmentfile:
+        segmentfile.write(''.join(records))
+    self.records = []
+    self.oldest = None
+
+  def Close(self):
+    self.Flush()
+
+
+class ColumnarReader(object):
+  """Reads the segments in a directory. Segments are memory mapped once and
+  mapped again when they grew, so repeated queries only touch the pages they
+  need."""
+
+  def __init__(self, directory):
+    self.directory = directory
+    # path -> (size, records, sorted)
+    self.segments = {}
+
+  def Segments(self, start=0, end=None):
+    """Returns the paths of the segments with data between start and end."""
+    paths = []
+    for name in sorted(os.listdir(self.directory)):
+      if not name.endswith(SUFFIX):
+        continue
+      first = SegmentStart(name)
+      if first + SEGMENTSECONDS <= start or (end is not None and first > end):
+        continue
+      paths.append(os.path.join(self.directory, name))
+    return paths
+
+  def Load(self, path):
+    """Returns the records of a segment as a read-only NumPy record array on
+    top of a memory map, and whether its timestamps are sorted."""
+    size = os.path.getsize(path)
+    cached = self.segments.get(path)
+    if cached and cached[0] == size:
+      return cached[1], cached[2]
+    count = size // RECORD.size
+    if not count:
+      records = numpy.zeros(0, DTYPE)
+    else:
+      records = numpy.memmap(path, DTYPE, 'r', shape=(count,))
+    dates = records['date']
+    issorted = bool(numpy.all(dates[1:] >= dates[:-1]))
+    self.segments[path] = size, records, issorted
+    return records, issorted
+
+  def Query(self, start=0, end=None, device=None, sensor=None):
+    """Returns a NumPy record array (see DTYPE) of the measurements with
+    start <= date <= end, optionally of a single device and sensor."""
+    if not ImportNumPy():
+      raise RuntimeError('Columnar queries need NumPy, use Records instead')
+    if end is None:
+      end = 2 ** 32 - 1
+    deviceid = DeviceId(device) if device is not None else None
+    results = []
+    for path in self.Segments(start, end):
+      records, issorted = self.Load(path)
+      if issorted:
+        dates = records['date']
+        records = records[dates.searchsorted(start, 'left'):
+                          dates.searchsorted(end, 'right')]
+      else:
+        dates = records['date']
+        records = records[(dates >= start) & (dates <= end)]
+      if deviceid is not None:
+        records = records[records['device'] == deviceid]
+      if sensor is not None:
+        records = records[records['sensor'] == sensor]
+      if len(records):
+        results.append(records)
+    if not results:
+      return numpy.zeros(0, DTYPE)
+    return numpy.concatenate(results)
+
+  def Records(self, start=0, end=None, device=None, sensor=None):
+    """Yields (date, device, sensor, temp, humidity) tuples like Query, without
+    NumPy. This unpacks every record in the selected segments."""
+    deviceid = DeviceId(device) if device is not None else None
+    for path in self.Segments(start, end):
+      size = os.path.getsize(path) // RECORD.size * RECORD.size
+      if not size:
+        continue
+      with open(path, 'rb') as segmentfile:
+        segment = mmap.mmap(segmentfile.fileno(), size,
+                            access=mmap.ACCESS_READ)
+        try:
+          for offset in xrange(0, size, RECORD.size):
+            record = RECORD.unpack_from(segment, offset)
+            if record[0] < start or (end is not None and record[0] > end):
+              continue
+            if deviceid is not None and record[1] != deviceid:
+              continue
+            if sensor is not None and record[2] != sensor:
+              continue
+            yield record
+        finally:
+          segment.close()
+
+
+def main():
+  """Prints per device and sensor statistics for a time range."""
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('directory', help='Directory with the segment files')
+  parser.add_argument('-s', '--start', type=int, default=0,
+                      help='First timestamp (default: all data)')
+  parser.add_argument('-e', '--end', type=int, default=None,
+                      help='Last timestamp (default: all data)')
+  parser.add_argument('-d', '--device', help='Device id, e.g. 1:2:3')
+  parser.add_argument('--sensor', type=int, help='Sensor number')
+  options = parser.parse_args()
+  reader = ColumnarReader(options.directory)
+  stats = {}
+  if ImportNumPy():
+    records = reader.Query(options.start, options.end, options.device,
+                           options.sensor)
+    records = zip(records['date'], records['device'], records['sensor'],
+                  records['temp'], records['humidity'])
+  else:
+    records = reader.Records(options.start, options.end, options.device,
+                             options.sensor)
+  for _date, deviceid, sensor, temp, humidity in records:
+    if temp != temp:
+      continue
+    stat = stats.setdefault((deviceid, sensor), [0, temp, 0.0, temp])
+    stat[0] += 1
+    stat[1] = min(stat[1], temp)
+    stat[2] += temp
+    stat[3] = max(stat[3], temp)
+  for (deviceid, sensor), (count, low, total, high) in sorted(stats.items()):
+    print '%-10s sensor %3d: %8d readings, temp %.2f/%.2f/%.2f' % (
+        DeviceName(deviceid), sensor, count, low, total / count, high)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,50 @@
+#!/usr/bin/python2.7
+# -*- coding: utf8 -*-
+""" Lazily imported modules for the WeatherDuino tools.
+
+A LazyModule stands in for a module in the namespace of the module that uses
+it, until an attribute of it is first looked up. It then imports the module
+and replaces itself by it in that namespace, so later lookups cost nothing
+extra. A tool then only loads the backends its options select, which matters
+for the start time on slow machines like a Raspberry Pi Zero.
+
+A LazyModule is always true, use Available to check for an optional module
+without importing it."""
+__author__ = 'Jan KLopper (jan@underdark.nl)'
+__version__ = 0.1
+
+import imp
+import importlib
+import sys
+
+
+class LazyModule(object):
+  """Imports the module `name` on first use and binds it as `alias` (default:
+  `name`) in `namespace`, normally the globals() of the using module."""
+
+  def __init__(self, name, namespace, alias=None):
+    self._name = name
+    self._namespace = namespace
+    self._alias = alias or name
+
+  def __getattr__(self, attribute):
+    module = importlib.import_module(self._name)
+    self._namespace[self._alias] = module
+    return getattr(module, attribute)
+
+  def __repr__(self):
+    return '<lazy module %r>' % self._name
+
+
+def Available(name):
+  """Returns whether the top level module `name` can be imported, without
+  importing it."""
+  if name in sys.modules:
+    return True
+  try:
+    moduleinfo = imp.find_module(name)
+  except ImportError:
+    return False
+  if moduleinfo[0]:
+    moduleinfo[0].close()
+  return True
@@ -0,0 +1,327 @@
+#!/usr/bin/python2.7
+# -*- coding: utf8 -*-
+""" Low overhead metrics for the WeatherDuino tools.
+
+Metrics live in a Registry and are exported in the Prometheus text format by
+a small HTTP server (MetricsServer), and pushed to Carbon (CarbonPusher).
+Updating a metric is a plain attribute or list update without locks; metric
+values are only formatted when they are scraped or pushed."""
+__author__ = 'Jan KLopper (jan@underdark.nl)'
+__version__ = 0.1
+
+import BaseHTTPServer
+import bisect
+import heapq
+import operator
+import socket
+import threading
+import time
+import urlparse
+
+# Latencies in the hot paths are timed for one in SAMPLEEVERY calls only.
+SAMPLEEVERY = 16
+# Upper bounds in seconds of the latency histogram buckets.
+LATENCYBUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3,
+                  5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 1.0)
+# Devices and sensors whose last reading is kept at most, and the seconds
+# after which a silent sensor is no longer exported.
+MAXDEVICES = 65536
+LASTSEENAGE = 7 * 86400
+
+
+def FormatLabels(labels):
+  if not labels:
+    return ''
+  return '{%s}' % ','.join('%s="%s"' % (key, value)
+                           for key, value in sorted(labels.items()))
+
+
+def CarbonPath(prefix, name, labels):
+  """Returns the Carbon path of a sample, labels become path components."""
+  path = [prefix, name]
+  path.extend(str(labels[key]).replace('.', '_').replace(':', '_')
+              for key in sorted(labels))
+  return '.'.join(path)
+
+
+class Metric(object):
+  """Base class of all metrics. A metric with a `function` calls it for its
+  value whenever it is exported, instead of keeping a value itself. Samples
+  with a value of None are unknown and left out of the export."""
+  kind = 'untyped'
+
+  def __init__(self, name, help, labels=None, function=None):
+    self.name = name
+    self.help = help
+    self.labels = labels or {}
+    self.function = function
+    self.value = 0
+
+  def Samples(self):
+    """Yields (name, labels, value) tuples for this metric."""
+    yield (self.name, self.labels,
+           self.function() if self.function else self.value)
+
+
+class Counter(Metric):
+  """A monotonically increasing count, update it with `counter.value += n`."""
+  kind = 'counter'
+
+
+class Gauge(Metric):
+  """A value that goes up and down."""
+  kind = 'gauge'
+
+
+class Histogram(Metric):
+  """Counts observations (e.g. latencies in seconds) in cumulative buckets.
+
+  A shared histogram keeps its counts in shared memory, so a forked worker
+  process can observe into it while its parent exports it. Every process
+  needs its own shared histogram, as updates are not locked.
+
+  Timing every call of a fast path costs about as much as the path itself,
+  so hot paths only time one in SAMPLEEVERY calls."""
+  kind = 'histogram'
+
+  def __init__(self, name, help, labels=None, buckets=LATENCYBUCKETS,
+               shared=False):
+    super(Histogram, self).__init__(name, help, labels)
+    self.buckets = tuple(buckets)
+    if shared:
+      import multiprocessing
+      self.counts = multiprocessing.RawArray('d', len(self.buckets) + 1)
+      self.total = multiprocessing.RawArray('d', 1)
+    else:
+      self.counts = [0] * (len(self.buckets) + 1)
+      self.total = [0.0]
+
+  def Observe(self, value):
+    self.counts[bisect.bisect_left(self.buckets, value)] += 1
+    self.total[0] += value
+
+  def Samples(self):
+    cumulative = 0
+    for bound, count in zip(self.buckets + ('+Inf',), self.counts[:]):
+      cumulative += int(count)
+      labels = dict(self.labels, le=bound)
+      yield '%s_bucket' % self.name, labels, cumulative
+    yield '%s_sum' % self.name, self.labels, self.total[0]
+    yield '%s_count' % self.name, self.labels, cumulative
+
+
+class LastSeen(Metric):
+  """The last time every device and sensor sent a valid reading.
+
+  The receive loop only stores the latest (timestamp, packet) of every device
+  in `packets`. The packets are checked for valid readings when the metric is
+  exported, so a sensor that alternates between valid and invalid readings
+  may be reported up to one scrape interval late.
+
+  Sensors that sent nothing for `maxage` seconds are dropped, and of more
+  than `maxsensors` (e.g. with spoofed device ids) only the most recently
+  seen are kept. The receive loop calls Fold once `packets` holds
+  `maxdevices` devices."""
+  kind = 'gauge'
+
+  def __init__(self, name, help, maxage=LASTSEENAGE, maxdevices=MAXDEVICES,
+               maxsensors=MAXDEVICES):
+    super(LastSeen, self).__init__(name, help)
+    self.maxage = maxage
+    self.maxdevices = maxdevices
+    self.maxsensors = maxsensors
+    self.packets = {}
+    self.sensors = {}
+    self.lock = threading.Lock()
+
+  def Fold(self):
+    """Moves the valid readings of the stored packets to `sensors` and
+    expires the sensors not seen for too long."""
+    with self.lock:
+      packets, self.packets = self.packets, {}
+      for timestamp, (device, temps, humidities) in packets.values():
+        for sensor in xrange(len(temps)):
+          if temps[sensor][0] < 129 or humidities[sensor] < 255:
+            self.sensors[device, sensor] = timestamp
+      expired = time.time() - self.maxage
+      sensors = [item for item in self.sensors.iteritems()
+                 if item[1] >= expired]
+      if len(sensors) > self.maxsensors:
+        sensors = heapq.nlargest(self.maxsensors, sensors,
+                                 key=operator.itemgetter(1))
+      if len(sensors) < len(self.sensors):
+        self.sensors = dict(sensors)
+    return sensors
+
+  def Samples(self):
+    for (device, sensor), timestamp in sorted(self.Fold()):
+      yield self.name, {'device': '%x:%x:%x' % device,
+                        'sensor': sensor}, timestamp
+
+
+class Registry(object):
+  """A set of metrics, exported in the order they were added."""
+
+  def __init__(self):
+    self.metrics = []
+    self.lock = threading.Lock()
+
+  def Add(self, metric):
+    with self.lock:
+      self.metrics.append(metric)
+    return metric
+
+  def Remove(self, metric):
+    with self.lock:
+      self.metrics.remove(metric)
+
+  def Text(self):
+    """Returns all metrics in the Prometheus text exposition format."""
+    lines = []
+    with self.lock:
+      metrics = list(self.metrics)
+    seen = set()
+    for metric in metrics:
+      if metric.name not in seen:
+        seen.add(metric.name)
+        lines.append('# HELP %s %s' % (metric.name, metric.help))
+        lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+      for name, labels, value in metric.Samples():
+        if value is None:
+          continue
+        lines.append('%s%s %s' % (name, FormatLabels(labels), value))
+    return '\n'.join(lines) + '\n'
+
+  def Datapoints(self, prefix, timestamp=None):
+    """Returns all metrics as Carbon (path, (timestamp, value)) datapoints.
+    Labels become path components, e.g. prefix.sink_dropped.sql."""
+    if timestamp is None:
+      timestamp = int(time.time())
+    with self.lock:
+      metrics = list(self.metrics)
+    datapoints = []
+    for metric in metrics:
+      for name, labels, value in metric.Samples():
+        if value is None:
+          continue
+        datapoints.append((CarbonPath(prefix, name, labels),
+                           (timestamp, value)))
+    return datapoints
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Serves the registry of the server on /metrics, and its other routes."""
+
+  def do_GET(self):
+    path, _sep, query = self.path.partition('?')
+    if path in ('/', '/metrics') and self.server.registry:
+      contenttype = 'text/plain; version=0.0.4'
+      body = self.server.registry.Text()
+    elif path in self.server.routes:
+      try:
+        contenttype, body = self.server.routes[path](urlparse.parse_qs(query))
+      except ValueError, err:
+        self.send_error(400, str(err))
+        return
+    else:
+      self.send_error(404)
+      return
+    self.send_response(200)
+    self.send_header('Content-Type', contenttype)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    pass
+
+
+class MetricsServer(BaseHTTPServer.HTTPServer):
+  """A HTTP server for the Prometheus scraper, in a background thread.
+
+  `routes` maps further paths to functions that are called with the parsed
+  query string and return a (content type, body) tuple, or raise ValueError
+  for a bad request. Without a registry only the routes are served."""
+
+  def __init__(self, registry, address, routes=None):
+    BaseHTTPServer.HTTPServer.__init__(self, address, MetricsHandler)
+    self.registry = registry
+    self.routes = routes or {}
+    thread = threading.Thread(target=self.serve_forever, name='metrics')
+    thread.daemon = True
+    thread.start()
+
+  def Close(self):
+    self.shutdown()
+    self.server_close()
+
+
+class CarbonPusher(threading.Thread):
+  """Pushes the registry to Carbon every `interval` seconds, through its own
+  wdcarbon.CarbonClient. Next to every counter a <name>_per_second rate over
+  the last interval is sent."""
+
+  def __init__(self, registry, client, prefix, interval=60):
+    super(CarbonPusher, self).__init__(name='metrics-carbon')
+    self.daemon = True
+    self.registry = registry
+    self.client = client
+    self.prefix = prefix
+    self.interval = interval
+    self.previous = {}
+    self.stop = threading.Event()
+
+  def run(self):
+    while not self.stop.wait(self.interval):
+      self.Push()
+    self.client.Close()
+
+  def Push(self):
+    now = time.time()
+    datapoints = self.registry.Datapoints(self.prefix, int(now))
+    with self.registry.lock:
+      counters = [metric for metric in self.registry.metrics
+                  if metric.kind == 'counter']
+    for metric in counters:
+      for name, labels, value in metric.Samples():
+        if value is None:
+          continue
+        key = name, tuple(sorted(labels.items()))
+        if key in self.previous:
+          before, then = self.previous[key]
+          datapoints.append((
+              CarbonPath(self.prefix, '%s_per_second' % name, labels),
+              (int(now), (value - before) / (now - then))))
+        self.previous[key] = value, now
+    self.client.AddMany(datapoints)
+    self.client.Flush()
+
+  def Close(self):
+    self.stop.set()
+    self.join()
+
+
+def UDPDrops(port):
+  """Returns the datagrams the kernel dropped on the UDP sockets bound to
+  `port` because their receive buffer was full, or None when unknown."""
+  try:
+    table = open('/proc/net/udp').readlines()
+  except IOError:
+    return None
+  drops = 0
+  for line in table[1:]:
+    fields = line.split()
+    if int(fields[1].split(':')[1], 16) == port:
+      drops += int(fields[-1])
+  return drops
+
+
+def ParseAddress(address, default='127.0.0.1'):
+  """Returns a (host, port) tuple for 'port' or 'host:port'."""
+  host, _sep, port = address.rpartition(':')
+  return host or default, int(port)
+
+
+def Hostname():
+  """Returns the short hostname, for metric paths."""
+  return socket.gethostname().split('.')[0]
@@ -0,0 +1,174 @@
+#!/usr/bin/python2.7
+# -*- coding: utf8 -*-
+""" Recent WeatherDuino readings in memory, served as JSON.
+
+RecentReadings keeps the last readings of every (device, sensor) series in a
+ring buffer, so current conditions and the last hours can be served without
+touching sqlite or the RRD files. All rings are allocated in three flat arrays
+when the buffer is created: a float64 timestamp and a float32 temperature and
+humidity per reading (NaN when unknown). Memory use is READINGSIZE bytes per
+slot, `slots` times `maxseries`, and does not grow afterwards.
+
+Routes returns the endpoints for a wdmetrics.MetricsServer:
+  /latest[?device=D]
+    the latest reading of every series, or of those of device D
+  /readings?device=D&sensor=S[&seconds=N | &start=T[&end=T]]
+    the readings of one series, by default all that are held"""
+__author__ = 'Jan KLopper (jan@underdark.nl)'
+__version__ = 0.1
+
+import array
+import json
+import threading
+import time
+
+# Bytes held per reading: a float64 timestamp and two float32 values.
+READINGSIZE = 16
+NAN = float('nan')
+
+
+def Slots(hours, interval):
+  """Returns the slots per series that hold `hours` of readings arriving
+  every `interval` seconds."""
+  return max(1, int(hours * 3600 / interval))
+
+
+def Value(value):
+  """Returns a stored float32 as a JSON value. The WeatherDuino reports
+  hundredths, which float32 keeps when rounded to 2 decimals."""
+  if value != value:
+    return None
+  return round(value, 2)
+
+
+class RecentReadings(object):
+  """Ring buffers of the last `slots` readings of up to `maxseries` series.
+
+  A series gets its ring when its first reading arrives and keeps it, readings
+  of new series beyond `maxseries` are counted in `overflow` and dropped. A
+  sensor reporting more often than planned for covers less time. Readings are
+  expected in timestamp order per series, as they are stamped on arrival.
+
+  Add is called from the threads receiving readings and the queries from the
+  HTTP server thread, a lock keeps them apart."""
+
+  def __init__(self, slots, maxseries=256):
+    self.slots = slots
+    self.maxseries = maxseries
+    size = slots * maxseries
+    self.times = array.array('d', [0.0]) * size
+    self.temps = array.array('f', [NAN]) * size
+    self.humidities = array.array('f', [NAN]) * size
+    # Readings written per series, the next goes to slot written % slots.
+    self.written = array.array('L', [0]) * maxseries
+    # (device, sensor) -> series number, in order of arrival.
+    self.series = {}
+    self.overflow = 0
+    self.lock = threading.Lock()
+
+  def Memory(self):
+    """Returns the bytes allocated for the readings."""
+    return (self.slots * READINGSIZE + self.written.itemsize) * self.maxseries
+
+  def Add(self, device, sensor, timestamp, temp, humidity):
+    """Stores a reading, None is an unknown temperature or humidity."""
+    with self.lock:
+      number = self.series.get((device, sensor))
+      if number is None:
+        if len(self.series) >= self.maxseries:
+          self.overflow += 1
+          return
+        number = self.series[device, sensor] = len(self.series)
+      written = self.written[number]
+      index = number * self.slots + written % self.slots
+      self.times[index] = timestamp
+      self.temps[index] = NAN if temp is None else temp
+      self.humidities[index] = NAN if humidity is None else humidity
+      self.written[number] = written + 1
+
+  def Reading(self, index):
+    return (self.times[index], Value(self.temps[index]),
+            Value(self.humidities[index]))
+
+  def Latest(self, device=None):
+    """Returns the latest (device, sensor, timestamp, temp, humidity) of every
+    series, or of the series of `device`."""
+    latest = []
+    with self.lock:
+      for (seriesdevice, sensor), number in self.series.iteritems():
+        written = self.written[number]
+        if not written or device is not None and seriesdevice != device:
+          continue
+        latest.append((seriesdevice, sensor) + self.Reading(
+            number * self.slots + (written - 1) % self.slots))
+    latest.sort()
+    return latest
+
+  def Readings(self, device, sensor, start=0, end=None):
+    """Returns the (timestamp, temp, humidity) readings of a series from
+    `start` up to and including `end`, oldest first."""
+    with self.lock:
+      number = self.series.get((device, sensor))
+      if number is None:
+        return []
+      written = self.written[number]
+      count = min(written, self.slots)
+      base = number * self.slots
+      first = written - count
+      slots = self.slots
+      times = self.times
+      # Binary search for the oldest reading at or after start.
+      low, high = 0, count
+      while low < high:
+        middle = (low + high) // 2
+        if times[base + (first + middle) % slots] < start:
+          low = middle + 1
+        else:
+          high = middle
+      readings = []
+      for position in xrange(low, count):
+        index = base + (first + position) % slots
+        if end is not None and times[index] > end:
+          break
+        readings.append(self.Reading(index))
+    return readings
+
+
+def QueryValue(query, name, kind=str, default=None):
+  """Returns the single value of a query parameter, converted by `kind`.
+  Raises ValueError for a missing or malformed parameter."""
+  values = query.get(name)
+  if not values:
+    if default is None:
+      raise ValueError('Missing parameter %s' % name)
+    return default
+  try:
+    return kind(values[-1])
+  except ValueError:
+    raise ValueError('Invalid %s: %r' % (name, values[-1]))
+
+
+def Routes(readings):
+  """Returns the JSON endpoints of a RecentReadings for a MetricsServer."""
+
+  def Latest(query):
+    body = {'series': [
+        {'device': device, 'sensor': sensor, 'time': timestamp,
+         'temp': temp, 'humidity': humidity}
+        for device, sensor, timestamp, temp, humidity
+        in readings.Latest(query.get('device', [None])[-1])]}
+    return 'application/json', json.dumps(body)
+
+  def Readings(query):
+    device = QueryValue(query, 'device')
+    sensor = QueryValue(query, 'sensor', int)
+    end = QueryValue(query, 'end', float, 0) or None
+    if 'seconds' in query:
+      start = time.time() - QueryValue(query, 'seconds', float)
+    else:
+      start = QueryValue(query, 'start', float, 0)
+    body = {'device': device, 'sensor': sensor,
+            'readings': readings.Readings(device, sensor, start, end)}
+    return 'application/json', json.dumps(body)
+
+  return {'/latest': Latest, '/readings': Readings}
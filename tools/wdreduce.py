@@ -0,0 +1,167 @@
+#!/usr/bin/python2.7
+# -*- coding: utf8 -*-
+""" Downsampling and deadband suppression of WeatherDuino readings.
+
+A Reducer sits between the decoder and the storage backends and decides per
+series (e.g. a device's sensor) which readings are stored:
+* with a `window`, the readings of a series are aggregated and one reading
+  per window is stored: the average, minimum, maximum or last value of every
+  quantity over the window
+* with a `deadband`, a reading (or window aggregate) is only stored when one
+  of its values moved more than the deadband away from the last stored one,
+  or when the last one was stored `heartbeat` seconds ago
+
+Error bounds, for a deadband D:
+* stores that hold a value until the next one (sqlite, columnar, Carbon with
+  keepLastValue) are never more than D off the reading they left out
+* RRD files fill the time before an update with its value. With `backfill`
+  the last left out reading is stored just before a change, which keeps RRD
+  files within 2 * D of every reading
+A deadband of 0 only leaves out readings equal to the last stored one, which
+loses nothing but the repeats. A window aggregate is stored with the time of
+the last reading in the window; the window closes with the first reading
+`window` seconds after its first. Gaps between stored readings are at most
+`heartbeat` plus `window` seconds, keep that below the heartbeat of RRD data
+sources (600 seconds) or the gaps become unknown.
+
+Averages and rollups over the stored readings weigh every stored reading the
+same, so with a deadband the periods with change count more than steady
+ones."""
+__author__ = 'Jan KLopper (jan@underdark.nl)'
+__version__ = 0.1
+
+AGGREGATES = ('avg', 'min', 'max', 'last')
+# Series whose window and deadband state is kept at most. When there are more
+# the state is dropped, which at worst stores a reading early.
+MAXSERIES = 65536
+
+
+class Window(object):
+  """The readings of one series in the current window, per quantity, and the
+  time of the first and last reading."""
+  __slots__ = ('start', 'end', 'count', 'total', 'low', 'high', 'last')
+
+  def __init__(self, start, size):
+    self.start = self.end = start
+    self.count = [0] * size
+    self.total = [0.0] * size
+    self.low = [None] * size
+    self.high = [None] * size
+    self.last = [None] * size
+
+  def Add(self, timestamp, values):
+    self.end = timestamp
+    for position, value in enumerate(values):
+      if value is None:
+        continue
+      self.count[position] += 1
+      self.total[position] += value
+      if self.low[position] is None or value < self.low[position]:
+        self.low[position] = value
+      if self.high[position] is None or value > self.high[position]:
+        self.high[position] = value
+      self.last[position] = value
+
+  def Value(self, aggregate, digits):
+    """Returns the aggregate of every quantity, None for those without a
+    reading in the window. Averages are rounded to `digits` decimals."""
+    if aggregate == 'avg':
+      return tuple(round(total / count, digits) if count else None
+                   for total, count in zip(self.total, self.count))
+    return tuple({'min': self.low, 'max': self.high,
+                  'last': self.last}[aggregate])
+
+
+def Changed(values, previous, deadbands):
+  """Returns whether any value moved more than its deadband away from the
+  previous one, or became or stopped being unknown."""
+  if len(values) != len(previous):
+    return True
+  for value, last, deadband in zip(values, previous, deadbands):
+    if value is None or last is None:
+      if value is not last:
+        return True
+    elif abs(value - last) > deadband:
+      return True
+  return False
+
+
+class Reducer(object):
+  """Decides per series which readings are stored, see the module docstring.
+
+  Readings are tuples of values (None when unknown), the same number for
+  every reading of a series. `deadband` is None to store every reading (or
+  window aggregate), a number for all values or a tuple with one per value.
+  Readings are expected in timestamp order per series."""
+
+  def __init__(self, window=0, aggregate='avg', deadband=None, heartbeat=300,
+               backfill=False, digits=2, maxseries=MAXSERIES):
+    if aggregate not in AGGREGATES:
+      raise ValueError('Unknown aggregate %r, use one of %s' % (
+          aggregate, ', '.join(AGGREGATES)))
+    self.window = window
+    self.aggregate = aggregate
+    self.deadband = deadband
+    self.heartbeat = heartbeat
+    self.backfill = backfill
+    self.digits = digits
+    self.maxseries = maxseries
+    # Series -> Window, and series -> [timestamp, values, left out reading]
+    # of the last stored reading.
+    self.windows = {}
+    self.stored = {}
+    self.added = 0
+    self.kept = 0
+
+  def Add(self, series, timestamp, values):
+    """Adds a reading, returns the (timestamp, values) readings to store."""
+    self.added += 1
+    if self.window:
+      window = self.windows.get(series)
+      if window is None:
+        if len(self.windows) >= self.maxseries:
+          self.windows.clear()
+        window = self.windows[series] = Window(timestamp, len(values))
+      window.Add(timestamp, values)
+      if timestamp - window.start < self.window:
+        return []
+      del self.windows[series]
+      values = window.Value(self.aggregate, self.digits)
+    return self.Store(series, timestamp, values)
+
+  def Store(self, series, timestamp, values):
+    """Applies the deadband to a reading or window aggregate."""
+    if self.deadband is None:
+      self.kept += 1
+      return [(timestamp, values)]
+    stored = self.stored.get(series)
+    readings = []
+    if stored is None:
+      if len(self.stored) >= self.maxseries:
+        self.stored.clear()
+    else:
+      deadbands = self.deadband
+      if not isinstance(deadbands, tuple):
+        deadbands = (deadbands,) * len(values)
+      if not Changed(values, stored[1], deadbands):
+        if timestamp - stored[0] < self.heartbeat:
+          stored[2] = timestamp, values
+          return []
+      elif self.backfill and stored[2]:
+        readings.append(stored[2])
+    readings.append((timestamp, values))
+    self.stored[series] = [timestamp, values, None]
+    self.kept += len(readings)
+    return readings
+
+  def Flush(self):
+    """Closes every open window. Returns the (series, timestamp, values)
+    readings to store, at the time of the last reading of their window."""
+    readings = []
+    windows, self.windows = self.windows, {}
+    for series, window in windows.iteritems():
+      readings.extend(
+          (series, timestamp, values) for timestamp, values in self.Store(
+              series, window.end,
+              window.Value(self.aggregate, self.digits)))
+    return readings
@@ -0,0 +1,127 @@
+#!/usr/bin/python2.7
+# -*- coding: utf8 -*-
+""" Replays WeatherDuino capture files without the hardware.
+
+Datagrams in a capture (see udplistener --capture) are sent to a listener over
+UDP, serial lines (see wd2rrd.py --capture) are written to a pseudo terminal
+that wd2rrd.py can open as its serial device. Records are replayed with the
+timing they were captured with, optionally sped up, or as fast as possible."""
+__author__ = 'Jan KLopper (jan@underdark.nl)'
+__version__ = 0.1
+
+import argparse
+import os
+import pty
+import socket
+import time
+import tty
+import wdcapture
+
+
+class FakeSerial(object):
+  """A pseudo terminal standing in for the serial port of a WeatherDuino.
+  `device` is the path to open as the serial port, `link` optionally a
+  symlink to it with a stable name."""
+
+  def __init__(self, link=None):
+    self.master, self.slave = pty.openpty()
+    # No echo and no newline translation, like a serial line.
+    tty.setraw(self.slave)
+    self.device = os.ttyname(self.slave)
+    self.link = link
+    if link:
+      if os.path.lexists(link):
+        os.unlink(link)
+      os.symlink(self.device, link)
+
+  def Write(self, data):
+    os.write(self.master, data)
+
+  def Close(self):
+    if self.link and os.path.islink(self.link):
+      os.unlink(self.link)
+    os.close(self.master)
+    os.close(self.slave)
+
+
+def Replay(records, send, speed=1.0, loops=1):
+  """Calls send(data) for the (timestamp, kind, data) records. With a speed
+  the gaps between the records are replayed divided by it, with 0 the records
+  are sent as fast as possible. Returns how many records were sent."""
+  if loops > 1:
+    records = list(records)
+  sent = 0
+  start = time.time()
+  # Seconds of the capture replayed so far.
+  elapsed = 0.0
+  for _loop in xrange(loops):
+    previous = None
+    for timestamp, _kind, data in records:
+      if speed:
+        if previous is not None:
+          elapsed += max(0, timestamp - previous)
+        previous = timestamp
+        delay = start + elapsed / speed - time.time()
+        if delay > 0:
+          time.sleep(delay)
+      send(data)
+      sent += 1
+  return sent
+
+
+def ReplayUDP(filename, address, speed=1.0, loops=1):
+  """Sends the datagrams of a capture file to a (host, port) address."""
+  udpsock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  try:
+    return Replay(wdcapture.Read(filename, wdcapture.DATAGRAM),
+                  lambda data: udpsock.sendto(data, address), speed, loops)
+  finally:
+    udpsock.close()
+
+
+def ReplaySerial(filename, fakeserial, speed=1.0, loops=1):
+  """Writes the serial lines of a capture file to a FakeSerial."""
+  return Replay(wdcapture.Read(filename, wdcapture.SERIAL),
+                fakeserial.Write, speed, loops)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('capture', help='Capture file to replay')
+  parser.add_argument('-u', '--udp', metavar='[HOST:]PORT',
+                      help='Send the datagrams to this address')
+  parser.add_argument('-s', '--serial', metavar='LINK', nargs='?', const='',
+                      help='Write the serial lines to a pseudo terminal, '
+                      'optionally symlinked as LINK')
+  parser.add_argument('-x', '--speed', type=float, default=1.0,
+                      help='Replay speed, 0 is as fast as possible '
+                      '(default: real time)')
+  parser.add_argument('-n', '--loops', type=int, default=1,
+                      help='Times to replay the capture')
+  parser.add_argument('-w', '--wait', type=float, default=0,
+                      help='Seconds to wait before replaying, to start '
+                      'wd2rrd.py on the pseudo terminal')
+  options = parser.parse_args()
+  if options.udp is None and options.serial is None:
+    parser.error('Replay to --udp and/or --serial')
+  start = time.time()
+  if options.udp is not None:
+    host, _sep, port = options.udp.rpartition(':')
+    sent = ReplayUDP(options.capture, (host or '127.0.0.1', int(port)),
+                     options.speed, options.loops)
+    print '%d datagrams sent in %.1fs' % (sent, time.time() - start)
+  if options.serial is not None:
+    fakeserial = FakeSerial(options.serial or None)
+    print 'Serial lines are written to %s' % (
+        options.serial or fakeserial.device)
+    try:
+      time.sleep(options.wait)
+      start = time.time()
+      sent = ReplaySerial(options.capture, fakeserial, options.speed,
+                          options.loops)
+      print '%d serial lines written in %.1fs' % (sent, time.time() - start)
+    finally:
+      fakeserial.Close()
+
+if __name__ == '__main__':
+  main()
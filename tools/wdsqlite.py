@@ -0,0 +1,317 @@
+#!/usr/bin/python2.7
+# -*- coding: utf8 -*-
+""" SQLite storage and queries for the WeatherDuino listener.
+
+The schema is versioned through PRAGMA user_version. Raw measurements go into
+a typed `sensors` table indexed on (device, sensor, date); devices are stored
+as their 'a:b:c' hex id and unknown values as NULL. Next to it rollup tables
+hold the count, min, sum and max of every time bucket, updated in the same
+transaction as the raw rows, so downsampled series never read raw rows.
+
+Databases written by older listeners (an untyped sensors table, user_version
+0) are migrated in place when they are opened. They stored negative
+temperatures as the whole degrees rounded down and the hundredths, e.g. -6.25
+as -7.75; the migration converts them to the true value, as new rows are
+stored."""
+__author__ = 'Jan KLopper (jan@underdark.nl)'
+__version__ = 0.1
+
+import argparse
+import math
+import sqlite3
+import time
+
+SCHEMAVERSION = 1
+# Rollup bucket sizes in seconds: the RRAs of wd2rrd's DEFRRD (5 minutes, 30
+# minutes, 2 hours and a day) plus hourly buckets.
+ROLLUPS = (300, 1800, 3600, 7200, 86400)
+# Points a series should have at most when no step is given, the number of
+# rows in every RRA of DEFRRD.
+MAXPOINTS = 800
+
+SCHEMA = ("""
+  CREATE TABLE sensors (
+    date INTEGER NOT NULL,
+    device TEXT NOT NULL,
+    sensor INTEGER NOT NULL,
+    temp REAL,
+    humidity INTEGER)""", """
+  CREATE INDEX sensors_device_sensor_date ON sensors (device, sensor, date)""")
+ROLLUPSCHEMA = """
+  CREATE TABLE rollup_%d (
+    device TEXT NOT NULL,
+    sensor INTEGER NOT NULL,
+    date INTEGER NOT NULL,
+    tempcount INTEGER NOT NULL,
+    tempmin REAL,
+    tempsum REAL,
+    tempmax REAL,
+    humiditycount INTEGER NOT NULL,
+    humiditymin INTEGER,
+    humiditysum INTEGER,
+    humiditymax INTEGER,
+    PRIMARY KEY (device, sensor, date))
+"""
+# The writer keeps the complete aggregate of every open bucket in memory and
+# writes it over the stored row, which needs no UPSERT (missing in older
+# SQLite versions) and lets a whole batch go out in one executemany().
+ROLLUPREPLACE = 'INSERT OR REPLACE INTO rollup_%d ' \
+                'VALUES (?,?,?,?,?,?,?,?,?,?,?)'
+ROLLUPSELECT = 'SELECT * FROM rollup_%d WHERE device = ? AND sensor = ? ' \
+               'AND date = ?'
+ROLLUPREBUILD = """
+  INSERT INTO rollup_%(step)d
+  SELECT device, sensor, date - date %% %(step)d,
+         COUNT(temp), MIN(temp), SUM(temp), MAX(temp),
+         COUNT(humidity), MIN(humidity), SUM(humidity), MAX(humidity)
+  FROM sensors GROUP BY device, sensor, date - date %% %(step)d
+"""
+
+
+def DeviceName(device):
+  """Returns the 'a:b:c' hex id the database uses for a device tuple."""
+  return '%x:%x:%x' % (device[0], device[1], device[2])
+
+
+def LegacyDeviceName(device):
+  """Converts the '(1, 2, 3)' device repr of the original schema."""
+  try:
+    return DeviceName([int(part) for part in device.strip('()').split(',')])
+  except (ValueError, IndexError, AttributeError):
+    return device
+
+
+def LegacyTemp(temp):
+  """Converts a temperature of the original schema, which stored the whole
+  degrees (rounded down) and the hundredths as '%d.%02d', so -6.25 as -7.75.
+  Positive temperatures were stored correctly."""
+  if temp is None or temp >= 0:
+    return temp
+  whole = math.trunc(temp)
+  return round(whole + abs(temp - whole), 2)
+
+
+def Connect(filename, verbose=False):
+  """Opens (creating or migrating when needed) a database. The connection may
+  be handed to another thread, but only one thread may use it at a time."""
+  connection = sqlite3.connect(filename, check_same_thread=False)
+  Migrate(connection, verbose)
+  return connection
+
+
+def Migrate(connection, verbose=False):
+  """Brings the schema of the database up to SCHEMAVERSION."""
+  version = connection.execute('PRAGMA user_version').fetchone()[0]
+  if version == SCHEMAVERSION:
+    return
+  if version > SCHEMAVERSION:
+    raise ValueError('Database schema version %d is newer than %d' % (
+        version, SCHEMAVERSION))
+  legacy = connection.execute(
+      "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sensors'"
+      ).fetchone()
+  # The sqlite3 module commits before every CREATE or ALTER statement, so
+  # manage the transaction by hand to migrate all or nothing.
+  isolation = connection.isolation_level
+  connection.isolation_level = None
+  try:
+    connection.execute('BEGIN')
+    if legacy:
+      if verbose:
+        print 'Migrating sqlite database to schema version %d' % SCHEMAVERSION
+      connection.create_function('legacydevice', 1, LegacyDeviceName)
+      connection.create_function('legacytemp', 1, LegacyTemp)
+      connection.execute('ALTER TABLE sensors RENAME TO sensors_legacy')
+    elif verbose:
+      print 'Create sqlite database'
+    for statement in SCHEMA:
+      connection.execute(statement)
+    for step in ROLLUPS:
+      connection.execute(ROLLUPSCHEMA % step)
+    if legacy:
+      # The original listener stored out of range readings as they came in,
+      # and negative temperatures in the '%d.%02d' form (see LegacyTemp).
+      connection.execute("""
+        INSERT INTO sensors
+        SELECT CAST(date AS INTEGER), legacydevice(device),
+               CAST(sensor AS INTEGER),
+               CASE WHEN temp < 129 THEN legacytemp(temp) END,
+               CASE WHEN humidity < 255 THEN CAST(humidity AS INTEGER) END
+        FROM sensors_legacy ORDER BY date""")
+      for step in ROLLUPS:
+        connection.execute(ROLLUPREBUILD % {'step': step})
+      connection.execute('DROP TABLE sensors_legacy')
+    connection.execute('PRAGMA user_version = %d' % SCHEMAVERSION)
+    connection.execute('COMMIT')
+  except:
+    connection.execute('ROLLBACK')
+    raise
+  finally:
+    connection.isolation_level = isolation
+
+
+class BufferedSQLWriter(object):
+  """Collects sensor rows in memory and writes them to sqlite in batches.
+
+  Rows are written with a single executemany() inside one transaction once
+  either `maxrows` rows are pending or the oldest pending row is older than
+  `maxdelay` seconds. This trades one fsync per measurement for one per batch.
+  The rollups are updated in the same transaction, so they always match the
+  raw rows. A database should only have one writer, as the writer keeps the
+  latest bucket of every sensor in memory.
+  """
+  INSERT = 'INSERT INTO sensors VALUES (?,?,?,?,?)'
+
+  def __init__(self, connection, maxrows=500, maxdelay=5.0):
+    self.connection = connection
+    self.maxrows = maxrows
+    self.maxdelay = maxdelay
+    self.rows = []
+    self.oldest = None
+    # step -> (device, sensor) -> the latest rollup row of that sensor.
+    self.buckets = dict((step, {}) for step in ROLLUPS)
+    # WAL lets readers query the database while we are writing to it, and
+    # NORMAL sync only fsyncs the WAL at checkpoints instead of every commit.
+    self.connection.execute('PRAGMA journal_mode=WAL')
+    self.connection.execute('PRAGMA synchronous=NORMAL')
+
+  def Add(self, row):
+    """Queues a (date, device, sensor, temp, humidity) row and flushes if the
+    batch is full or too old. Unknown values are None."""
+    if not self.rows:
+      self.oldest = time.time()
+    self.rows.append(row)
+    if len(self.rows) >= self.maxrows:
+      self.Flush()
+    else:
+      self.Tick()
+
+  def Tick(self):
+    """Flushes the pending rows if they have been waiting for too long."""
+    if self.rows and time.time() - self.oldest >= self.maxdelay:
+      self.Flush()
+
+  def Flush(self):
+    """Writes all pending rows and their rollups in a single transaction."""
+    if not self.rows:
+      return
+    with self.connection:
+      self.connection.executemany(self.INSERT, self.rows)
+      for step in ROLLUPS:
+        self.connection.executemany(ROLLUPREPLACE % step, self.Rollup(step))
+    self.rows = []
+    self.oldest = None
+
+  def Rollup(self, step):
+    """Adds the pending rows to the rollup rows of size `step` and returns the
+    rows that changed."""
+    latest = self.buckets[step]
+    changed = {}
+    for date, device, sensor, temp, humidity in self.rows:
+      start = date - date % step
+      bucket = latest.get((device, sensor))
+      if bucket is None or bucket[2] != start:
+        bucket = changed.get((device, sensor, start))
+        if bucket is None:
+          bucket = self.connection.execute(
+              ROLLUPSELECT % step, (device, sensor, start)).fetchone()
+          bucket = list(bucket or (device, sensor, start, 0, None, None, None,
+                                   0, None, None, None))
+        if (device, sensor) not in latest or \
+            start > latest[device, sensor][2]:
+          latest[device, sensor] = bucket
+      changed[device, sensor, start] = bucket
+      if temp is not None:
+        if bucket[3]:
+          bucket[4] = min(bucket[4], temp)
+          bucket[5] += temp
+          bucket[6] = max(bucket[6], temp)
+        else:
+          bucket[4] = bucket[5] = bucket[6] = temp
+        bucket[3] += 1
+      if humidity is not None:
+        if bucket[7]:
+          bucket[8] = min(bucket[8], humidity)
+          bucket[9] += humidity
+          bucket[10] = max(bucket[10], humidity)
+        else:
+          bucket[8] = bucket[9] = bucket[10] = humidity
+        bucket[7] += 1
+    return changed.values()
+
+  def Close(self):
+    self.Flush()
+    self.connection.close()
+
+
+def Step(start, end, points=MAXPOINTS):
+  """Returns the smallest rollup step that gives at most `points` points for
+  the time range, or the largest one."""
+  for step in ROLLUPS:
+    if (end - start) // step < points:
+      return step
+  return ROLLUPS[-1]
+
+
+def Series(connection, device, sensor, start, end=None, step=None,
+           points=MAXPOINTS):
+  """Returns the downsampled series of a sensor between start and end (default
+  now) from the rollup with the given step, or the finest rollup that gives at
+  most `points` points. Every point is a tuple of the bucket start, temp
+  min/avg/max and humidity min/avg/max; values are None when unknown."""
+  if end is None:
+    end = int(time.time())
+  if step is None:
+    step = Step(start, end, points)
+  elif step not in ROLLUPS:
+    raise ValueError('No rollup with step %r, use one of %r' % (step, ROLLUPS))
+  if not isinstance(device, basestring):
+    device = DeviceName(device)
+  return connection.execute("""
+    SELECT date, tempmin, tempsum / tempcount, tempmax,
+           humiditymin, CAST(humiditysum AS REAL) / humiditycount, humiditymax
+    FROM rollup_%d
+    WHERE device = ? AND sensor = ? AND date BETWEEN ? AND ?
+    ORDER BY date""" % step, (device, sensor, start - start % step,
+                                end)).fetchall()
+
+
+def Sensors(connection):
+  """Returns the (device, sensor) pairs in the database and the start of the
+  last (finest) rollup bucket each was seen in."""
+  return connection.execute("""
+    SELECT device, sensor, MAX(date) FROM rollup_%d
+    GROUP BY device, sensor ORDER BY device, sensor""" % ROLLUPS[0]
+                            ).fetchall()
+
+
+def main():
+  """Migrates a database and prints the sensors in it or a series."""
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('database', help='sqlite file written by udplistener')
+  parser.add_argument('-d', '--device', help='Device id, e.g. 1:2:3')
+  parser.add_argument('-s', '--sensor', type=int, default=0,
+                      help='Sensor number')
+  parser.add_argument('--start', type=int, default=None,
+                      help='First timestamp (default: a day ago)')
+  parser.add_argument('--end', type=int, default=None,
+                      help='Last timestamp (default: now)')
+  parser.add_argument('--step', type=int, default=None,
+                      help='Rollup step in seconds, one of %r' % (ROLLUPS,))
+  options = parser.parse_args()
+  connection = Connect(options.database, verbose=True)
+  if not options.device:
+    for device, sensor, lastseen in Sensors(connection):
+      print '%-10s sensor %3d, last seen %s' % (
+          device, sensor, time.ctime(lastseen))
+    return
+  end = options.end or int(time.time())
+  start = options.start if options.start is not None else end - 86400
+  for point in Series(connection, options.device, options.sensor, start, end,
+                      options.step):
+    print time.strftime('%Y-%m-%d %H:%M', time.localtime(point[0])),
+    print ' '.join('%7s' % ('-' if value is None else '%.2f' % value)
+                   for value in point[1:])
+
+if __name__ == '__main__':
+  main()